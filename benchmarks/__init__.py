@@ -0,0 +1 @@
+"""Performance benchmarks, run them from the repository root"""
@@ -0,0 +1,108 @@
+"""
+Compares the cost of parsing ffmpeg progress reports with the `-progress` channel parser and
+with the previous approach, which scraped the stats lines ffmpeg writes on stderr.
+
+Usage: python -m benchmarks.bench_progress [number of reports]
+"""
+import datetime
+import io
+import re
+import sys
+
+from contextlib import redirect_stdout
+from dataclasses import dataclass
+from timeit import timeit
+from typing import Any, Callable, ClassVar, Dict, Optional, Pattern, Sequence
+
+from video_transformer.core import ProgressParser
+
+#: Regex used to parse progress lines with multiple key=value pairs (previous implementation)
+PROGRESS_RE: Pattern = re.compile(r"(\w+)=\s*([^ ]+) ?")
+
+
+def parse_timestamp(as_str: str) -> datetime.timedelta:
+    """Parses a timestamp in HH:MM:SS format"""
+    kwargs = dict(zip(
+        ("hours", "minutes", "seconds"),
+        map(int, as_str.split(".")[0].split(":"))
+    ))
+    return datetime.timedelta(days=0, **kwargs)
+
+
+def parse_speed(as_str: str) -> float:
+    """Parses a speed in N.NNx format"""
+    return float(as_str.rstrip("x"))
+
+
+@dataclass
+class LegacyProgress:
+    """The progress record, as it was before the `-progress` channel"""
+    fps: float
+    size: str
+    time: datetime.timedelta
+    bitrate: str
+    speed: Optional[float] = None
+
+    _PARSERS: ClassVar[Dict[str, Callable[[str], Any]]] = {
+        "fps": float,
+        "time": parse_timestamp,
+        "speed": parse_speed,
+    }
+
+    @classmethod
+    def from_raw_dict(cls, data: Dict[str, str]):
+        print(data)
+        return cls(**{field: cls._PARSERS.get(field, str)(data[field])
+                      for field in cls.__dataclass_fields__  # type: ignore
+                      if field in data})
+
+
+def legacy_parse(lines: Sequence[str]) -> Optional[LegacyProgress]:
+    """The stderr scraping parser, as it was before the `-progress` channel"""
+    for line in reversed(lines):
+        raw_status = dict(PROGRESS_RE.findall(line))
+        if raw_status:
+            try:
+                return LegacyProgress.from_raw_dict(raw_status)
+            except (TypeError, ValueError):
+                pass
+    return None
+
+
+def stderr_report(idx: int) -> str:
+    """A stats line, as written on stderr"""
+    return (f"frame={idx:5d} fps= 25 q=29.0 size=   {idx * 3}kB time=00:{idx // 1500:02d}:"
+            f"{idx // 25 % 60:02d}.{idx % 25 * 4:02d} bitrate= 881.0kbits/s dup=0 drop=2 "
+            f"speed=6.38x    ")
+
+
+def progress_report(idx: int) -> bytes:
+    """A block of the `-progress` channel"""
+    return (f"frame={idx}\nfps=25.00\nstream_0_0_q=29.0\nbitrate= 881.0kbits/s\n"
+            f"total_size={idx * 3072}\nout_time_us={idx * 40000}\nout_time_ms={idx * 40000}\n"
+            f"out_time=00:00:00.000000\ndup_frames=0\ndrop_frames=2\nspeed=6.38x\n"
+            f"progress=continue\n").encode()
+
+
+def main(count: int):
+    stderr_chunks = [stderr_report(idx) for idx in range(count)]
+    progress_chunks = [progress_report(idx) for idx in range(count)]
+
+    def run_legacy():
+        # The previous parser printed every report, keep that off the terminal
+        with redirect_stdout(io.StringIO()):
+            for chunk in stderr_chunks:
+                legacy_parse(chunk.splitlines())
+
+    def run_progress():
+        parser = ProgressParser()
+        for chunk in progress_chunks:
+            parser.feed(chunk)
+
+    for name, function in (("stderr regex", run_legacy), ("-progress", run_progress)):
+        elapsed = min(timeit(function, number=1) for _ in range(5))
+        print(f"{name:>14}: {elapsed / count * 1e6:.2f}µs per progress report")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,60 @@
+"""
+Measures the realtime factor (seconds of input processed per second) of each timelapse
+strategy, on the sample video and on a synthetic 720p H.264 video.
+
+Usage: python -m benchmarks.bench_timelapse [speed-up ...]
+"""
+import subprocess
+import sys
+import time
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Sequence
+
+from video_transformer.core import FFmpegWrapper, Timelapse, ffmpeg_executable
+
+SAMPLE_VIDEO = Path("tests/Whathappenedontwentythirdstreet-thomasedisoninc.ogv.240p.vp9.webm")
+
+
+def synthetic_video(to: Path, size: str = "1280x720", duration: int = 60) -> Path:
+    """Generates a H.264 test video with a keyframe every 2 seconds"""
+    subprocess.run([
+        ffmpeg_executable(), "-nostdin", "-loglevel", "error", "-y",
+        "-f", "lavfi", "-i", f"testsrc2=size={size}:rate=30:duration={duration}",
+        "-c:v", "libx264", "-preset", "ultrafast", "-g", "60", str(to),
+    ], check=True)
+    return to
+
+
+def realtime_factor(wrapper: FFmpegWrapper, to: Path, by: float, timelapse: Timelapse) -> float:
+    """Processes the video, returns the number of input seconds processed per second"""
+    start = time.perf_counter()
+    for _ in wrapper.process(to, by=by, timelapse=timelapse):
+        pass
+    elapsed = time.perf_counter() - start
+    assert wrapper.returncode == 0, f"ffmpeg failed ({wrapper.returncode})"
+    return wrapper.metadata.duration.total_seconds() / elapsed
+
+
+def main(speeds: Sequence[float]):
+    with TemporaryDirectory() as td:
+        videos = [SAMPLE_VIDEO, synthetic_video(Path(td) / "synthetic.mp4")]
+        for video in videos:
+            wrapper = FFmpegWrapper(video)
+            print(f"{video.name} ({wrapper.metadata.resolution}, {wrapper.metadata.codec})")
+            for by in speeds:
+                results = {
+                    timelapse.value: realtime_factor(wrapper, Path(td) / "out.mp4", by, timelapse)
+                    for timelapse in (Timelapse.NONE, Timelapse.DROP, Timelapse.KEYFRAMES)
+                }
+                auto = wrapper.timelapse_strategy(by).value
+                print(f"  {by:>6}x: " + ", ".join(
+                    f"{name}{'*' if name == auto else ''} {factor:.1f}x realtime"
+                    for name, factor in results.items()
+                ))
+        print("* strategy picked by Timelapse.AUTO")
+
+
+if __name__ == '__main__':
+    main([float(arg) for arg in sys.argv[1:]] or [8.0, 32.0, 128.0])
@@ -0,0 +1,166 @@
+"""
+Benchmark suite tracking performance regressions. `run` measures the realtime factor of
+process() per speed-up and format, the probe latency and the progress parsing cost, on the
+sample video and on synthetic videos, and writes the results to a JSON file. `compare` reports
+the results of a run that are worse than a baseline's by more than a threshold.
+
+Usage: python -m benchmarks.suite run [-o results.json] [--quick]
+       python -m benchmarks.suite compare baseline.json results.json [--threshold 0.1]
+"""
+import argparse
+import datetime
+import json
+import platform
+import subprocess
+import sys
+import time
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from timeit import timeit
+from typing import Any, Dict, List, Sequence
+
+from benchmarks.bench_progress import progress_report
+from benchmarks.bench_timelapse import SAMPLE_VIDEO, synthetic_video
+from video_transformer.core import (FFmpegWrapper, Format, Profile,
+                                    ProgressParser, ffmpeg_executable)
+
+#: Synthetic videos, as (resolution, duration in seconds), and their --quick counterparts
+SYNTHETIC_VIDEOS = [("320x240", 60), ("1280x720", 30)]
+QUICK_SYNTHETIC_VIDEOS = [("320x240", 10)]
+
+
+def measurement(value: float, unit: str, higher_is_better: bool) -> Dict[str, Any]:
+    """A result, as stored in the JSON file"""
+    return {"value": value, "unit": unit, "higher_is_better": higher_is_better}
+
+
+def realtime_factor(wrapper: FFmpegWrapper, to: Path, by: float, fmt: Format,
+                    profile: Profile) -> float:
+    """Processes the video, returns the number of input seconds processed per second"""
+    start = time.perf_counter()
+    for _ in wrapper.process(to, by=by, fmt=fmt, profile=profile):
+        pass
+    elapsed = time.perf_counter() - start
+    assert wrapper.returncode == 0, f"ffmpeg failed ({wrapper.returncode})"
+    return wrapper.metadata.duration.total_seconds() / elapsed
+
+
+def probe_latency(video: Path, repeat: int) -> float:
+    """Best time to probe the video's metadata without a cache, in milliseconds"""
+    wrapper = FFmpegWrapper(video)
+    best = min(timeit(wrapper.fetch_video_metadata, number=1) for _ in range(repeat))
+    return best * 1000
+
+
+def parsing_cost(count: int) -> float:
+    """Best time to parse a progress report, in microseconds"""
+    chunks = [progress_report(idx) for idx in range(count)]
+
+    def parse():
+        parser = ProgressParser()
+        for chunk in chunks:
+            parser.feed(chunk)
+    return min(timeit(parse, number=1) for _ in range(5)) / count * 1e6
+
+
+def run(speeds: Sequence[float], formats: Sequence[Format], profile: Profile,
+        quick: bool) -> Dict[str, Dict[str, Any]]:
+    """Runs the whole suite, returns the results by name"""
+    results: Dict[str, Dict[str, Any]] = {}
+    with TemporaryDirectory() as td:
+        videos = [SAMPLE_VIDEO, *(
+            synthetic_video(Path(td) / f"testsrc2-{size}-{duration}s.mp4", size, duration)
+            for size, duration in (QUICK_SYNTHETIC_VIDEOS if quick else SYNTHETIC_VIDEOS)
+        )]
+        for video in videos:
+            name = "sample" if video == SAMPLE_VIDEO else video.stem
+            results[f"probe/{name}"] = measurement(probe_latency(video, 3 if quick else 10),
+                                                   "ms", higher_is_better=False)
+            wrapper = FFmpegWrapper(video)
+            for fmt in formats:
+                for by in speeds:
+                    factor = realtime_factor(wrapper, Path(td) / f"out.{fmt.extension}", by, fmt,
+                                             profile)
+                    key = f"realtime/{name}/{fmt.name.lower()}/x{by:g}"
+                    results[key] = measurement(factor, "x", higher_is_better=True)
+                    print(f"{key}: {factor:.2f}x realtime", file=sys.stderr)
+    results["parse/progress"] = measurement(parsing_cost(10000 if quick else 100000), "µs",
+                                            higher_is_better=False)
+    return results
+
+
+def ffmpeg_version() -> str:
+    """First line of `ffmpeg -version`"""
+    output = subprocess.run([ffmpeg_executable(), "-version"], stdout=subprocess.PIPE,
+                            universal_newlines=True).stdout
+    return output.splitlines()[0] if output else "unknown"
+
+
+def compare(baseline: Dict[str, Dict[str, Any]], current: Dict[str, Dict[str, Any]],
+            threshold: float) -> List[str]:
+    """
+    Prints the results found in both runs with their relative change, returns the names of
+    those that are worse than the baseline by more than `threshold` (a fraction).
+    """
+    regressions: List[str] = []
+    for name in sorted(baseline.keys() & current.keys()):
+        before, after = baseline[name]["value"], current[name]["value"]
+        change = (after - before) / before if before else 0.0
+        # Positive when worse
+        worse = -change if current[name]["higher_is_better"] else change
+        flag = ""
+        if worse > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        unit = current[name]["unit"]
+        print(f"{name:<48} {before:>10.2f}{unit} -> {after:>10.2f}{unit} {change:>+8.1%}{flag}")
+    for name in sorted(baseline.keys() ^ current.keys()):
+        print(f"{name:<48} only in {'the baseline' if name in baseline else 'this run'}")
+    return regressions
+
+
+def main(argv: Sequence[str]) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.suite", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+    run_parser = commands.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("-o", "--output", type=Path, default=Path("benchmark-results.json"))
+    run_parser.add_argument("--speeds", type=float, nargs="+", default=[2.0, 8.0])
+    run_parser.add_argument("--formats", nargs="+", choices=[fmt.name for fmt in Format],
+                            help="default: all the formats available locally")
+    run_parser.add_argument("--profile", choices=[profile.name for profile in Profile],
+                            default=Profile.PREVIEW.name)
+    run_parser.add_argument("--quick", action="store_true",
+                            help="fewer and shorter videos, fewer repetitions")
+    compare_parser = commands.add_parser("compare", help="compare results to a baseline")
+    compare_parser.add_argument("baseline", type=Path)
+    compare_parser.add_argument("current", type=Path)
+    compare_parser.add_argument("--threshold", type=float, default=0.1,
+                                help="relative change flagged as a regression (default: 0.1)")
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        formats = [Format[name] for name in args.formats] if args.formats else Format.available()
+        results = run(args.speeds, formats, Profile[args.profile], args.quick)
+        args.output.write_text(json.dumps({
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "ffmpeg": ffmpeg_version(),
+            "results": results,
+        }, indent=2))
+        print(f"Results written to {args.output}")
+        return 0
+    baseline, current = (json.loads(path.read_text())["results"]
+                         for path in (args.baseline, args.current))
+    regressions = compare(baseline, current, args.threshold)
+    if regressions:
+        print(f"{len(regressions)} regression(s) beyond {args.threshold:.0%}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -19,9 +19,12 @@ setuptools.setup(
     url="https://github.com/etene/video-transformer",
     packages=["video_transformer"],
     install_requires=["PyQt5==5.13.2", "ffmpeg-python==0.2.0"],
+    # Decoding frames into arrays, and previewing videos in the GUI
+    extras_require={"frames": ["numpy"]},
     classifiers=[
         "Programming Language :: Python :: 3.7",
         # TODO
     ],
-    package_data={"video_transformer": ["py.typed"]}
+    package_data={"video_transformer": ["py.typed"]},
+    entry_points={"console_scripts": ["video-transformer=video_transformer.cli:main"]},
 )
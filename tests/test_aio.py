@@ -0,0 +1,89 @@
+import asyncio
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import pytest
+
+from video_transformer.aio import AsyncFFmpegWrapper, run_many
+from video_transformer.core import Speed
+
+SAMPLE_VIDEO = Path("tests/Whathappenedontwentythirdstreet-thomasedisoninc.ogv.240p.vp9.webm")
+
+
+def test_async_process():
+    """process() can be iterated asynchronously and creates a video file"""
+    async def run(output_file: Path):
+        wrapper = await AsyncFFmpegWrapper.open(SAMPLE_VIDEO)
+        statuses = [status async for status in wrapper.process(to=output_file, by=8)]
+        return wrapper, statuses
+
+    with TemporaryDirectory() as td:
+        output_file = Path(td) / "result.mp4"
+        wrapper, statuses = asyncio.run(run(output_file))
+        assert wrapper.returncode == 0
+        assert output_file.exists()
+        assert statuses[-1].done
+        with pytest.raises(RuntimeError):
+            wrapper.stop()
+        assert wrapper.report is not None
+        assert (wrapper.report.returncode, wrapper.report.output_size) == (
+            0, output_file.stat().st_size)
+        assert len(wrapper.report.samples) == len(statuses)
+
+
+def test_async_cancel():
+    """cancelling the task processing a video stops ffmpeg"""
+    wrapper = AsyncFFmpegWrapper(SAMPLE_VIDEO)
+
+    async def consume(output_file: Path, started: asyncio.Event):
+        async for status in wrapper.process(to=output_file):
+            if status.time.total_seconds() > 0:
+                started.set()
+
+    async def run(output_file: Path):
+        started = asyncio.Event()
+        task = asyncio.ensure_future(consume(output_file, started))
+        await started.wait()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    with TemporaryDirectory() as td:
+        output_file = Path(td) / "result.mp4"
+        asyncio.run(run(output_file))
+        assert wrapper.returncode == 255
+        assert not output_file.exists()
+
+
+def test_sync_stop():
+    """the inherited synchronous methods are stopped too"""
+    wrapper = AsyncFFmpegWrapper(SAMPLE_VIDEO)
+    with TemporaryDirectory() as td:
+        output_file = Path(td) / "result.mp4"
+        for _ in wrapper.apply(output_file, [Speed(2)]):
+            wrapper.stop()
+        assert wrapper.returncode == 255
+        assert not output_file.exists()
+    with pytest.raises(RuntimeError):
+        wrapper.stop()
+
+
+def test_run_many():
+    """run_many() runs all the jobs, no more than `limit` at once"""
+    running, max_running = set(), 0
+
+    def on_progress(wrapper, progress):
+        nonlocal max_running
+        if progress.done:
+            running.discard(wrapper)
+        else:
+            running.add(wrapper)
+        max_running = max(max_running, len(running))
+
+    with TemporaryDirectory() as td:
+        jobs = [(AsyncFFmpegWrapper(SAMPLE_VIDEO), {"to": Path(td) / f"{i}.mp4", "by": 16})
+                for i in range(3)]
+        assert asyncio.run(run_many(jobs, limit=2, on_progress=on_progress)) == [0, 0, 0]
+        assert max_running <= 2
+        assert all(options["to"].exists() for _, options in jobs)
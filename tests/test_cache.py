@@ -0,0 +1,148 @@
+import os
+import shutil
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import ffmpeg  # type: ignore
+import pytest
+
+from video_transformer import core
+from video_transformer.cache import MetadataCache, OutputCache
+from video_transformer.core import FFmpegWrapper, Format, Profile, VideoError
+
+SAMPLE_VIDEO = Path("tests/Whathappenedontwentythirdstreet-thomasedisoninc.ogv.240p.vp9.webm")
+
+
+@pytest.fixture
+def cache():
+    with TemporaryDirectory() as td:
+        yield MetadataCache(Path(td) / "cache.sqlite3")
+
+
+def test_metadata_cache(cache, monkeypatch):
+    """cached metadata is reused until the file changes"""
+    with TemporaryDirectory() as td:
+        video = Path(td) / SAMPLE_VIDEO.name
+        shutil.copy(SAMPLE_VIDEO, video)
+        metadata = FFmpegWrapper(video, cache=cache).metadata
+        assert cache.get(video) == metadata
+
+        def no_probe(*args, **kwargs):
+            raise AssertionError("ffprobe should not run")
+        monkeypatch.setattr(ffmpeg, "probe", no_probe)
+        assert FFmpegWrapper(video, cache=cache).metadata == metadata
+
+        # A modified file is not found in the cache
+        stat = video.stat()
+        os.utime(video, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+        assert cache.get(video) is None
+
+
+def test_keyframes_cache(cache, monkeypatch):
+    """keyframes are probed once per file"""
+    keyframes = FFmpegWrapper(SAMPLE_VIDEO, cache=cache).keyframes()
+    assert keyframes and cache.get_keyframes(SAMPLE_VIDEO) == keyframes
+
+    def no_probe(*args, **kwargs):
+        raise AssertionError("ffprobe should not run")
+    monkeypatch.setattr(ffmpeg, "probe", no_probe)
+    assert FFmpegWrapper(SAMPLE_VIDEO, cache=cache).keyframes() == keyframes
+
+
+def test_metadata_cache_eviction(cache):
+    """the least recently used entries are evicted"""
+    cache.max_entries = 2
+    metadata = FFmpegWrapper(SAMPLE_VIDEO).metadata
+    with TemporaryDirectory() as td:
+        videos = [Path(td) / f"{i}.webm" for i in range(3)]
+        for video in videos:
+            video.touch()
+        cache.put(videos[0], metadata)
+        cache.put(videos[1], metadata)
+        assert cache.get(videos[0]) == metadata
+        cache.put(videos[2], metadata)
+        assert len(cache) == 2
+        assert cache.get(videos[1]) is None
+        assert cache.get(videos[0]) == metadata
+
+
+def test_open_in_background(cache):
+    """wrappers can be created without blocking"""
+    future = FFmpegWrapper.open_in_background(SAMPLE_VIDEO, cache=cache)
+    assert future.result(timeout=30).metadata.codec == "vp9"
+    with pytest.raises(VideoError):
+        FFmpegWrapper.open_in_background(Path(__file__), cache=cache).result(timeout=30)
+
+
+@pytest.fixture
+def output_cache():
+    with TemporaryDirectory() as td:
+        yield OutputCache(Path(td) / "outputs")
+
+
+def test_fingerprint(output_cache, monkeypatch):
+    """fingerprints only depend on the size and the ends of the file"""
+    monkeypatch.setattr(OutputCache, "SAMPLE_SIZE", 4)
+    with TemporaryDirectory() as td:
+        video = Path(td) / "video"
+        video.write_bytes(b"head-middle-tail")
+        fingerprint = output_cache.fingerprint(video)
+        video.write_bytes(b"head-MIDDLE-tail")
+        assert output_cache.fingerprint(video) == fingerprint
+        video.write_bytes(b"head-middle-TAIL")
+        assert output_cache.fingerprint(video) != fingerprint
+        video.write_bytes(b"head-middle--tail")
+        assert output_cache.fingerprint(video) != fingerprint
+
+
+def test_output_cache(output_cache, monkeypatch):
+    """processing the same video with the same parameters twice only encodes it once"""
+    wrapper = FFmpegWrapper(SAMPLE_VIDEO, output_cache=output_cache)
+    with TemporaryDirectory() as td:
+        first, second = Path(td) / "first.mp4", Path(td) / "second.mp4"
+        list(wrapper.process(first, by=8, profile=Profile.PREVIEW))
+        assert wrapper.returncode == 0
+        assert len(output_cache) == 1
+
+        def no_encode(*args, **kwargs):
+            raise AssertionError("ffmpeg should not run")
+        monkeypatch.setattr(core, "FFmpegProcess", no_encode)
+        statuses = list(wrapper.process(second, by=8, profile=Profile.PREVIEW))
+        assert wrapper.returncode == 0
+        assert second.read_bytes() == first.read_bytes()
+        assert len(statuses) == 1 and statuses[0].done
+        assert statuses[0].total_size == second.stat().st_size
+        assert statuses[0].time.total_seconds() == pytest.approx(
+            wrapper.metadata.duration.total_seconds() / 8, abs=0.01
+        )
+        # Other parameters are a miss
+        with pytest.raises(AssertionError):
+            list(wrapper.process(second, by=4, profile=Profile.PREVIEW))
+        with pytest.raises(AssertionError):
+            list(wrapper.process(second, by=8, fmt=Format.HEVC, profile=Profile.PREVIEW))
+        # Copies are not cached
+        monkeypatch.undo()
+        list(wrapper.process(Path(td) / "copy.webm", by=1, fmt=Format.WEBM, copy=True))
+        assert wrapper.returncode == 0
+        assert len(output_cache) == 1
+
+
+def test_output_cache_eviction(output_cache):
+    """the least recently used outputs are evicted when the cache is too big"""
+    output_cache.max_size = 10
+    with TemporaryDirectory() as td:
+        outputs = [Path(td) / f"{i}.mp4" for i in range(3)]
+        for output in outputs:
+            output.write_bytes(b"12345")
+        output_cache.put("a", outputs[0])
+        output_cache.put("b", outputs[1])
+        assert output_cache.get("a", Path(td) / "a.mp4")
+        output_cache.put("c", outputs[2])
+        assert len(output_cache) == 2
+        assert output_cache.size == 10
+        assert not output_cache.get("b", Path(td) / "b.mp4")
+        assert output_cache.get("a", Path(td) / "a.mp4")
+        assert (Path(td) / "a.mp4").read_bytes() == b"12345"
+        # Only the index and the cached files are left
+        assert len(list(output_cache.path.iterdir())) == 3
@@ -0,0 +1,103 @@
+import json
+import shutil
+import subprocess
+import sys
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import pytest
+
+from video_transformer.cli import main
+
+SAMPLE_VIDEO = Path("tests/Whathappenedontwentythirdstreet-thomasedisoninc.ogv.240p.vp9.webm")
+
+
+def test_import_time():
+    """the command line interface does not import Qt nor other heavy modules"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import video_transformer.cli"],
+        stderr=subprocess.PIPE, universal_newlines=True, check=True,
+    )
+    # "import time: self [us] | cumulative | imported package" lines
+    imports = {
+        name.strip(): int(cumulative)
+        for _, cumulative, name in (line.split("|") for line in result.stderr.splitlines()[1:])
+    }
+    assert not {"PyQt5", "ffmpeg", "distutils", "sqlite3", "asyncio"} & imports.keys()
+    # Generous bound, it takes a few tens of milliseconds
+    assert imports["video_transformer.cli"] < 500000
+
+
+def test_cli_process(capsys):
+    """videos can be processed from the command line, with JSON progress"""
+    with TemporaryDirectory() as td:
+        output_file = Path(td) / "result.mp4"
+        assert main(["process", str(SAMPLE_VIDEO), "-o", str(output_file), "-s", "16",
+                     "-p", "preview", "--progress", "json", "--no-cache"]) == 0
+        assert output_file.exists()
+        events = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+        assert {event["event"] for event in events[:-1]} == {"progress"}
+        assert events[-1] == {"event": "finished", "input": str(SAMPLE_VIDEO),
+                              "output": str(output_file), "fraction": 1.0,
+                              "returncode": 0, "error": None}
+
+
+def test_cli_errors(capsys):
+    """invalid arguments and failed jobs are reported"""
+    assert main(["process", str(SAMPLE_VIDEO), "missing.webm", "-o", "result.mp4"]) == 2
+    with TemporaryDirectory() as td:
+        assert main(["process", str(Path(td) / "missing.webm"), "-d", td, "--no-cache"]) == 1
+        assert "failed" in capsys.readouterr().err
+
+
+def test_cli_unexpected_error(capsys, monkeypatch):
+    """jobs which raise unexpected errors fail, and are not reported as written"""
+    from video_transformer.core import FFmpegWrapper
+
+    def process(*args, **kwargs):
+        raise KeyError("duration")
+    monkeypatch.setattr(FFmpegWrapper, "process", process)
+    with TemporaryDirectory() as td:
+        assert main(["process", str(SAMPLE_VIDEO), "-d", td, "--no-cache"]) == 1
+        err = capsys.readouterr().err
+        assert "failed ('duration')" in err and "written" not in err
+        assert list(Path(td).iterdir()) == []
+
+
+def test_cli_probe(capsys):
+    """videos can be probed in bulk, with a manifest and a summary"""
+    with TemporaryDirectory() as td:
+        for name in ("a.webm", "b.webm"):
+            shutil.copy(SAMPLE_VIDEO, Path(td) / name)
+        manifest = Path(td) / "manifest.jsonl"
+        assert main(["probe", td, "-m", str(manifest), "-s", "4", "-r", "2", "--json",
+                     "--no-cache"]) == 0
+        summary = json.loads(capsys.readouterr().out)
+        assert (summary["files"], summary["failed"]) == (2, 0)
+        assert summary["output_duration"] == pytest.approx(2 * 49.713 / 4)
+        assert summary["encode_time"] == pytest.approx(49.713)
+        assert len(manifest.read_text().splitlines()) == 2
+
+
+def test_cli_submit(capsys, monkeypatch):
+    """videos can be submitted to a job server, and the jobs followed"""
+    from video_transformer.server import JobServer
+    monkeypatch.setenv("VIDEO_TRANSFORMER_TOKEN", "secret")
+    server = JobServer(("127.0.0.1", 0), token="secret", roots=[Path.cwd()])
+    server.start()
+    try:
+        assert main(["submit", server.url, str(SAMPLE_VIDEO), "-s", "8", "-d", "tests"]) == 0
+        assert capsys.readouterr().out == f"1: {SAMPLE_VIDEO.resolve()}\n"
+        assert main(["status", server.url, "--json"]) == 0
+        job = json.loads(capsys.readouterr().out)[0]
+        assert (job["status"], job["output"]) == (
+            "queued", str(SAMPLE_VIDEO.resolve().with_suffix(".8.0.mp4")))
+        # Outside of the served directories, or with another token
+        with TemporaryDirectory() as td:
+            assert main(["submit", server.url, str(SAMPLE_VIDEO), "-d", td]) == 1
+        assert "not under a directory served" in capsys.readouterr().err
+        assert main(["status", server.url, "--token", "wrong"]) == 1
+        assert "refused the token" in capsys.readouterr().err
+    finally:
+        server.shutdown()
@@ -1,9 +1,23 @@
+import contextlib
+import datetime
+import io
+import json
+import re
+import subprocess
+
 from pathlib import Path
 from tempfile import TemporaryDirectory
 
 import pytest
 
-from video_transformer.core import FFmpegWrapper, VideoError
+from video_transformer import core
+from video_transformer.core import (PROFILES, SPEED_LADDERS, Crop,
+                                    FFmpegWrapper, Format, Fps, Output,
+                                    Profile, Progress, ProgressParser, Scale,
+                                    Speed, Target, Timelapse, Trim, VideoError,
+                                    ffmpeg_executable, output_metadata,
+                                    resume_directory, smart_cut_pieces,
+                                    split_segments)
 
 SAMPLE_VIDEO = Path("tests/Whathappenedontwentythirdstreet-thomasedisoninc.ogv.240p.vp9.webm")
 
@@ -16,6 +30,8 @@ def test_metadata():
     assert md.pixel_format == "yuv420p"
     assert md.duration.total_seconds() == 49.713
     assert md.resolution == (320, 240)
+    assert md.frame_rate == pytest.approx(29.97, abs=0.01)
+    assert md.audio_codec == "opus"
 
 
 def test_process():
@@ -27,14 +43,18 @@ def test_process():
         assert wrapper.returncode == 0
         assert output_file.exists()
         assert len(output_file.read_bytes()) > 0
+        # The temporary files were written next to the output, and removed
+        assert list(Path(td).iterdir()) == [output_file]
         assert len(statuses) > 0
         size, secs = 0, 0
         for s in statuses:
-            new_size = int(s.size[:-2])
+            new_size = s.total_size
             new_secs = s.time.total_seconds()
             assert new_size >= size
             size = new_size
             assert new_secs >= secs
+            secs = new_secs
+        assert statuses[-1].done
 
 
 def test_stop():
@@ -52,11 +72,458 @@ def test_stop():
             if status.time.total_seconds() > 0:
                 # video processing started, stop it
                 wrapper.stop()
+                assert wrapper.stopping
+        assert wrapper.returncode == 255
+        assert not output_file.exists()
+
+
+def test_threads():
+    """the threads limit applies to the decoder and the filters too"""
+    wrapper = FFmpegWrapper(SAMPLE_VIDEO)
+    args = wrapper._encode_args(Path("result.mp4"), 2, Format.MP4, threads=2)
+    assert args[1:4] == ["-threads", "2", "-i"]
+    assert args[args.index("-filter_threads") + 1] == "2"
+    assert "-threads" not in wrapper._encode_args(Path("result.mp4"), 2, Format.MP4)
+    with TemporaryDirectory() as td:
+        output_file = Path(td) / "result.mp4"
+        list(wrapper.process(output_file, by=8, profile=Profile.PREVIEW, threads=1))
+        assert wrapper.returncode == 0
+
+
+def test_process_resumable():
+    """a stopped resumable encode keeps its complete pieces, and only encodes the others"""
+    with TemporaryDirectory() as td:
+        output_file = Path(td) / "result.mp4"
+        wrapper = FFmpegWrapper(SAMPLE_VIDEO)
+        wrapper.CHECKPOINT_INTERVAL = 10
+        for status in wrapper.process(output_file, by=2, profile=Profile.PREVIEW,
+                                      resumable=True):
+            if status.time.total_seconds() > 6:
+                # into the second piece
+                wrapper.stop()
         assert wrapper.returncode == 255
         assert not output_file.exists()
+        journal = json.loads((resume_directory(output_file) / "journal.json").read_text())
+        assert len(journal["params"]["pieces"]) == 5
+        done = len(journal["pieces"])
+        assert 1 <= done < 5
+
+        wrapper = FFmpegWrapper(SAMPLE_VIDEO)
+        wrapper.CHECKPOINT_INTERVAL = 10
+        statuses = list(wrapper.process(output_file, by=2, profile=Profile.PREVIEW,
+                                        resumable=True))
+        assert wrapper.returncode == 0
+        # The pieces were removed with their journal
+        assert list(Path(td).iterdir()) == [output_file]
+        # Only the remaining pieces were encoded
+        resumed_at = journal["params"]["pieces"][done][0] / 2
+        assert statuses[0].time.total_seconds() == pytest.approx(resumed_at, abs=0.1)
+        assert statuses[-1].done and not any(status.done for status in statuses[:-1])
+        duration = FFmpegWrapper(output_file).metadata.duration.total_seconds()
+        assert duration == pytest.approx(wrapper.metadata.duration.total_seconds() / 2, abs=0.5)
+        assert decoding_errors(output_file) == ""
+
+
+def test_process_resumable_stop_between_pieces(monkeypatch):
+    """a stop while no ffmpeg runs, between two pieces, is not lost"""
+    with TemporaryDirectory() as td:
+        output_file = Path(td) / "result.mp4"
+        wrapper = FFmpegWrapper(SAMPLE_VIDEO)
+        wrapper.CHECKPOINT_INTERVAL = 10
+        real_encode_args = wrapper._encode_args
+        pieces = []
+
+        def encode_args(*args, **kwargs):
+            pieces.append(args[0])
+            if len(pieces) == 2:
+                # Like the callers of stop() which run it from another thread
+                with contextlib.suppress(RuntimeError):
+                    wrapper.stop()
+            return real_encode_args(*args, **kwargs)
+        monkeypatch.setattr(wrapper, "_encode_args", encode_args)
+        list(wrapper.process(output_file, by=4, profile=Profile.PREVIEW, resumable=True))
+        assert wrapper.returncode == 255
+        assert len(pieces) == 2
+        journal = json.loads((resume_directory(output_file) / "journal.json").read_text())
+        assert len(journal["pieces"]) == 1
+
+
+def test_process_resumable_fsync(monkeypatch):
+    """the pieces are on the disk before the journal lists them"""
+    synced = []
+    monkeypatch.setattr(core, "fsync_path", synced.append)
+    with TemporaryDirectory() as td:
+        output_file = Path(td) / "result.mp4"
+        wrapper = FFmpegWrapper(SAMPLE_VIDEO)
+        wrapper.CHECKPOINT_INTERVAL = 20
+        list(wrapper.process(output_file, by=8, profile=Profile.PREVIEW, resumable=True))
+        assert wrapper.returncode == 0
+        directory = resume_directory(output_file).resolve()
+        assert [path.name for path in synced] == [
+            "piece0000.part.mp4", directory.name, "piece0001.part.mp4", directory.name,
+            "piece0002.part.mp4", directory.name,
+        ]
+
+
+def test_process_resumable_other_encode():
+    """the pieces of an encode with other parameters are not reused"""
+    with TemporaryDirectory() as td:
+        output_file = Path(td) / "result.mp4"
+        wrapper = FFmpegWrapper(SAMPLE_VIDEO)
+        wrapper.CHECKPOINT_INTERVAL = 10
+        for status in wrapper.process(output_file, by=4, profile=Profile.PREVIEW,
+                                      resumable=True):
+            if status.time.total_seconds() > 3:
+                wrapper.stop()
+        assert wrapper.returncode == 255
+        statuses = list(wrapper.process(output_file, by=2, profile=Profile.PREVIEW,
+                                        resumable=True))
+        assert wrapper.returncode == 0
+        assert statuses[0].time.total_seconds() < 5
+        duration = FFmpegWrapper(output_file).metadata.duration.total_seconds()
+        assert duration == pytest.approx(wrapper.metadata.duration.total_seconds() / 2, abs=0.5)
 
 
 def test_invalid_video():
     with pytest.raises(VideoError) as err:
         FFmpegWrapper(Path(__file__))
     assert str(err.value).endswith("Invalid data found when processing input")
+
+
+def test_process_parallel():
+    """process() in parallel mode joins its segments into a video of the expected duration"""
+    wrapper = FFmpegWrapper(SAMPLE_VIDEO)
+    assert len(wrapper.keyframes()) > 1
+    by = 2.0
+    with TemporaryDirectory() as td:
+        output_file = Path(td) / "result.mp4"
+        statuses = list(wrapper.process(to=output_file, by=by, jobs=3))
+        assert wrapper.returncode == 0
+        assert wrapper.workers == []
+        assert len(statuses) > 0
+        duration = FFmpegWrapper(output_file).metadata.duration.total_seconds()
+        expected = wrapper.metadata.duration.total_seconds() / by
+        assert duration == pytest.approx(expected, abs=0.5)
+
+
+def test_split_segments():
+    """segments start on the keyframes closest to even split points"""
+    keyframes = [0.0, 1.0, 9.0, 17.0, 25.0, 33.0, 41.0, 49.0]
+    assert split_segments(keyframes, 50.0, 1) == [(0.0, None)]
+    assert split_segments(keyframes, 50.0, 2) == [(0.0, 25.0), (25.0, None)]
+    assert split_segments(keyframes, 50.0, 3) == [(0.0, 17.0), (17.0, 33.0), (33.0, None)]
+    # Cannot split more than there are keyframes
+    assert len(split_segments(keyframes, 50.0, 20)) <= len(keyframes)
+
+
+def test_progress_parser():
+    """progress blocks are parsed incrementally, whatever the chunk boundaries"""
+    output = (b"frame=0\nfps=0.00\nstream_0_0_q=0.0\nbitrate=N/A\ntotal_size=0\n"
+              b"out_time_us=-9223372036854775807\nout_time=-577014:32:22.775807\n"
+              b"dup_frames=0\ndrop_frames=0\nspeed=N/A\nprogress=continue\n"
+              b"frame=90\nfps=12.50\nbitrate= 881.0kbits/s\ntotal_size=327369\n"
+              b"out_time_us=2972833\ndup_frames=1\ndrop_frames=86\nspeed=6.38x\n"
+              b"progress=end\n")
+    expected = [
+        Progress(),
+        Progress(frame=90, fps=12.5, bitrate=881.0, total_size=327369, out_time_us=2972833,
+                 dup_frames=1, drop_frames=86, speed=6.38, done=True),
+    ]
+    assert ProgressParser().feed(output) == expected
+    parser = ProgressParser()
+    records = [record for i in range(0, len(output), 7) for record in parser.feed(output[i:i + 7])]
+    assert records == expected
+    assert records[1].time.total_seconds() == 2.972833
+    # Blocks with unexpected keys or ordering are still parsed
+    assert ProgressParser().feed(b"total_size=12\nframe=3\nprogress=continue\n") == [
+        Progress(frame=3, total_size=12),
+    ]
+
+
+def test_timelapse_strategy():
+    """the timelapse strategy depends on the speed-up and the interval between keyframes"""
+    wrapper = FFmpegWrapper(SAMPLE_VIDEO)
+    assert wrapper.timelapse_strategy(2) is Timelapse.NONE
+    assert wrapper.timelapse_strategy(8) is Timelapse.DROP
+    # The sample has a keyframe every ~8 seconds
+    assert wrapper.timelapse_strategy(300) is Timelapse.KEYFRAMES
+
+
+@pytest.mark.parametrize("timelapse", [Timelapse.DROP, Timelapse.KEYFRAMES])
+def test_process_timelapse(timelapse):
+    """timelapse strategies produce a video of the expected duration"""
+    wrapper = FFmpegWrapper(SAMPLE_VIDEO)
+    by = 16.0
+    with TemporaryDirectory() as td:
+        output_file = Path(td) / "result.mp4"
+        list(wrapper.process(to=output_file, by=by, timelapse=timelapse))
+        assert wrapper.returncode == 0
+        duration = FFmpegWrapper(output_file).metadata.duration.total_seconds()
+        assert duration == pytest.approx(wrapper.metadata.duration.total_seconds() / by, abs=0.5)
+
+
+def test_profiles():
+    """every format has options for every profile"""
+    assert set(PROFILES) == set(Format)
+    assert all(set(profiles) == set(Profile) for profiles in PROFILES.values())
+    assert set(FFmpegWrapper.FORMATS.values()) == {fmt.value for fmt in Format}
+    assert Format.MP4 in Format.available()
+
+
+@pytest.mark.parametrize("fmt", Format.available())
+def test_process_formats(fmt):
+    """every format the local ffmpeg supports can be encoded"""
+    codecs = {Format.MP4: "h264", Format.HEVC: "hevc", Format.WEBM: "vp9", Format.AV1: "av1"}
+    wrapper = FFmpegWrapper(SAMPLE_VIDEO)
+    with TemporaryDirectory() as td:
+        output_file = Path(td) / f"result.{fmt.extension}"
+        list(wrapper.process(to=output_file, by=8, fmt=fmt, profile=Profile.PREVIEW))
+        assert wrapper.returncode == 0
+        assert FFmpegWrapper(output_file).metadata.codec == codecs[fmt]
+
+
+def test_target():
+    """targets are converted to a required realtime factor"""
+    duration = datetime.timedelta(minutes=30)
+    assert Target(min_speed=3).input_rate(duration) == 3
+    assert Target(deadline=datetime.timedelta(minutes=10)).input_rate(duration) == 3
+    assert Target(deadline=datetime.timedelta(minutes=10), min_speed=4).input_rate(duration) == 4
+
+
+def test_tune(monkeypatch):
+    """tuning picks the slowest settings meeting the target, not slower than the profile"""
+    wrapper = FFmpegWrapper(SAMPLE_VIDEO)
+    wrapper.CALIBRATION_WINDOW = 2.0
+    # Unreachable target: fastest settings
+    assert wrapper.tune(Target(min_speed=1e6), by=8) == SPEED_LADDERS[Format.MP4][0]
+    # Any speed will do: the profile's settings
+    assert wrapper.tune(Target(min_speed=1e-6), by=8, profile=Profile.FAST) == {
+        "preset": PROFILES[Format.MP4][Profile.FAST]["preset"]
+    }
+    with TemporaryDirectory() as td:
+        output_file = Path(td) / "result.mp4"
+        list(wrapper.process(to=output_file, by=8, target=Target(min_speed=1e6)))
+        assert wrapper.returncode == 0
+        assert output_file.exists()
+
+        # Stopped between the calibration and the encode
+        def tune_then_stop(*args, **kwargs):
+            tuned = FFmpegWrapper.tune(wrapper, *args, **kwargs)
+            wrapper.stop()
+            return tuned
+        monkeypatch.setattr(wrapper, "tune", tune_then_stop)
+        output_file.unlink()
+        assert list(wrapper.process(to=output_file, by=8, target=Target(min_speed=1e6))) == []
+        assert wrapper.returncode == 255
+        assert not output_file.exists()
+
+
+def test_process_many():
+    """process_many() writes every output from a single decode, each one on its own"""
+    wrapper = FFmpegWrapper(SAMPLE_VIDEO)
+    duration = wrapper.metadata.duration.total_seconds()
+    with TemporaryDirectory() as td:
+        outputs = [
+            Output(Path(td) / "x2.mp4", by=2, profile=Profile.PREVIEW),
+            Output(Path(td) / "x8.webm", by=8, fmt=Format.WEBM, profile=Profile.PREVIEW,
+                   resolution=(160, -2)),
+            # Cannot be moved to its destination
+            Output(Path(td) / "missing" / "x4.mp4", by=4, profile=Profile.PREVIEW),
+        ]
+        events = list(wrapper.process_many(outputs))
+        assert wrapper.returncode == 0
+        assert [output.written for output in outputs] == [True, True, False]
+        assert outputs[2].error
+        for output in outputs[:2]:
+            output_duration = FFmpegWrapper(output.to).metadata.duration.total_seconds()
+            assert output_duration == pytest.approx(duration / output.by, abs=0.5)
+            last = [progress for out, progress in events if out is output][-1]
+            assert last.done
+            assert last.time.total_seconds() == pytest.approx(duration / output.by, abs=0.5)
+            assert last.total_size == output.to.stat().st_size
+        assert FFmpegWrapper(outputs[1].to).metadata.resolution == (160, 120)
+
+
+def test_stream():
+    """stream() writes a fragmented output to files and file-like objects"""
+    wrapper = FFmpegWrapper(SAMPLE_VIDEO)
+    with TemporaryDirectory() as td:
+        output_file = Path(td) / "result.mp4"
+        with output_file.open("wb") as out:
+            statuses = list(wrapper.stream(out, by=8, profile=Profile.PREVIEW))
+        assert wrapper.returncode == 0
+        assert statuses[-1].done
+        # Fragmented mp4
+        assert b"moof" in output_file.read_bytes()
+        metadata = FFmpegWrapper(output_file).metadata
+        assert metadata.codec == "h264"
+        assert metadata.duration.total_seconds() == pytest.approx(
+            wrapper.metadata.duration.total_seconds() / 8, abs=0.5
+        )
+    buffer = io.BytesIO()
+    list(wrapper.stream(buffer, by=8, fmt=Format.WEBM, profile=Profile.PREVIEW, matroska=True))
+    assert wrapper.returncode == 0
+    # EBML header
+    assert buffer.getvalue().startswith(b"\x1a\x45\xdf\xa3")
+    assert b"matroska" in buffer.getvalue()[:64]
+
+
+def test_output_metadata():
+    """the metadata of a video is changed by operations like ffmpeg changes the video"""
+    metadata = FFmpegWrapper(SAMPLE_VIDEO).metadata
+    assert output_metadata(metadata, []) == metadata
+    result = output_metadata(metadata, [Trim(10, 40), Speed(2), Scale(-2, 120), Fps(10)])
+    assert result.duration == datetime.timedelta(seconds=15)
+    assert result.resolution == (160, 120)
+    assert result.frame_rate == 10
+    assert output_metadata(metadata, [Trim(40)]).duration.total_seconds() == pytest.approx(9.713)
+    assert output_metadata(metadata, [Crop(100, 50), Scale(-1, 99)]).resolution == (198, 99)
+    assert output_metadata(metadata, [Scale(0, 480)]).resolution == (320, 480)
+
+
+def test_speed_audio():
+    """audio tempo changes are chained within the range of the atempo filter"""
+    import ffmpeg  # type: ignore
+    for by, tempos in ((8, [2, 2, 2]), (3, [2, 1.5]), (0.2, [0.5, 0.5, 0.8]), (1, [])):
+        stream = Speed(by).audio(ffmpeg.input("in.webm").audio)
+        args = " ".join(stream.output("out.mp4").get_args())
+        assert list(map(float, re.findall(r"atempo=([\d.]+)", args))) == pytest.approx(tempos)
+
+
+def test_apply():
+    """operations are applied in a single pass, the result matches the predicted metadata"""
+    wrapper = FFmpegWrapper(SAMPLE_VIDEO)
+    operations = [Trim(5, 35), Crop(240, 180), Scale(-2, 120), Fps(15), Speed(4)]
+    expected = wrapper.output_metadata(operations)
+    with TemporaryDirectory() as td:
+        output_file = Path(td) / "result.mp4"
+        statuses = list(wrapper.apply(output_file, operations, profile=Profile.PREVIEW))
+        assert wrapper.returncode == 0
+        assert statuses[-1].done
+        result = FFmpegWrapper(output_file).metadata
+        assert result.resolution == expected.resolution == (160, 120)
+        assert result.frame_rate == pytest.approx(expected.frame_rate)
+        assert result.duration.total_seconds() == pytest.approx(
+            expected.duration.total_seconds(), abs=0.2
+        )
+        assert result.audio_codec == "aac"
+        list(wrapper.apply(output_file, operations, profile=Profile.PREVIEW, audio=False))
+        assert FFmpegWrapper(output_file).metadata.audio_codec is None
+
+
+def test_smart_cut_pieces():
+    """whole groups of pictures are copied, partial ones at the edit points are re-encoded"""
+    keyframes = [0.0, 8.0, 16.0, 24.0, 32.0]
+    assert smart_cut_pieces(keyframes, 5, 30) == [(5, 8.0, False), (8.0, 24.0, True),
+                                                  (24.0, 30, False)]
+    assert smart_cut_pieces(keyframes, 8.0005, 24) == [(8.0, 24, True)]
+    assert smart_cut_pieces(keyframes, 16, None) == [(16.0, None, True)]
+    assert smart_cut_pieces(keyframes, 10, None) == [(10, 16.0, False), (16.0, None, True)]
+    # No whole group of pictures
+    assert smart_cut_pieces(keyframes, 9, 15) == [(9, 15, False)]
+    assert smart_cut_pieces(keyframes, 33, None) == [(33, None, False)]
+
+
+def frame_times(video: Path) -> list:
+    """Timestamps of the decoded video frames, in seconds"""
+    result = subprocess.run(
+        ["ffprobe", "-v", "error", "-select_streams", "v", "-show_entries", "frame=pts_time",
+         "-of", "csv=p=0", str(video)], stdout=subprocess.PIPE, universal_newlines=True,
+        check=True,
+    )
+    return [float(line.strip(",")) for line in result.stdout.split()]
+
+
+def decoding_errors(video: Path) -> str:
+    """What ffmpeg complains about when decoding a video"""
+    return subprocess.run([ffmpeg_executable(), "-v", "warning", "-i", str(video), "-f", "null",
+                           "-"], stderr=subprocess.PIPE, universal_newlines=True).stderr
+
+
+def test_trim():
+    """trim() copies the whole groups of pictures and re-encodes the edges"""
+    wrapper = FFmpegWrapper(SAMPLE_VIDEO)
+    with TemporaryDirectory() as td:
+        output_file = Path(td) / "result.webm"
+        statuses = list(wrapper.trim(output_file, 5, 30, profile=Profile.PREVIEW))
+        assert wrapper.returncode == 0
+        assert statuses[-1].done and not any(status.done for status in statuses[:-1])
+        assert list(Path(td).iterdir()) == [output_file]
+        result = FFmpegWrapper(output_file).metadata
+        assert (result.codec, result.audio_codec) == ("vp9", "opus")
+        assert result.duration.total_seconds() == pytest.approx(25, abs=0.1)
+        # No frame is lost nor repeated where the pieces were joined
+        times = frame_times(output_file)
+        assert len(times) == pytest.approx(25 * wrapper.metadata.frame_rate, abs=1)
+        assert all(0 < b - a < 0.05 for a, b in zip(times, times[1:]))
+        assert decoding_errors(output_file) == ""
+
+
+def test_trim_reordered_frames():
+    """copied pieces end right before the next keyframe even when frames are reordered"""
+    with TemporaryDirectory() as td:
+        source, output_file = Path(td) / "source.mp4", Path(td) / "result.mp4"
+        subprocess.run([ffmpeg_executable(), "-v", "error", "-f", "lavfi", "-i",
+                        "testsrc=size=160x120:rate=25:duration=6", "-c:v", "libx264",
+                        "-preset", "ultrafast", "-bf", "2", "-g", "25", str(source)], check=True)
+        wrapper = FFmpegWrapper(source)
+        list(wrapper.trim(output_file, 1.5, 4.3, profile=Profile.PREVIEW))
+        assert wrapper.returncode == 0
+        assert FFmpegWrapper(output_file).metadata.codec == "h264"
+        times = frame_times(output_file)
+        assert len(times) == pytest.approx(2.8 * 25, abs=1)
+        assert all(0 < b - a < 0.05 for a, b in zip(times, times[1:]))
+        assert decoding_errors(output_file) == ""
+
+
+def test_remux(monkeypatch):
+    """the video is copied instead of being encoded again when asked to and nothing changes"""
+    wrapper = FFmpegWrapper(SAMPLE_VIDEO)
+
+    def no_encode(*args, **kwargs):
+        raise AssertionError("the video should not be encoded")
+    monkeypatch.setattr(wrapper, "_encode_args", no_encode)
+    with TemporaryDirectory() as td:
+        output_file = Path(td) / "result.webm"
+        statuses = list(wrapper.process(output_file, by=1, fmt=Format.WEBM, copy=True))
+        assert wrapper.returncode == 0
+        assert statuses[-1].done
+        result = FFmpegWrapper(output_file).metadata
+        assert (result.codec, result.audio_codec) == ("vp9", "opus")
+        assert result.duration == pytest.approx(wrapper.metadata.duration,
+                                                abs=datetime.timedelta(seconds=0.1))
+        # Otherwise the profile is applied
+        with pytest.raises(AssertionError):
+            list(wrapper.process(output_file, by=1, fmt=Format.WEBM, profile=Profile.PREVIEW))
+
+
+def test_frames():
+    """frames are decoded into a ring of preallocated arrays"""
+    numpy = pytest.importorskip("numpy")
+    wrapper = FFmpegWrapper(SAMPLE_VIDEO)
+    operations = [Trim(10, 12), Scale(80, -2), Fps(5)]
+    frames = [frame.copy() for frame in wrapper.frames(operations)]
+    assert wrapper.returncode == 0
+    assert len(frames) == 10
+    assert frames[0].shape == (60, 80, 3) and frames[0].dtype == numpy.uint8
+    # Same pixels as ffmpeg writes
+    expected = subprocess.run(
+        [ffmpeg_executable(), "-v", "error", "-ss", "10", "-t", "2", "-i", str(SAMPLE_VIDEO),
+         "-vf", "scale=80:-2,fps=5", "-f", "rawvideo", "-pix_fmt", "rgb24", "-"],
+        stdout=subprocess.PIPE, check=True,
+    ).stdout
+    assert b"".join(frame.tobytes() for frame in frames) == expected
+    # The buffers are reused
+    assert len({id(frame) for frame in wrapper.frames(operations, buffers=3)}) == 3
+
+
+def test_frames_stopped():
+    """ffmpeg is stopped when the frames are not wanted anymore"""
+    pytest.importorskip("numpy")
+    wrapper = FFmpegWrapper(SAMPLE_VIDEO)
+    frames = wrapper.frames([Scale(64, -2)], keyframes=True)
+    next(frames)
+    assert wrapper.ffmpeg is not None
+    frames.close()
+    assert wrapper.ffmpeg is None
+    assert wrapper.returncode != 0
@@ -0,0 +1,87 @@
+import os
+import threading
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from video_transformer.core import FFmpegWrapper, Job, JobQueue
+
+SAMPLE_VIDEO = Path("tests/Whathappenedontwentythirdstreet-thomasedisoninc.ogv.240p.vp9.webm")
+
+
+def test_job_queue():
+    """all the queued jobs are processed, invalid ones are reported"""
+    with TemporaryDirectory() as td:
+        jobs = [Job(SAMPLE_VIDEO, Path(td) / f"{i}.mp4", speed=16) for i in range(3)]
+        invalid = Job(Path(__file__), Path(td) / "invalid.mp4")
+        queue = JobQueue([*jobs[:2], invalid], workers=2)
+        queue.submit(jobs[2])
+        assert queue.progress == 0
+        events = list(queue.run())
+        assert {id(job) for job, _ in events} == {id(job) for job in jobs}
+        assert all(job.returncode == 0 and job.output_file.exists() for job in jobs)
+        assert invalid.error and not invalid.output_file.exists()
+        assert queue.returncode == 1
+        assert queue.progress == 1
+
+
+def test_job_queue_threads():
+    """workers share the CPUs"""
+    queue = JobQueue(workers=2)
+    assert queue.workers == 2
+    assert queue.threads * queue.workers <= max(2, os.cpu_count() or 1)
+    assert JobQueue().workers >= 1
+
+
+def test_job_queue_stop():
+    """stopping the queue stops the running jobs and skips the pending ones"""
+    with TemporaryDirectory() as td:
+        jobs = [Job(SAMPLE_VIDEO, Path(td) / f"{i}.mp4") for i in range(3)]
+        queue = JobQueue(jobs, workers=1)
+        for job, progress in queue.run():
+            if progress.time.total_seconds() > 0:
+                queue.stop()
+        assert queue.returncode == 255
+        assert jobs[0].returncode == 255
+        assert jobs[1].returncode is None and jobs[2].returncode is None
+        assert not any(job.output_file.exists() for job in jobs)
+
+
+def test_job_queue_exception(monkeypatch):
+    """an unexpected error fails its job only, the worker processes the next ones"""
+    real_process = FFmpegWrapper.process
+
+    def process(self, to, *args, **kwargs):
+        if to.name == "0.mp4":
+            raise KeyError("duration")
+        return real_process(self, to, *args, **kwargs)
+    monkeypatch.setattr(FFmpegWrapper, "process", process)
+    with TemporaryDirectory() as td:
+        jobs = [Job(SAMPLE_VIDEO, Path(td) / f"{i}.mp4", speed=16) for i in range(2)]
+        queue = JobQueue(jobs, workers=1)
+        list(queue.run())
+        assert jobs[0].error == "'duration'" and jobs[0].returncode is None
+        assert jobs[1].returncode == 0 and jobs[1].output_file.exists()
+        assert queue.returncode == 1
+
+
+def test_job_queue_unfinished():
+    """jobs which did not finish are failures"""
+    queue = JobQueue([Job(SAMPLE_VIDEO, Path("0.mp4"))])
+    assert queue.returncode == 1
+
+
+def test_job_queue_interrupted():
+    """leaving the iteration stops the jobs, and waits for the workers"""
+    with TemporaryDirectory() as td:
+        jobs = [Job(SAMPLE_VIDEO, Path(td) / f"{i}.mp4") for i in range(2)]
+        queue = JobQueue(jobs, workers=2)
+        events = queue.run()
+        for job, progress in events:
+            if progress.time.total_seconds() > 0:
+                break
+        threads = threading.active_count()
+        events.close()
+        assert threading.active_count() == threads - 2
+        assert queue.returncode == 255
+        assert not any(job.output_file.exists() for job in jobs)
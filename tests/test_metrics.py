@@ -0,0 +1,87 @@
+import json
+import os
+import time
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import pytest
+
+from video_transformer.core import (FFmpegProcess, FFmpegWrapper, Job,
+                                    JobQueue, Profile)
+from video_transformer.metrics import prometheus_text
+
+SAMPLE_VIDEO = Path("tests/Whathappenedontwentythirdstreet-thomasedisoninc.ogv.240p.vp9.webm")
+
+
+def test_report():
+    """process() reports the resources it used"""
+    wrapper = FFmpegWrapper(SAMPLE_VIDEO)
+    with TemporaryDirectory() as td:
+        output_file = Path(td) / "result.mp4"
+        statuses = list(wrapper.process(output_file, by=8, profile=Profile.PREVIEW))
+        report = wrapper.report
+        assert report is not None
+        assert report.returncode == 0
+        assert report.input_size == SAMPLE_VIDEO.stat().st_size
+        assert report.output_size == output_file.stat().st_size
+        assert report.compression_ratio == pytest.approx(report.input_size / report.output_size)
+        assert report.wall_time > 0
+        assert report.user_time + report.system_time > 0
+        assert report.max_rss > 1 << 20
+        assert len(report.samples) == len(statuses)
+        assert report.samples[-1].position == statuses[-1].time.total_seconds()
+        assert json.loads(json.dumps(report.as_dict()))["realtime_factor"] > 0
+        # Only process() is reported
+        list(wrapper.trim(Path(td) / "trimmed.webm", 1.0, 2.0))
+        assert wrapper.returncode == 0 and wrapper.report is None
+
+
+def test_report_stopped():
+    """the resources used by ffmpeg are reported when it is stopped too"""
+    wrapper = FFmpegWrapper(SAMPLE_VIDEO)
+    with TemporaryDirectory() as td:
+        for _ in wrapper.process(Path(td) / "result.mp4", by=2, profile=Profile.PREVIEW):
+            wrapper.stop()
+        assert wrapper.returncode == 255
+        assert wrapper.report is not None
+        assert wrapper.report.user_time + wrapper.report.system_time > 0
+        assert wrapper.report.max_rss > 1 << 20
+
+
+def test_process_running():
+    """checking whether ffmpeg runs does not reap it, poll() still does"""
+    process = FFmpegProcess(["true"])
+    try:
+        deadline = time.monotonic() + 10
+        while process.running:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+        assert process.returncode is None
+        assert process.poll() == 0
+        assert not process.running
+    finally:
+        os.close(process.progress_fd)
+        process.stderr.close()
+
+
+def test_report_export():
+    """the job queue exports the reports as JSON lines and Prometheus metrics"""
+    with TemporaryDirectory() as td:
+        report_file, metrics_file = Path(td) / "reports.jsonl", Path(td) / "metrics.prom"
+        jobs = [Job(SAMPLE_VIDEO, Path(td) / f"{i}\".mp4", speed=16, profile=Profile.PREVIEW)
+                for i in range(2)]
+        queue = JobQueue(jobs, workers=1, report_file=report_file, metrics_file=metrics_file)
+        list(queue.run())
+        lines = [json.loads(line) for line in report_file.read_text().splitlines()]
+        assert [line["output_file"] for line in lines] == [str(job.output_file) for job in jobs]
+        assert all(line["output_size"] == job.output_file.stat().st_size
+                   for line, job in zip(lines, jobs))
+        metrics = metrics_file.read_text()
+        assert metrics == prometheus_text(job.report for job in jobs)
+        # Quotes are escaped in labels
+        assert f'output="{td}/0\\".mp4"' in metrics
+        samples = [line for line in metrics.splitlines()
+                   if line.startswith("video_transformer_job_wall_seconds{")]
+        assert len(samples) == 2
+        assert not list(Path(td).glob(".*.tmp"))
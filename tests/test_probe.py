@@ -0,0 +1,82 @@
+import shutil
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import ffmpeg  # type: ignore
+import pytest
+
+from video_transformer.core import FFmpegWrapper
+from video_transformer.probe import (ProbeSummary, find_videos, probe_many,
+                                     read_manifest, write_manifest)
+
+SAMPLE_VIDEO = Path("tests/Whathappenedontwentythirdstreet-thomasedisoninc.ogv.240p.vp9.webm")
+
+
+@pytest.fixture
+def videos():
+    """A directory tree with two videos, an invalid one and another file"""
+    with TemporaryDirectory() as td:
+        root = Path(td)
+        (root / "sub").mkdir()
+        shutil.copy(SAMPLE_VIDEO, root / "a.webm")
+        shutil.copy(SAMPLE_VIDEO, root / "sub" / "b.MKV")
+        (root / "sub" / "invalid.mp4").write_text("not a video")
+        (root / "notes.txt").write_text("not a video either")
+        yield root
+
+
+def test_find_videos(videos):
+    """videos are found by extension in the whole tree, in a stable order"""
+    assert list(find_videos(videos)) == [videos / "a.webm", videos / "sub" / "b.MKV",
+                                         videos / "sub" / "invalid.mp4"]
+
+
+def test_probe_many(videos):
+    """all the videos are probed, failures are reported instead of raised"""
+    paths = [*find_videos(videos), videos / "missing.webm"]
+    results = list(probe_many(paths, workers=2))
+    assert [result.path for result in results] == paths
+    metadata = FFmpegWrapper(SAMPLE_VIDEO).metadata
+    assert [result.metadata for result in results[:2]] == [metadata, metadata]
+    assert results[2].metadata is None
+    assert results[2].error.endswith("Invalid data found when processing input")
+    assert results[3].metadata is None and "missing.webm" in results[3].error
+    summary = ProbeSummary.of(results)
+    assert (summary.files, summary.failed, summary.codecs) == (4, 2, {"vp9": 2})
+    assert summary.total_duration == pytest.approx(2 * 49.713)
+    assert summary.output_duration(4) == pytest.approx(49.713 / 2)
+    assert summary.encode_time(2) == pytest.approx(49.713)
+
+
+def test_probe_many_no_duration(videos):
+    """files without the expected metadata, such as raw streams without a duration, fail"""
+    raw = videos / "raw.h264"
+    ffmpeg.input("testsrc=size=64x48:rate=10", f="lavfi", t=1).output(
+        str(raw), vcodec="libx264", f="h264"
+    ).run(quiet=True)
+    audio = videos / "audio.webm"
+    ffmpeg.input("sine", f="lavfi", t=1).output(str(audio)).run(quiet=True)
+    results = list(probe_many([raw, audio, videos / "a.webm"], workers=1))
+    assert results[0].metadata is None
+    assert results[0].error == f"No duration found in {raw}"
+    assert results[1].error == f"No video streams found in {audio}"
+    assert results[2].metadata is not None
+
+
+@pytest.mark.parametrize("extension", [".jsonl", ".csv"])
+def test_manifest(videos, extension, monkeypatch):
+    """manifests hold the results, which are reused until the files change"""
+    manifest = videos / f"manifest{extension}"
+    results = write_manifest(probe_many(find_videos(videos)), manifest)
+    known = read_manifest(manifest)
+    assert list(known.values()) == results
+
+    def no_probe(*args, **kwargs):
+        raise AssertionError("ffprobe should not run")
+    monkeypatch.setattr(ffmpeg, "probe", no_probe)
+    assert list(probe_many(find_videos(videos), known=known)) == results
+    # A changed file is probed again
+    (videos / "sub" / "invalid.mp4").write_text("still not a video")
+    with pytest.raises(AssertionError):
+        list(probe_many(find_videos(videos), known=known))
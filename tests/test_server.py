@@ -0,0 +1,257 @@
+import http.client
+import socket
+import time
+import urllib.error
+import urllib.request
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from threading import Event, Thread
+
+import ffmpeg  # type: ignore
+import pytest
+
+from video_transformer import server as server_module
+from video_transformer.core import FFmpegWrapper, Job, Profile, VideoError
+from video_transformer.server import (AuthenticationError, JobRequestHandler,
+                                      JobServer, Worker, request, status,
+                                      submit)
+
+SAMPLE_VIDEO = Path("tests/Whathappenedontwentythirdstreet-thomasedisoninc.ogv.240p.vp9.webm")
+TOKEN = "secret"
+
+
+@pytest.fixture
+def root():
+    """Directory served by the job server"""
+    with TemporaryDirectory() as td:
+        yield Path(td).resolve()
+
+
+@pytest.fixture
+def clips(root):
+    """Three short copies of the sample video"""
+    paths = [root / f"clip{idx}.webm" for idx in range(3)]
+    for path in paths:
+        ffmpeg.input(str(SAMPLE_VIDEO), t=2).output(str(path), c="copy").run(quiet=True)
+    return paths
+
+
+@pytest.fixture
+def server(root):
+    server = JobServer(("127.0.0.1", 0), token=TOKEN, roots=[root], lease_timeout=5.0)
+    server.start()
+    yield server
+    server.shutdown()
+
+
+def jobs_for(clips, output_dir: Path):
+    return [Job(clip, output_dir / f"{clip.stem}.mp4", speed=4, profile=Profile.PREVIEW)
+            for clip in clips]
+
+
+def run_workers(workers):
+    """Runs workers until there are no jobs left"""
+    threads = [Thread(target=worker.run, args=(True,)) for worker in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def check_outputs(jobs):
+    for job in jobs:
+        duration = FFmpegWrapper(job.output_file).metadata.duration.total_seconds()
+        assert duration == pytest.approx(2 / 4, abs=0.1)
+
+
+def test_workers(server, root, clips):
+    """jobs are shared between several workers, which report their progress"""
+    jobs = jobs_for(clips, root)
+    assert submit(server.url, TOKEN, jobs) == [1, 2, 3]
+    workers = [Worker(server.url, TOKEN, name=f"worker{idx}", threads=1) for idx in range(2)]
+    run_workers(workers)
+    check_outputs(jobs)
+    assert sum(worker.processed for worker in workers) == 3
+    states = status(server.url, TOKEN)
+    assert [state["status"] for state in states] == ["done"] * 3
+    assert all(state["fraction"] == 1.0 and state["progress"]["done"] for state in states)
+    assert {state["worker"] for state in states} <= {"worker0", "worker1"}
+
+
+def test_upload(server, root, clips):
+    """workers without shared storage download the inputs and upload the outputs"""
+    jobs = jobs_for(clips[:1], root / "sub")
+    submit(server.url, TOKEN, jobs)
+    run_workers([Worker(server.url, TOKEN, shared=False)])
+    check_outputs(jobs)
+    assert [path.name for path in (root / "sub").iterdir()] == ["clip0.mp4"]
+
+
+def test_lease_timeout(root, clips):
+    """the jobs of dead workers are queued again, their late reports are refused"""
+    server = JobServer(("127.0.0.1", 0), token=TOKEN, roots=[root], lease_timeout=0.5,
+                       max_attempts=2)
+    server.start()
+    try:
+        jobs = jobs_for(clips[:2], root)
+        submit(server.url, TOKEN, jobs)
+        # A worker leases the first job then dies
+        code, leased = request(f"{server.url}/leases", TOKEN, "POST", {"worker": "dead"})
+        assert code == 200 and leased["id"] == 1
+        time.sleep(0.6)
+        run_workers([Worker(server.url, TOKEN)])
+        check_outputs(jobs)
+        code, _ = request(f"{server.url}/jobs/1/finish", TOKEN, "POST",
+                          {"lease": leased["lease"], "returncode": 0})
+        assert code == 409
+        states = status(server.url, TOKEN)
+        attempts = [(state["status"], state["attempts"]) for state in states]
+        assert attempts == [("done", 2), ("done", 1)]
+        # Once the attempts are exhausted, the job fails
+        server.submit(jobs[0])
+        for _ in range(2):
+            assert request(f"{server.url}/leases", TOKEN, "POST", {"worker": "dead"})[0] == 200
+            time.sleep(0.6)
+        state = status(server.url, TOKEN)[2]
+        assert (state["status"], state["error"]) == ("failed", "lease expired 2 times")
+    finally:
+        server.shutdown()
+
+
+def test_heartbeat(root, clips, monkeypatch):
+    """the lease is kept while the worker does anything else than encoding"""
+    real_init = FFmpegWrapper.__init__
+
+    def slow_init(self, *args, **kwargs):
+        time.sleep(1.5)
+        real_init(self, *args, **kwargs)
+    monkeypatch.setattr(FFmpegWrapper, "__init__", slow_init)
+    server = JobServer(("127.0.0.1", 0), token=TOKEN, roots=[root], lease_timeout=0.5)
+    server.start()
+    try:
+        jobs = jobs_for(clips[:1], root / "out")
+        submit(server.url, TOKEN, jobs)
+        run_workers([Worker(server.url, TOKEN, shared=False)])
+        check_outputs(jobs)
+        [state] = status(server.url, TOKEN)
+        assert (state["status"], state["attempts"]) == ("done", 1)
+    finally:
+        server.shutdown()
+
+
+def test_invalid_job(server, root, monkeypatch):
+    """jobs which cannot be processed fail, without stopping the worker"""
+    real_process = FFmpegWrapper.process
+
+    def process(self, to, *args, **kwargs):
+        if self.input_file.name == "unexpected.webm":
+            raise KeyError("duration")
+        return real_process(self, to, *args, **kwargs)
+    monkeypatch.setattr(FFmpegWrapper, "process", process)
+    invalid = root / "invalid.webm"
+    invalid.write_text("not a video")
+    unexpected = root / "unexpected.webm"
+    ffmpeg.input(str(SAMPLE_VIDEO), t=1).output(str(unexpected), c="copy").run(quiet=True)
+    submit(server.url, TOKEN, [Job(invalid, root / "out.mp4"),
+                               Job(root / "missing.webm", root / "out2.mp4"),
+                               Job(unexpected, root / "out3.mp4")])
+    run_workers([Worker(server.url, TOKEN)])
+    states = status(server.url, TOKEN)
+    assert [state["status"] for state in states] == ["failed", "failed", "failed"]
+    assert "does not exist" in states[1]["error"]
+    assert states[2]["error"] == "'duration'"
+
+
+def test_slow_status(server, root, clips, monkeypatch):
+    """a client slow to receive the state of the jobs does not hold the workers up"""
+    sending, resume = Event(), Event()
+    real_send_json = JobRequestHandler.send_json
+
+    def send_json(self, data, *args):
+        if "jobs" in data:
+            sending.set()
+            resume.wait(10)
+        real_send_json(self, data, *args)
+    monkeypatch.setattr(JobRequestHandler, "send_json", send_json)
+    submit(server.url, TOKEN, jobs_for(clips[:1], root))
+    thread = Thread(target=status, args=(server.url, TOKEN))
+    thread.start()
+    try:
+        assert sending.wait(10)
+        start = time.monotonic()
+        code, leased = request(f"{server.url}/leases", TOKEN, "POST", {"worker": "test"})
+        assert code == 200 and leased["id"] == 1
+        assert time.monotonic() - start < 5
+    finally:
+        resume.set()
+        thread.join()
+    assert [state["status"] for state in server.snapshot()] == ["leased"]
+
+
+def test_token(server, root, clips):
+    """requests without the server's token are refused"""
+    with pytest.raises(urllib.error.HTTPError) as raised:
+        urllib.request.urlopen(f"{server.url}/jobs")
+    assert raised.value.code == 401
+    with pytest.raises(AuthenticationError):
+        request(f"{server.url}/jobs", "wrong")
+    with pytest.raises(AuthenticationError):
+        submit(server.url, "wrong", [Job(clips[0], root / "out.mp4")])
+    with pytest.raises(AuthenticationError):
+        Worker(server.url, "wrong").run(True)
+    assert status(server.url, TOKEN) == []
+
+
+def test_paths(server, root, clips):
+    """jobs can only read and write under the served directories"""
+    with TemporaryDirectory() as td:
+        outside = Path(td).resolve()
+        (root / "link").symlink_to(outside)
+        for job in (Job(Path("/etc/passwd"), root / "out.mp4"),
+                    Job(clips[0], outside / "out.mp4"),
+                    Job(clips[0], root / "link" / "out.mp4"),
+                    Job(clips[0], root / ".." / "out.mp4"),
+                    Job(Path(clips[0].name), root / "out.mp4")):
+            with pytest.raises(VideoError, match="not under a directory served"):
+                submit(server.url, TOKEN, [job])
+    assert status(server.url, TOKEN) == []
+
+
+def test_bad_upload(server, root, clips):
+    """invalid uploads get a 400 (Bad Request) response"""
+    submit(server.url, TOKEN, jobs_for(clips[:1], root))
+    lease = request(f"{server.url}/leases", TOKEN, "POST", {"worker": "test"})[1]["lease"]
+    host, port = server.url[len("http://"):].split(":")
+    for path, length in (("/jobs/one/output", 10), ("/jobs/1/output", 100)):
+        connection = http.client.HTTPConnection(host, int(port))
+        connection.putrequest("PUT", f"{path}?lease={lease}")
+        connection.putheader("Authorization", f"Bearer {TOKEN}")
+        connection.putheader("Content-Length", str(length))
+        connection.endheaders(b"x" * 10)
+        if length > 10:
+            # The client is gone before sending everything
+            connection.sock.shutdown(socket.SHUT_WR)
+        assert connection.getresponse().status == 400
+        connection.close()
+    assert sorted(path.name for path in root.iterdir()) == [clip.name for clip in clips]
+
+
+def test_unreachable_server(root, clips, monkeypatch):
+    """workers wait for a server which cannot be reached"""
+    monkeypatch.setattr(server_module, "RETRY_DELAY", 0.1)
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    worker = Worker(f"http://127.0.0.1:{port}", TOKEN)
+    thread = Thread(target=worker.run, args=(True,))
+    thread.start()
+    time.sleep(0.5)
+    server = JobServer(("127.0.0.1", port), token=TOKEN, roots=[root])
+    server.submit(jobs_for(clips[:1], root)[0])
+    server.start()
+    try:
+        thread.join()
+        assert worker.processed == 1
+    finally:
+        server.shutdown()
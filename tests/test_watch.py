@@ -0,0 +1,170 @@
+import json
+import os
+import shutil
+import time
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from threading import Thread
+
+import ffmpeg  # type: ignore
+import pytest
+
+from video_transformer.core import FFmpegWrapper, Profile, resume_directory
+from video_transformer.watch import DirectoryPoller, Inotify, WatchFolder
+
+SAMPLE_VIDEO = Path("tests/Whathappenedontwentythirdstreet-thomasedisoninc.ogv.240p.vp9.webm")
+
+
+@pytest.fixture
+def clip():
+    """A short copy of the sample video"""
+    with TemporaryDirectory() as td:
+        path = Path(td) / "clip.webm"
+        ffmpeg.input(str(SAMPLE_VIDEO), t=3).output(str(path), c="copy").run(quiet=True)
+        yield path
+
+
+@pytest.fixture
+def inbox():
+    with TemporaryDirectory() as td:
+        yield Path(td)
+
+
+def wait_until(condition, timeout: float = 60.0):
+    """Waits for `condition()` to be true"""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.1)
+
+
+def start(folder: WatchFolder) -> Thread:
+    """Runs the watch folder in a thread"""
+    folder.TICK = 0.1
+    thread = Thread(target=folder.run)
+    thread.start()
+    return thread
+
+
+@pytest.mark.parametrize("watcher", [Inotify, DirectoryPoller])
+def test_watchers(inbox, watcher):
+    """new files are notified once"""
+    watch = watcher(inbox)
+    try:
+        watch.wait(0.1)
+        (inbox / "a.webm").write_bytes(b"a")
+        os.rename(inbox / "a.webm", inbox / "b.webm")
+        assert "b.webm" in watch.wait(0.2)
+        assert watch.wait(0.1) == []
+    finally:
+        watch.close()
+
+
+def test_inotify_overflow(inbox, monkeypatch):
+    """lost events are reported"""
+    watch = Inotify(inbox)
+    try:
+        (inbox / "a.webm").write_bytes(b"a")
+        overflow = Inotify.EVENT.pack(-1, Inotify.IN_Q_OVERFLOW, 0, 0)
+        monkeypatch.setattr(os, "read", lambda fd, size: overflow)
+        assert watch.wait(1) is None
+    finally:
+        watch.close()
+
+
+def test_watch_folder_overflow(inbox, clip, monkeypatch):
+    """once notifications were lost, the inbox is listed again"""
+    class Overflowing(DirectoryPoller):
+        def wait(self, timeout):
+            time.sleep(timeout)
+            return None if (inbox / "a.webm").exists() else []
+    monkeypatch.setattr(WatchFolder, "_watcher", lambda self: Overflowing(inbox))
+    folder = WatchFolder(inbox, inbox / "output", speed=4, profile=Profile.PREVIEW, settle=0.2)
+    thread = start(folder)
+    try:
+        time.sleep(0.3)
+        shutil.copy(clip, inbox / "a.webm")
+        wait_until(lambda: (inbox / "done" / "a.webm").exists())
+    finally:
+        folder.stop()
+        thread.join()
+
+
+@pytest.mark.parametrize("polling", [False, True])
+def test_watch_folder(inbox, clip, polling):
+    """videos are processed once completely written, then moved out of the inbox"""
+    output_dir = inbox / "output"
+    folder = WatchFolder(inbox, output_dir, speed=4, profile=Profile.PREVIEW, workers=2,
+                         settle=0.5, polling=polling)
+    thread = start(folder)
+    try:
+        # Written slowly, like a camera would
+        data = clip.read_bytes()
+        with (inbox / "a.webm").open("wb") as file:
+            for offset in range(0, len(data), len(data) // 4):
+                file.write(data[offset:offset + len(data) // 4])
+                file.flush()
+                time.sleep(0.2)
+        (inbox / "invalid.mp4").write_text("not a video")
+        (inbox / "notes.txt").write_text("not a video either")
+        wait_until(lambda: (inbox / "done" / "a.webm").exists()
+                   and (inbox / "failed" / "invalid.mp4").exists())
+    finally:
+        folder.stop()
+        thread.join()
+    assert (inbox / "done" / "a.webm").read_bytes() == data
+    output = FFmpegWrapper(output_dir / "a.4.mp4").metadata
+    assert output.duration.total_seconds() == pytest.approx(3 / 4, abs=0.1)
+    assert sorted(path.name for path in inbox.iterdir()) == [
+        ".video-transformer-watch.json", "done", "failed", "notes.txt", "output"]
+    assert json.loads(folder.state_file.read_text()) == {"files": {}}
+
+
+def test_watch_folder_restart(inbox, clip):
+    """what a previous run processed is not processed again, interrupted videos are"""
+    shutil.copy(clip, inbox / "processed.webm")
+    shutil.copy(clip, inbox / "interrupted.webm")
+    stats = {name: os.stat(inbox / name) for name in ("processed.webm", "interrupted.webm")}
+    state_file = inbox / ".video-transformer-watch.json"
+    state_file.write_text(json.dumps({"files": {
+        name: {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+               "status": "done" if name == "processed.webm" else "processing"}
+        for name, stat in stats.items()
+    }}))
+    output_dir = inbox / "output"
+    folder = WatchFolder(inbox, output_dir, speed=4, profile=Profile.PREVIEW, settle=0.2)
+    thread = start(folder)
+    try:
+        wait_until(lambda: (inbox / "done" / "interrupted.webm").exists())
+    finally:
+        folder.stop()
+        thread.join()
+    assert (inbox / "done" / "processed.webm").exists()
+    assert [path.name for path in output_dir.iterdir()] == ["interrupted.4.mp4"]
+
+
+def test_watch_folder_errors(inbox, clip, monkeypatch):
+    """a file that makes processing fail unexpectedly does not stop the next ones"""
+    real_process = FFmpegWrapper.process
+
+    def process(self, to, *args, **kwargs):
+        if self.input_file.name == "a.webm":
+            raise KeyError("duration")
+        return real_process(self, to, *args, **kwargs)
+    monkeypatch.setattr(FFmpegWrapper, "process", process)
+    output_dir = inbox / "output"
+    # Pieces of an earlier attempt
+    resume_directory(output_dir / "a.4.mp4").mkdir(parents=True)
+    shutil.copy(clip, inbox / "a.webm")
+    shutil.copy(clip, inbox / "b.webm")
+    folder = WatchFolder(inbox, output_dir, speed=4, profile=Profile.PREVIEW, settle=0.2)
+    thread = start(folder)
+    try:
+        wait_until(lambda: (inbox / "done" / "b.webm").exists()
+                   and (inbox / "failed" / "a.webm").exists())
+    finally:
+        folder.stop()
+        thread.join()
+    assert [path.name for path in output_dir.iterdir()] == ["b.4.mp4"]
+    assert json.loads(folder.state_file.read_text()) == {"files": {}}
@@ -0,0 +1,156 @@
+"""asyncio flavour of `FFmpegWrapper`, to run many encodes from a single event loop"""
+import asyncio
+import os
+import signal
+import time
+
+from collections import deque
+from functools import partial
+from logging import getLogger
+from pathlib import Path
+from typing import (Any, AsyncIterator, Callable, Deque, Dict, Iterable, List,
+                    Optional, Tuple)
+
+from video_transformer.cache import MetadataCache
+from video_transformer.core import (FFmpegProcess, FFmpegWrapper, Format,
+                                    Profile, Progress, ProgressParser,
+                                    temporary_directory)
+
+LOGGER = getLogger(__name__)
+
+
+class AsyncFFmpegWrapper(FFmpegWrapper):
+    """
+    `FFmpegWrapper` whose `process()` is an async generator running ffmpeg with asyncio.
+    Cancelling the task iterating over it stops ffmpeg like `stop()` does.
+    """
+
+    def __init__(self, input_file: Path, **kwargs: Any):
+        super().__init__(input_file, **kwargs)
+        self.subprocess: Optional[asyncio.subprocess.Process] = None
+
+    @classmethod
+    async def open(cls, input_file: Path,
+                   cache: Optional[MetadataCache] = None) -> "AsyncFFmpegWrapper":
+        """Creates a wrapper without blocking the event loop while the file is probed"""
+        return await asyncio.get_event_loop().run_in_executor(
+            None, partial(cls, input_file, cache=cache)
+        )
+
+    def stop(self):
+        """
+        Sends a stop signal the running ffmpeg process, that of `process()` or those of the
+        inherited synchronous methods.
+        Raises `RuntimeError` if ffmpeg is not running.
+        """
+        if not self.subprocess or self.subprocess.returncode is not None:
+            super().stop()
+            return
+        self._stopping = True
+        self.subprocess.send_signal(signal.SIGINT)
+
+    async def process(self, to: Path, by: float = 2.0,  # type: ignore
+                      fmt: Format = Format.MP4,
+                      profile: Profile = Profile.ARCHIVAL) -> AsyncIterator[Progress]:
+        """
+        Runs ffmpeg. Yields `Progress` instances when progress is reported.
+        Once done, what it took is described by `report`, without the CPU time and memory
+        used by ffmpeg, which asyncio waits for.
+        """
+        report = self._start_report(to)
+        start = time.perf_counter()
+        try:
+            async for progress in self._encode_async(to, by, fmt, profile):
+                report.samples.append(self._sample(time.perf_counter() - start, progress))
+                yield progress
+        finally:
+            self._end_report(report, to, time.perf_counter() - start)
+
+    async def _encode_async(self, to: Path, by: float, fmt: Format,
+                            profile: Profile) -> AsyncIterator[Progress]:
+        """Implementation of `process()`"""
+        self.returncode = None
+        self._stopping = False
+        with temporary_directory(to) as td:
+            temp_to = Path(td) / to.name
+            read_fd, write_fd = os.pipe()
+            try:
+                self.subprocess = await asyncio.create_subprocess_exec(
+                    *FFmpegProcess.command(self._encode_args(temp_to, by, fmt, profile=profile),
+                                           write_fd),
+                    stdin=asyncio.subprocess.DEVNULL,
+                    stdout=asyncio.subprocess.DEVNULL,
+                    stderr=asyncio.subprocess.PIPE,
+                    pass_fds=(write_fd,),
+                )
+            except BaseException:
+                os.close(read_fd)
+                raise
+            finally:
+                os.close(write_fd)
+            log: Deque[bytes] = deque(maxlen=20)
+            log_task = asyncio.ensure_future(self._read_log(self.subprocess, log))
+            try:
+                async for progress in self._read_progress(read_fd):
+                    yield progress
+                self.returncode = await self.subprocess.wait()
+            finally:
+                if self.subprocess.returncode is None:
+                    # Cancelled, or the caller stopped iterating: interrupt ffmpeg
+                    self.subprocess.send_signal(signal.SIGINT)
+                    self.returncode = await self.subprocess.wait()
+                await log_task
+                self.subprocess = None
+            if self.returncode not in (0, 255):
+                LOGGER.warning("ffmpeg exited with code %d: %s", self.returncode,
+                               b"\n".join(log).decode(errors="replace"))
+            if self.returncode == 0:
+                # if ffmpeg exited successfully, move the output file in place
+                os.replace(temp_to, to)
+
+    @staticmethod
+    async def _read_progress(fd: int) -> AsyncIterator[Progress]:
+        """Reads and parses the progress channel until ffmpeg closes it"""
+        loop = asyncio.get_event_loop()
+        reader = asyncio.StreamReader()
+        transport, _ = await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(fd, "rb", 0)
+        )
+        parser = ProgressParser()
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                records = parser.feed(data)
+                if records:
+                    yield records[-1]
+        finally:
+            transport.close()
+
+    @staticmethod
+    async def _read_log(process: asyncio.subprocess.Process, log: Deque[bytes]):
+        """Keeps the last lines logged by ffmpeg"""
+        async for line in process.stderr:  # type: ignore
+            log.append(line.rstrip())
+
+
+async def run_many(jobs: Iterable[Tuple[AsyncFFmpegWrapper, Dict[str, Any]]],
+                   limit: Optional[int] = None,
+                   on_progress: Optional[Callable[[AsyncFFmpegWrapper, Progress], Any]] = None
+                   ) -> List[Optional[int]]:
+    """
+    Runs the given (wrapper, `process()` keyword arguments) jobs, at most `limit` at a time
+    (the number of CPUs by default). `on_progress` is called with each job's progress.
+    Returns the jobs' return codes, in order.
+    """
+    semaphore = asyncio.Semaphore(limit or os.cpu_count() or 1)
+
+    async def run(wrapper: AsyncFFmpegWrapper, options: Dict[str, Any]) -> Optional[int]:
+        async with semaphore:
+            async for progress in wrapper.process(**options):
+                if on_progress:
+                    on_progress(wrapper, progress)
+            return wrapper.returncode
+
+    return await asyncio.gather(*(run(wrapper, options) for wrapper, options in jobs))
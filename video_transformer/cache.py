@@ -0,0 +1,249 @@
+"""On-disk caches, stored in the user's cache directory"""
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import time
+import uuid
+
+from contextlib import closing
+from logging import getLogger
+from pathlib import Path
+from threading import Lock
+from typing import Any, ClassVar, List, Optional
+
+from video_transformer.core import VideoMetadata
+
+LOGGER = getLogger(__name__)
+
+
+def user_cache_dir() -> Path:
+    """The directory where video-transformer keeps its caches (follows XDG)"""
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "video-transformer"
+
+
+#: ioctl creating a copy-on-write clone of a file (btrfs, xfs...), from linux/fs.h
+FICLONE = 0x40049409
+
+
+def clone_file(source: Path, destination: Path):
+    """
+    Creates `destination` with the contents of `source`, without copying them if possible:
+    as a copy-on-write clone, or else as a hard link. Falls back to a copy.
+    `destination` is replaced atomically if it exists.
+    """
+    # Unique name on the same filesystem, so that replacing is atomic
+    temp = destination.with_name(f".{destination.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        try:
+            with source.open("rb") as src, temp.open("wb") as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            # Not supported by the filesystem, or across filesystems
+            temp.unlink()
+            try:
+                os.link(str(source), str(temp))
+            except OSError:
+                shutil.copyfile(str(source), str(temp))
+        os.replace(str(temp), str(destination))
+    except BaseException:
+        if temp.exists():
+            temp.unlink()
+        raise
+
+
+class MetadataCache:
+    """
+    Persistent cache of `VideoMetadata` and keyframe timestamps, stored in a sqlite database.
+    Entries are keyed by path, size and modification time, so a modified file is probed again.
+    When there are more than `max_entries` of a kind, the least recently used ones are evicted.
+    """
+    #: Tables of the database, one per kind of cached value
+    TABLES: ClassVar[List[str]] = ["metadata", "keyframes"]
+
+    def __init__(self, path: Optional[Path] = None, max_entries: int = 10000):
+        self.path = path or user_cache_dir() / "metadata.sqlite3"
+        self.max_entries = max_entries
+        # sqlite connections are not shared between threads, but writes still need to be
+        # serialized to avoid "database is locked" errors
+        self._lock = Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as db, db:
+            for table in self.TABLES:
+                # The value column is named like the table
+                db.execute(
+                    f"CREATE TABLE IF NOT EXISTS {table} ("
+                    f" path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER,"
+                    f" {table} TEXT, last_used REAL)"
+                )
+                db.execute(
+                    f"CREATE INDEX IF NOT EXISTS {table}_last_used ON {table} (last_used)"
+                )
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(str(self.path), timeout=10)
+
+    @staticmethod
+    def _key(video: Path):
+        """Cache key of a video file"""
+        stat = video.stat()
+        return str(video.resolve()), stat.st_size, stat.st_mtime_ns
+
+    def get(self, video: Path) -> Optional[VideoMetadata]:
+        """Returns the cached metadata of the given video, or None"""
+        data = self._get("metadata", video)
+        try:
+            return VideoMetadata.from_dict(data) if data is not None else None
+        except (ValueError, KeyError, TypeError) as err:
+            # Written by another version
+            LOGGER.debug("Ignoring invalid cache entry for %s: %s", video, err)
+            return None
+
+    def put(self, video: Path, metadata: VideoMetadata):
+        """Stores the metadata of the given video, evicting old entries if needed"""
+        self._put("metadata", video, metadata.as_dict())
+
+    def get_keyframes(self, video: Path) -> Optional[List[float]]:
+        """Returns the cached keyframe timestamps of the given video, or None"""
+        return self._get("keyframes", video)
+
+    def put_keyframes(self, video: Path, keyframes: List[float]):
+        """Stores the keyframe timestamps of the given video, evicting old entries if needed"""
+        self._put("keyframes", video, keyframes)
+
+    def _get(self, table: str, video: Path) -> Any:
+        """Returns the JSON value cached in the given table for a video, or None"""
+        path, size, mtime_ns = self._key(video)
+        with self._lock, closing(self._connect()) as db, db:
+            row = db.execute(
+                f"SELECT {table} FROM {table} WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (path, size, mtime_ns),
+            ).fetchone()
+            if row is None:
+                return None
+            db.execute(f"UPDATE {table} SET last_used = ? WHERE path = ?", (time.time(), path))
+        try:
+            return json.loads(row[0])
+        except ValueError as err:
+            LOGGER.debug("Ignoring invalid cache entry for %s: %s", video, err)
+            return None
+
+    def _put(self, table: str, video: Path, value: Any):
+        """Stores a JSON value in the given table for a video, evicting old entries if needed"""
+        path, size, mtime_ns = self._key(video)
+        with self._lock, closing(self._connect()) as db, db:
+            db.execute(
+                f"INSERT OR REPLACE INTO {table} VALUES (?, ?, ?, ?, ?)",
+                (path, size, mtime_ns, json.dumps(value), time.time()),
+            )
+            db.execute(
+                f"DELETE FROM {table} WHERE path IN ("
+                f" SELECT path FROM {table} ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def __len__(self) -> int:
+        """Number of videos whose metadata is cached"""
+        with closing(self._connect()) as db:
+            return db.execute("SELECT COUNT(*) FROM metadata").fetchone()[0]
+
+
+class OutputCache:
+    """
+    Persistent cache of processed videos, so that the same input processed with the same
+    parameters is not encoded again. Entries are keyed by a partial hash of the input's
+    contents (see `fingerprint()`) and the processing parameters.
+    Outputs are stored as files in a directory, indexed in a sqlite database. When they take
+    more than `max_size` bytes, the least recently used ones are evicted.
+    """
+    #: Bytes of the beginning and of the end of the input hashed by `fingerprint()`
+    SAMPLE_SIZE: ClassVar[int] = 1 << 20
+
+    def __init__(self, path: Optional[Path] = None, max_size: int = 10 << 30):
+        self.path = path or user_cache_dir() / "outputs"
+        self.max_size = max_size
+        self._lock = Lock()
+        self.path.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as db, db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS outputs ("
+                " key TEXT PRIMARY KEY, file TEXT, size INTEGER, last_used REAL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS outputs_last_used ON outputs (last_used)")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(str(self.path / "index.sqlite3"), timeout=10)
+
+    @classmethod
+    def fingerprint(cls, video: Path) -> str:
+        """
+        Hash of the size and of the first and last `SAMPLE_SIZE` bytes of a video, which
+        identifies it without reading all of it.
+        """
+        digest = hashlib.blake2b(digest_size=20)
+        with video.open("rb") as file:
+            size = os.fstat(file.fileno()).st_size
+            digest.update(str(size).encode())
+            digest.update(file.read(cls.SAMPLE_SIZE))
+            if size > cls.SAMPLE_SIZE:
+                file.seek(max(size - cls.SAMPLE_SIZE, cls.SAMPLE_SIZE))
+                digest.update(file.read())
+        return digest.hexdigest()
+
+    def key(self, video: Path, **parameters: Any) -> str:
+        """Cache key of the output of processing `video` with the given parameters"""
+        normalized = json.dumps(parameters, sort_keys=True, default=str)
+        return hashlib.blake2b(f"{self.fingerprint(video)}:{normalized}".encode(),
+                               digest_size=20).hexdigest()
+
+    def get(self, key: str, to: Path) -> bool:
+        """Writes the cached output with the given key to `to`. Returns whether it was found."""
+        with self._lock, closing(self._connect()) as db, db:
+            row = db.execute("SELECT file FROM outputs WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return False
+            try:
+                clone_file(self.path / row[0], to)
+            except FileNotFoundError:
+                # Removed behind our back
+                db.execute("DELETE FROM outputs WHERE key = ?", (key,))
+                return False
+            db.execute("UPDATE outputs SET last_used = ? WHERE key = ?", (time.time(), key))
+        return True
+
+    def put(self, key: str, output: Path):
+        """Stores a copy of `output` under the given key, evicting old entries if needed"""
+        file = key + output.suffix
+        clone_file(output, self.path / file)
+        with self._lock, closing(self._connect()) as db, db:
+            db.execute("INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?)",
+                       (key, file, output.stat().st_size, time.time()))
+            self._evict(db)
+
+    def _evict(self, db: sqlite3.Connection):
+        """Removes the least recently used entries until they fit in `max_size`"""
+        total = 0
+        for key, file, size in db.execute(
+            "SELECT key, file, size FROM outputs ORDER BY last_used DESC"
+        ).fetchall():
+            total += size
+            if total > self.max_size:
+                LOGGER.debug("Evicting %s from the output cache", file)
+                db.execute("DELETE FROM outputs WHERE key = ?", (key,))
+                try:
+                    (self.path / file).unlink()
+                except FileNotFoundError:
+                    pass
+
+    @property
+    def size(self) -> int:
+        """Bytes taken by the cached outputs"""
+        with closing(self._connect()) as db:
+            return db.execute("SELECT COALESCE(SUM(size), 0) FROM outputs").fetchone()[0]
+
+    def __len__(self) -> int:
+        with closing(self._connect()) as db:
+            return db.execute("SELECT COUNT(*) FROM outputs").fetchone()[0]
@@ -0,0 +1,411 @@
+"""
+Command line interface. Without arguments, the GUI is started.
+Only what the chosen command needs is imported, so that scripted use starts fast.
+"""
+import argparse
+import datetime
+import json
+import os
+import sys
+
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+from video_transformer.core import (Format, Job, JobQueue, Profile, Progress,
+                                    default_output_file)
+
+#: Environment variable holding the token of the job server
+TOKEN_VARIABLE = "VIDEO_TRANSFORMER_TOKEN"
+
+
+def parser() -> argparse.ArgumentParser:
+    """Parser of the command line arguments"""
+    main_parser = argparse.ArgumentParser(prog="video-transformer",
+                                          description="ffmpeg based video processing")
+    commands = main_parser.add_subparsers(dest="command", metavar="command")
+    commands.add_parser("gui", help="start the graphical interface (default)")
+    process = commands.add_parser("process", help="speed videos up or down")
+    process.add_argument("files", nargs="+", type=Path, metavar="file")
+    process.add_argument("-s", "--speed", type=float, default=2.0,
+                         help="speed-up factor (default: %(default)s)")
+    process.add_argument("-f", "--format", choices=[fmt.name.lower() for fmt in Format],
+                         default=Format.MP4.name.lower(), help="output format (default: mp4)")
+    process.add_argument("-p", "--profile", choices=[profile.value for profile in Profile],
+                         default=Profile.ARCHIVAL.value,
+                         help="speed/quality trade-off (default: %(default)s)")
+    output = process.add_mutually_exclusive_group()
+    output.add_argument("-o", "--output", type=Path,
+                        help="output file, when processing a single file")
+    output.add_argument("-d", "--output-dir", type=Path,
+                        help="directory of the output files (default: next to the inputs)")
+    process.add_argument("-j", "--workers", type=int,
+                         help="videos processed at once (default: depends on the CPUs)")
+    process.add_argument("--progress", choices=("text", "json", "none"), default="text",
+                         help="progress reporting: text on stderr, or JSON lines on stdout")
+    process.add_argument("--resumable", action="store_true",
+                         help="keep the encoded pieces of interrupted jobs, so that running "
+                              "them again continues where they stopped")
+    process.add_argument("--copy", action="store_true",
+                         help="copy the videos already in the output's codec instead of "
+                              "re-encoding them, with a speed of 1")
+    process.add_argument("--no-cache", action="store_true",
+                         help="do not cache the metadata of the videos")
+    probe = commands.add_parser("probe", help="analyse many videos, summarize them")
+    probe.add_argument("paths", nargs="+", type=Path, metavar="path",
+                       help="video, or directory to search for videos")
+    probe.add_argument("-m", "--manifest", type=Path,
+                       help="JSON lines (or .csv) file to write the results to, "
+                            "the results it already holds are reused")
+    probe.add_argument("-j", "--workers", type=int,
+                       help="videos probed at once (default: number of CPUs)")
+    probe.add_argument("-s", "--speed", type=float, default=2.0,
+                       help="speed-up factor, for the output duration (default: %(default)s)")
+    probe.add_argument("-r", "--realtime-factor", type=float, default=1.0,
+                       help="seconds of video processed per second, for the time estimate "
+                            "(default: %(default)s)")
+    probe.add_argument("--json", action="store_true", help="print the summary as JSON")
+    probe.add_argument("--no-cache", action="store_true",
+                       help="do not cache the metadata of the videos")
+    watch = commands.add_parser("watch", help="process the videos dropped in a directory")
+    watch.add_argument("inbox", type=Path, help="directory to watch")
+    watch.add_argument("-d", "--output-dir", type=Path, required=True,
+                       help="directory of the output files")
+    watch.add_argument("-s", "--speed", type=float, default=2.0,
+                       help="speed-up factor (default: %(default)s)")
+    watch.add_argument("-f", "--format", choices=[fmt.name.lower() for fmt in Format],
+                       default=Format.MP4.name.lower(), help="output format (default: mp4)")
+    watch.add_argument("-p", "--profile", choices=[profile.value for profile in Profile],
+                       default=Profile.ARCHIVAL.value,
+                       help="speed/quality trade-off (default: %(default)s)")
+    watch.add_argument("-j", "--workers", type=int, default=1,
+                       help="videos processed at once (default: %(default)s)")
+    watch.add_argument("--settle", type=float, default=5.0,
+                       help="seconds a video must stay unchanged before it is processed "
+                            "(default: %(default)s)")
+    watch.add_argument("--done-dir", type=Path,
+                       help="where processed videos are moved (default: INBOX/done)")
+    watch.add_argument("--failed-dir", type=Path,
+                       help="where videos that could not be processed are moved "
+                            "(default: INBOX/failed)")
+    watch.add_argument("--polling", action="store_true",
+                       help="list the directory periodically instead of using inotify")
+    watch.add_argument("--no-cache", action="store_true",
+                       help="do not cache the metadata of the videos")
+    serve = commands.add_parser("serve", help="serve a queue of jobs to workers")
+    serve.add_argument("--host", default="127.0.0.1",
+                       help="address to listen on (default: %(default)s)")
+    serve.add_argument("--port", type=int, default=8642,
+                       help="port to listen on (default: %(default)s)")
+    serve.add_argument("--lease-timeout", type=float, default=60.0,
+                       help="seconds without progress after which a job is given to another "
+                            "worker (default: %(default)s)")
+    serve.add_argument("--root", type=Path, action="append", dest="roots", metavar="DIR",
+                       help="directory the jobs may read and write in, can be repeated "
+                            "(default: the current directory)")
+    worker = commands.add_parser("worker", help="process the jobs of a job server")
+    worker.add_argument("url", help="URL of the job server")
+    worker.add_argument("-j", "--workers", type=int, default=1,
+                        help="jobs processed at once (default: %(default)s)")
+    worker.add_argument("--upload", action="store_true",
+                        help="download the inputs and upload the outputs, instead of using "
+                             "the paths of the jobs")
+    worker.add_argument("--exit-when-idle", action="store_true",
+                        help="exit once there are no jobs left")
+    worker.add_argument("--no-cache", action="store_true",
+                        help="do not cache the metadata of the videos")
+    submit = commands.add_parser("submit", help="queue videos on a job server")
+    submit.add_argument("url", help="URL of the job server")
+    submit.add_argument("files", nargs="+", type=Path, metavar="file")
+    submit.add_argument("-s", "--speed", type=float, default=2.0,
+                        help="speed-up factor (default: %(default)s)")
+    submit.add_argument("-f", "--format", choices=[fmt.name.lower() for fmt in Format],
+                        default=Format.MP4.name.lower(), help="output format (default: mp4)")
+    submit.add_argument("-p", "--profile", choices=[profile.value for profile in Profile],
+                        default=Profile.ARCHIVAL.value,
+                        help="speed/quality trade-off (default: %(default)s)")
+    submit.add_argument("-d", "--output-dir", type=Path,
+                        help="directory of the output files (default: next to the inputs)")
+    status = commands.add_parser("status", help="show the jobs of a job server")
+    status.add_argument("url", help="URL of the job server")
+    status.add_argument("--json", action="store_true", help="print the jobs as JSON")
+    for command in (serve, worker, submit, status):
+        command.add_argument("--token", default=os.environ.get(TOKEN_VARIABLE),
+                             help="secret shared by the job server and its clients (default: "
+                                  f"${TOKEN_VARIABLE}, a new one is printed by serve)")
+    return main_parser
+
+
+def jobs_from_args(args: argparse.Namespace) -> List[Job]:
+    """The jobs to run for the `process` command"""
+    fmt, profile = Format[args.format.upper()], Profile(args.profile)
+    jobs: List[Job] = []
+    for input_file in args.files:
+        output_file = args.output or default_output_file(input_file, args.speed, fmt)
+        if args.output_dir:
+            output_file = args.output_dir / output_file.name
+        jobs.append(Job(input_file, output_file, speed=args.speed, fmt=fmt, profile=profile,
+                        resumable=args.resumable, copy=args.copy))
+    return jobs
+
+
+def progress_line(job: Job, progress: Progress) -> str:
+    """Human readable progress of a job"""
+    speed = f", {progress.speed:.2f}x" if progress.speed is not None else ""
+    return f"{job.input_file.name}: {job.fraction:.0%} ({progress.fps:.0f} fps{speed})"
+
+
+def job_event(job: Job, progress: Optional[Progress] = None) -> str:
+    """JSON line describing the progress, or the result if `progress` is None, of a job"""
+    event: Dict[str, Any] = {
+        "event": "progress" if progress else "finished",
+        "input": str(job.input_file),
+        "output": str(job.output_file),
+        "fraction": job.fraction,
+    }
+    if progress:
+        event.update(time=progress.time.total_seconds(), fps=progress.fps,
+                     speed=progress.speed, bitrate=progress.bitrate,
+                     total_size=progress.total_size)
+    else:
+        event.update(returncode=job.returncode, error=job.error)
+    return json.dumps(event)
+
+
+def process(args: argparse.Namespace) -> int:
+    """Runs the `process` command, returns the exit code"""
+    if args.output and len(args.files) > 1:
+        print("--output can only be used with a single file", file=sys.stderr)
+        return 2
+    cache = None
+    if not args.no_cache:
+        from video_transformer.cache import MetadataCache
+        cache = MetadataCache()
+    queue = JobQueue(jobs_from_args(args), workers=args.workers, cache=cache)
+    # Only report progress when it changed visibly
+    reported = {id(job): -1 for job in queue.jobs}
+    events = queue.run()
+    try:
+        for job, progress in events:
+            percent = int(job.fraction * 100)
+            if percent == reported[id(job)] and not progress.done:
+                continue
+            reported[id(job)] = percent
+            if args.progress == "json":
+                print(job_event(job, progress), flush=True)
+            elif args.progress == "text":
+                print(progress_line(job, progress), file=sys.stderr, flush=True)
+    except KeyboardInterrupt:
+        # ffmpeg got the signal too, stop the jobs and wait for the workers to exit
+        queue.stop()
+        events.close()
+        return 255
+    for job in queue.jobs:
+        report_result(job, args.progress)
+    return queue.returncode or 0
+
+
+def report_result(job: Job, progress: str):
+    """Reports the result of a finished job, failures are always reported"""
+    if progress == "json":
+        print(job_event(job), flush=True)
+    elif job.returncode != 0:
+        reason = job.error or job.returncode or "not finished"
+        print(f"{job.input_file}: failed ({reason})", file=sys.stderr)
+    elif progress == "text":
+        print(f"{job.input_file.name}: written to {job.output_file}", file=sys.stderr)
+
+
+def probe_paths(paths: Sequence[Path]) -> Iterator[Path]:
+    """The videos to probe for the `probe` command, directories are searched"""
+    from video_transformer.probe import find_videos
+    for path in paths:
+        if path.is_dir():
+            yield from find_videos(path)
+        else:
+            yield path
+
+
+def probe(args: argparse.Namespace) -> int:
+    """Runs the `probe` command, returns the exit code"""
+    from video_transformer.probe import (ProbeSummary, probe_many,
+                                         read_manifest, write_manifest)
+    cache = None
+    if not args.no_cache:
+        from video_transformer.cache import MetadataCache
+        cache = MetadataCache()
+    known = read_manifest(args.manifest) if args.manifest and args.manifest.exists() else None
+    probed = probe_many(probe_paths(args.paths), workers=args.workers, cache=cache, known=known)
+    results = write_manifest(probed, args.manifest) if args.manifest else list(probed)
+    for result in results:
+        if result.error:
+            print(f"{result.path}: {result.error}", file=sys.stderr)
+    summary = ProbeSummary.of(results)
+    output_duration = summary.output_duration(args.speed)
+    encode_time = summary.encode_time(args.realtime_factor)
+    if args.json:
+        print(json.dumps({"files": summary.files, "failed": summary.failed,
+                          "total_size": summary.total_size,
+                          "total_duration": summary.total_duration,
+                          "output_duration": output_duration, "encode_time": encode_time,
+                          "codecs": summary.codecs}))
+    else:
+        def duration(seconds: float) -> str:
+            return str(datetime.timedelta(seconds=round(seconds)))
+        codecs = ", ".join(f"{count} {codec}" for codec, count in summary.codecs.items())
+        print(f"{summary.files} videos ({summary.failed} failed), "
+              f"{summary.total_size / 1e6:.0f} MB: {codecs or 'none'}")
+        print(f"duration: {duration(summary.total_duration)}, "
+              f"{duration(output_duration)} at x{args.speed}")
+        print(f"estimated processing time: {duration(encode_time)}")
+    return 1 if summary.failed else 0
+
+
+def watch(args: argparse.Namespace) -> int:
+    """Runs the `watch` command until interrupted, returns the exit code"""
+    import logging
+
+    from video_transformer.watch import WatchFolder
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    cache = None
+    if not args.no_cache:
+        from video_transformer.cache import MetadataCache
+        cache = MetadataCache()
+    if not args.inbox.is_dir():
+        print(f"{args.inbox} is not a directory", file=sys.stderr)
+        return 2
+    folder = WatchFolder(args.inbox, args.output_dir, speed=args.speed,
+                         fmt=Format[args.format.upper()], profile=Profile(args.profile),
+                         workers=args.workers, settle=args.settle, done_dir=args.done_dir,
+                         failed_dir=args.failed_dir, cache=cache, polling=args.polling)
+    try:
+        folder.run()
+    except KeyboardInterrupt:
+        # The videos being processed stay in the inbox, for the next run
+        pass
+    return 0
+
+
+def serve(args: argparse.Namespace) -> int:
+    """Runs the `serve` command until interrupted, returns the exit code"""
+    import logging
+    import secrets
+
+    from video_transformer.server import JobServer
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    token = args.token or secrets.token_urlsafe(16)
+    server = JobServer((args.host, args.port), token=token, roots=args.roots or [Path.cwd()],
+                       lease_timeout=args.lease_timeout)
+    print(f"serving {', '.join(map(str, server.roots))} on {server.url}", file=sys.stderr)
+    if not args.token:
+        print(f"token: {token}", file=sys.stderr)
+    sys.stderr.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+    return 0
+
+
+def worker(args: argparse.Namespace) -> int:
+    """Runs the `worker` command, returns the exit code"""
+    import logging
+    import threading
+
+    from video_transformer.server import Worker
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    cache = None
+    if not args.no_cache:
+        from video_transformer.cache import MetadataCache
+        cache = MetadataCache()
+    # Each worker's ffmpeg gets its share of the cores
+    threads = max(1, (os.cpu_count() or 1) // args.workers)
+    workers = [Worker(args.url, args.token, shared=not args.upload, threads=threads, cache=cache)
+               for _ in range(args.workers)]
+    for idx, instance in enumerate(workers):
+        instance.name = f"{instance.name}/{idx}"
+    runners = [threading.Thread(target=instance.run, args=(args.exit_when_idle,), daemon=True)
+               for instance in workers]
+    for runner in runners:
+        runner.start()
+    try:
+        for runner in runners:
+            runner.join()
+    except KeyboardInterrupt:
+        # The jobs being processed are given back to the server
+        for instance in workers:
+            instance.stop()
+        for runner in runners:
+            runner.join()
+        return 255
+    return 0
+
+
+def submit(args: argparse.Namespace) -> int:
+    """Runs the `submit` command, returns the exit code"""
+    from video_transformer.core import VideoError
+    from video_transformer.server import AuthenticationError
+    from video_transformer.server import submit as submit_jobs
+    fmt, profile = Format[args.format.upper()], Profile(args.profile)
+    jobs: List[Job] = []
+    for input_file in args.files:
+        # The server and the workers do not share our working directory
+        input_file = input_file.resolve()
+        output_file = default_output_file(input_file, args.speed, fmt)
+        if args.output_dir:
+            output_file = args.output_dir.resolve() / output_file.name
+        jobs.append(Job(input_file, output_file, speed=args.speed, fmt=fmt, profile=profile))
+    try:
+        ids = submit_jobs(args.url.rstrip("/"), args.token, jobs)
+    except (VideoError, AuthenticationError, OSError) as err:
+        print(err, file=sys.stderr)
+        return 1
+    for job, job_id in zip(jobs, ids):
+        print(f"{job_id}: {job.input_file}")
+    return 0
+
+
+def status(args: argparse.Namespace) -> int:
+    """Runs the `status` command, returns the exit code"""
+    from video_transformer.server import AuthenticationError
+    from video_transformer.server import status as server_status
+    try:
+        jobs = server_status(args.url.rstrip("/"), args.token)
+    except (AuthenticationError, OSError) as err:
+        print(err, file=sys.stderr)
+        return 1
+    if args.json:
+        print(json.dumps(jobs))
+        return 0
+    for job in jobs:
+        worker = f" by {job['worker']}" if job["worker"] else ""
+        error = f": {job['error']}" if job["error"] else ""
+        print(f"{job['id']}: {Path(job['input']).name} {job['status']}{worker} "
+              f"({job['fraction']:.0%}){error}")
+    return 0
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    """Entry point, returns the exit code"""
+    main_parser = parser()
+    args = main_parser.parse_args(argv)
+    if args.command in ("worker", "submit", "status") and not args.token:
+        main_parser.error("the token of the job server is needed, see --token")
+    if args.command == "process":
+        return process(args)
+    if args.command == "probe":
+        return probe(args)
+    if args.command == "watch":
+        return watch(args)
+    if args.command == "serve":
+        return serve(args)
+    if args.command == "worker":
+        return worker(args)
+    if args.command == "submit":
+        return submit(args)
+    if args.command == "status":
+        return status(args)
+    # Qt is only imported when it is needed
+    from video_transformer.gui import main as gui_main
+    return gui_main()
@@ -1,42 +1,145 @@
 import datetime
 import fcntl
+import json
+import math
 import os
 import re
+import resource
+import shutil
 import signal
 import subprocess
+import time
 
-from dataclasses import dataclass
-from distutils.spawn import find_executable
+from bisect import bisect_left, bisect_right
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import ExitStack
+from dataclasses import dataclass, replace
 from enum import Enum, unique
+from functools import lru_cache
 from logging import getLogger
 from pathlib import Path
+from queue import Queue
 from select import select
 from tempfile import TemporaryDirectory
-from typing import (Any, Callable, ClassVar, Dict, Iterable, List, Optional,
-                    Pattern, Sequence, Tuple)
+from threading import Lock, Thread
+from typing import (TYPE_CHECKING, Any, BinaryIO, ClassVar, Deque, Dict,
+                    FrozenSet, Generator, Iterable, List, Optional, Pattern,
+                    Sequence, Tuple, Union)
 
-import ffmpeg  # type: ignore
+from video_transformer.metrics import (JobReport, Sample, append_json_lines,
+                                       write_prometheus)
+
+if TYPE_CHECKING:
+    import numpy
+
+    from video_transformer.cache import MetadataCache, OutputCache
 
 LOGGER = getLogger(__name__)
 
-FFMPEG: Optional[str] = find_executable("ffmpeg")
 
-#: Regex used to parse progress lines with multiple key=value pairs
-PROGRESS_RE: Pattern = re.compile(r"(\w+)=\s*([^ ]+) ?")
+@lru_cache(maxsize=None)
+def ffmpeg_executable() -> Optional[str]:
+    """Path of the ffmpeg executable, looked up in the PATH on first use"""
+    return shutil.which("ffmpeg")
+
+
+def parse_frame_rate(as_str: str) -> Optional[float]:
+    """Parses a frame rate in NUM/DEN format, returns None if unknown (0/0)"""
+    num, _, den = as_str.partition("/")
+    return float(num) / float(den or 1) if float(den or 1) and float(num) else None
+
+
+def default_output_file(input_file: Path, speed: float, fmt: "Format") -> Path:
+    """Where to write a processed video by default: <input file name>.<speed>.<extension>"""
+    return input_file.with_suffix(f".{speed}.{fmt.extension}")
+
+
+def split_segments(keyframes: Sequence[float], duration: float,
+                   count: int) -> List[Tuple[float, Optional[float]]]:
+    """
+    Splits a video of the given duration in at most `count` segments of similar durations,
+    each one starting on one of the given (sorted) keyframe timestamps.
+    Returns (start, end) tuples, the last segment's end being None.
+    """
+    starts: List[float] = [0.0]
+    for i in range(1, count):
+        target = duration * i / count
+        idx = bisect_left(keyframes, target)
+        # Closest keyframe to the ideal split point
+        nearest = min(keyframes[max(idx - 1, 0):idx + 1], key=lambda k: abs(k - target),
+                      default=None)
+        if nearest is not None and nearest > starts[-1]:
+            starts.append(nearest)
+    return list(zip(starts, [*starts[1:], None]))
+
+
+def temporary_directory(to: Path) -> "TemporaryDirectory[str]":
+    """
+    Hidden temporary directory next to `to`, on the same filesystem, so that the files written
+    there can be moved to `to` atomically and without copying them.
+    """
+    return TemporaryDirectory(prefix=f".{to.name}.", suffix=".tmp", dir=to.parent)
 
 
-def parse_timestamp(as_str: str) -> datetime.timedelta:
-    """Parses a timestamp in HH:MM:SS format"""
-    kwargs = dict(zip(
-        ("hours", "minutes", "seconds"),
-        map(int, as_str.split(".")[0].split(":"))
-    ))
-    return datetime.timedelta(days=0, **kwargs)
+def resume_directory(to: Path) -> Path:
+    """
+    Hidden directory next to `to` where a resumable encode keeps its pieces and journal,
+    until the output is complete.
+    """
+    return to.with_name(f".{to.name}.resume")
 
 
-def parse_speed(as_str: str) -> float:
-    """Parses a speed in N.NNx format"""
-    return float(as_str.rstrip("x"))
+def fsync_path(path: Path):
+    """Flushes a file, or the entries of a directory, to the disk"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_concat_list(path: Path, files: Sequence[Path],
+                      durations: Optional[Sequence[Optional[float]]] = None):
+    """
+    Writes the list of files to join with ffmpeg's concat demuxer. The `durations` of the files,
+    when known, make each one start right after the previous one whatever its container says.
+    """
+    lines: List[str] = []
+    for idx, file in enumerate(files):
+        lines.append("file '{}'\n".format(str(file).replace("'", "'\\''")))
+        if durations and durations[idx] is not None:
+            lines.append(f"duration {durations[idx]}\n")
+    path.write_text("".join(lines))
+
+
+def smart_cut_pieces(keyframes: Sequence[float], start: float, end: Optional[float],
+                     tolerance: float = 0.001) -> List[Tuple[float, Optional[float], bool]]:
+    """
+    Splits the part of a video between `start` and `end` (None for the end of the video) in
+    pieces that can be copied without re-encoding, being whole groups of pictures starting on
+    one of the given (sorted) keyframe timestamps, and pieces to re-encode at the boundaries.
+    Returns (start, end, copy) tuples, the last one's end being None if `end` is.
+    """
+    first = bisect_left(keyframes, start - tolerance)
+    if first == len(keyframes):
+        return [(start, end, False)]
+    copy_start: float = keyframes[first]
+    copy_end: Optional[float] = end
+    if end is not None:
+        last = bisect_right(keyframes, end + tolerance) - 1
+        if end - keyframes[last] > tolerance:
+            copy_end = keyframes[last]
+        if copy_end is not None and copy_end <= copy_start:
+            # No whole group of pictures
+            return [(start, end, False)]
+    pieces: List[Tuple[float, Optional[float], bool]] = []
+    if copy_start - start > tolerance:
+        pieces.append((start, copy_start, False))
+    pieces.append((copy_start, copy_end, True))
+    if copy_end is not None and copy_end != end:
+        pieces.append((copy_end, end, False))
+    return pieces
 
 
 def unbuffer_fd(fileno: int):
@@ -48,28 +151,140 @@ class VideoError(Exception):
     """Raised when a video cannot be processed"""
 
 
-@dataclass
 class Progress:
-    fps: float
-    size: str
-    time: datetime.timedelta
-    bitrate: str
-    speed: Optional[float] = None  # Not always available
-
-    #: Which function to use to parse which field in from_raw_dict()
-    _PARSERS: ClassVar[Dict[str, Callable[[str], Any]]] = {
-        "fps": float,
-        "time": parse_timestamp,
-        "speed": parse_speed,
-    }
+    """Progress of a ffmpeg process, as reported on its `-progress` channel"""
+    __slots__ = ("frame", "fps", "bitrate", "total_size", "out_time_us",
+                 "dup_frames", "drop_frames", "speed", "done")
+
+    def __init__(self, frame: int = 0, fps: float = 0.0, bitrate: Optional[float] = None,
+                 total_size: int = 0, out_time_us: int = 0, dup_frames: int = 0,
+                 drop_frames: int = 0, speed: Optional[float] = None, done: bool = False):
+        #: Number of frames written
+        self.frame = frame
+        #: Encoding frames per second
+        self.fps = fps
+        #: Output bitrate in kbit/s, not always available
+        self.bitrate = bitrate
+        #: Bytes written to the output
+        self.total_size = total_size
+        #: Output position, in microseconds
+        self.out_time_us = out_time_us
+        #: Duplicated and dropped frames
+        self.dup_frames = dup_frames
+        self.drop_frames = drop_frames
+        #: Realtime factor, not always available
+        self.speed = speed
+        #: Whether this is the last progress report of the process
+        self.done = done
+
+    @property
+    def time(self) -> datetime.timedelta:
+        """Output position"""
+        return datetime.timedelta(microseconds=self.out_time_us)
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Progress):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def as_dict(self) -> Dict[str, Any]:
+        """JSON serializable representation"""
+        return {name: getattr(self, name) for name in self.__slots__}
 
     @classmethod
-    def from_raw_dict(cls, data: Dict[str, str]):
-        """Creates a new `Progress` instance from a raw unparsed dict."""
-        print(data)
-        return cls(**{field: cls._PARSERS.get(field, str)(data[field])
-                      for field in cls.__dataclass_fields__  # type: ignore
-                      if field in data})
+    def from_dict(cls, data: Dict[str, Any]) -> "Progress":
+        """Creates a new instance from its `as_dict()` representation"""
+        return cls(**{name: data[name] for name in cls.__slots__ if name in data})
+
+    @classmethod
+    def merge(cls, progresses: Sequence["Progress"]) -> "Progress":
+        """
+        Merges the progress of several ffmpeg processes working on parts of the same output.
+        Counters, times and speeds add up, the bitrate is recomputed from the totals.
+        """
+        total_size = sum(p.total_size for p in progresses)
+        out_time_us = sum(p.out_time_us for p in progresses)
+        speeds = [p.speed for p in progresses if p.speed is not None]
+        return cls(
+            frame=sum(p.frame for p in progresses),
+            fps=sum(p.fps for p in progresses),
+            bitrate=total_size * 8 / 1000 / (out_time_us / 1e6) if out_time_us else None,
+            total_size=total_size,
+            out_time_us=out_time_us,
+            dup_frames=sum(p.dup_frames for p in progresses),
+            drop_frames=sum(p.drop_frames for p in progresses),
+            speed=sum(speeds) if speeds else None,
+            done=all(p.done for p in progresses),
+        )
+
+
+class ProgressParser:
+    """
+    Incremental parser for ffmpeg's `-progress` output, which is made of blocks of key=value
+    lines, each block being terminated by a `progress=continue|end` line.
+    """
+    __slots__ = ("_buffer",)
+
+    #: Matches a whole progress block, its keys are always written in the same order
+    _BLOCK_RE: ClassVar[Pattern] = re.compile(
+        rb"frame=(\S+)\nfps=(\S+)\n(?:stream_\w+=\S*\n)*bitrate=\s*(\S+)\n"
+        rb"total_size=(\S+)\nout_time_us=(\S+)\n(?:out_time\w*=\S*\n)*"
+        rb"dup_frames=(\S+)\ndrop_frames=(\S+)\nspeed=\s*(\S+)\nprogress=(\w+)\n"
+    )
+    #: Matches a single key=value line, for blocks that do not match `_BLOCK_RE`
+    _FIELD_RE: ClassVar[Pattern] = re.compile(rb"^(\w+)=\s*(\S*)", re.M)
+    #: Fields captured by `_BLOCK_RE`, in order
+    _FIELDS: ClassVar[Tuple[bytes, ...]] = (
+        b"frame", b"fps", b"bitrate", b"total_size", b"out_time_us",
+        b"dup_frames", b"drop_frames", b"speed", b"progress",
+    )
+
+    def __init__(self):
+        self._buffer = b""
+
+    def feed(self, data: bytes) -> List[Progress]:
+        """Parses a chunk of output, returns the progress blocks it completed"""
+        buffer = self._buffer + data
+        records: List[Progress] = []
+        pos = 0
+        while True:
+            match = self._BLOCK_RE.match(buffer, pos)
+            if match:
+                records.append(self._build(*match.groups()))
+                pos = match.end()
+                continue
+            # Unexpected layout, or incomplete block
+            end = buffer.find(b"\n", buffer.find(b"progress=", pos))
+            if end < 0 or b"progress=" not in buffer[pos:end]:
+                break
+            fields = dict(self._FIELD_RE.findall(buffer, pos, end))
+            records.append(self._build(*map(fields.get, self._FIELDS)))
+            pos = end + 1
+        self._buffer = buffer[pos:]
+        return records
+
+    @staticmethod
+    def _build(frame: Optional[bytes], fps: Optional[bytes], bitrate: Optional[bytes],
+               total_size: Optional[bytes], out_time_us: Optional[bytes],
+               dup_frames: Optional[bytes], drop_frames: Optional[bytes],
+               speed: Optional[bytes], progress: Optional[bytes]) -> Progress:
+        """Creates a `Progress` from the raw values of a block"""
+        return Progress(
+            frame=int(frame or 0),
+            fps=float(fps or 0),
+            bitrate=float(bitrate[:-7]) if bitrate and bitrate.endswith(b"kbits/s") else None,
+            total_size=int(total_size) if total_size and total_size.isdigit() else 0,
+            # Unknown timestamps are reported as N/A or a large negative number
+            out_time_us=int(out_time_us) if out_time_us and out_time_us.isdigit() else 0,
+            dup_frames=int(dup_frames or 0),
+            drop_frames=int(drop_frames or 0),
+            speed=float(speed[:-1]) if speed and speed.endswith(b"x") else None,
+            done=progress == b"end",
+        )
 
 
 @dataclass
@@ -83,41 +298,418 @@ class VideoMetadata:
     duration: datetime.timedelta
     #: Resolution
     resolution: Optional[Tuple[int, int]]
+    #: Average frames per second
+    frame_rate: Optional[float] = None
+    #: Codec of the first audio stream, None without audio
+    audio_codec: Optional[str] = None
+
+    def as_dict(self) -> Dict[str, Any]:
+        """JSON serializable representation"""
+        return {
+            "codec": self.codec,
+            "pixel_format": self.pixel_format,
+            "duration": self.duration.total_seconds(),
+            "resolution": list(self.resolution) if self.resolution else None,
+            "frame_rate": self.frame_rate,
+            "audio_codec": self.audio_codec,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "VideoMetadata":
+        """Creates a new instance from its `as_dict()` representation"""
+        return cls(
+            codec=data["codec"],
+            pixel_format=data["pixel_format"],
+            duration=datetime.timedelta(seconds=data["duration"]),
+            resolution=tuple(data["resolution"]) if data["resolution"] else None,  # type: ignore
+            frame_rate=data["frame_rate"],
+            audio_codec=data["audio_codec"],
+        )
+
+
+@lru_cache(maxsize=None)
+def available_encoders() -> FrozenSet[str]:
+    """Runs ffmpeg (blocking) to list the encoders it was built with"""
+    executable = ffmpeg_executable()
+    if not executable:
+        return frozenset()
+    try:
+        output = subprocess.run([executable, "-hide_banner", "-encoders"], stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, universal_newlines=True).stdout
+    except OSError as err:
+        LOGGER.warning("Cannot list the ffmpeg encoders: %s", err)
+        return frozenset()
+    # Encoders are listed after a ------ line, as " V....D name description"
+    _, _, encoders = output.partition("------")
+    return frozenset(line.split()[1] for line in encoders.splitlines() if len(line.split()) > 1)
 
 
 @unique
 class Format(Enum):
-    """Available output formats"""
+    """Available output formats, by encoder"""
     MP4 = "libx264"
+    HEVC = "libx265"
+    WEBM = "libvpx-vp9"
+    AV1 = "libsvtav1"
+
+    @property
+    def label(self) -> str:
+        """Human readable name"""
+        return FORMAT_INFO[self][0]
+
+    @property
+    def extension(self) -> str:
+        """Extension of the output files"""
+        return FORMAT_INFO[self][1]
+
+    @classmethod
+    def available(cls) -> List["Format"]:
+        """The formats whose encoder the local ffmpeg was built with"""
+        return [fmt for fmt in cls if fmt.value in available_encoders()]
+
+
+#: Human readable name and file extension of each format
+FORMAT_INFO: Dict[Format, Tuple[str, str]] = {
+    Format.MP4: ("H.264 (mp4)", "mp4"),
+    Format.HEVC: ("H.265 (mp4)", "mp4"),
+    Format.WEBM: ("VP9 (webm)", "webm"),
+    Format.AV1: ("AV1 (mp4)", "mp4"),
+}
+
+#: Codec written by the encoder of each format, as named by ffprobe
+FORMAT_CODECS: Dict[Format, str] = {
+    Format.MP4: "h264",
+    Format.HEVC: "hevc",
+    Format.WEBM: "vp9",
+    Format.AV1: "av1",
+}
+
+#: Container of the pieces of `FFmpegWrapper.trim()` for each codec, others use matroska.
+#: H.264 and H.265 frames are reordered, and matroska does not keep their decoding timestamps.
+PIECE_CONTAINERS: Dict[str, str] = {"h264": "mp4", "hevc": "mp4"}
+
+#: Audio encoder of each file extension
+AUDIO_CODECS: Dict[str, str] = {"mp4": "aac", "webm": "libopus"}
+
+#: Muxer options of each file extension, for outputs that can be read while they are written
+STREAMING_OPTIONS: Dict[str, Dict[str, Any]] = {
+    # Fragmented mp4, the index is written with each fragment instead of at the end
+    "mp4": {"f": "mp4", "movflags": "frag_keyframe+empty_moov+default_base_moof"},
+    "webm": {"f": "webm"},
+}
+
+
+@unique
+class Profile(Enum):
+    """Speed/quality trade-offs, from the fastest to the best"""
+    #: Several times faster than realtime, for a quick review
+    PREVIEW = "preview"
+    FAST = "fast"
+    BALANCED = "balanced"
+    #: Best quality, for the final output
+    ARCHIVAL = "archival"
+
+
+#: Encoder options of each profile, for each format
+PROFILES: Dict[Format, Dict[Profile, Dict[str, Any]]] = {
+    Format.MP4: {
+        Profile.PREVIEW: {"preset": "ultrafast", "crf": 28},
+        Profile.FAST: {"preset": "veryfast", "crf": 23},
+        Profile.BALANCED: {"preset": "medium", "crf": 20},
+        Profile.ARCHIVAL: {"preset": "slower", "crf": 17},
+    },
+    Format.HEVC: {
+        Profile.PREVIEW: {"preset": "ultrafast", "crf": 30},
+        Profile.FAST: {"preset": "veryfast", "crf": 26},
+        Profile.BALANCED: {"preset": "medium", "crf": 23},
+        Profile.ARCHIVAL: {"preset": "slow", "crf": 20},
+    },
+    # Constant quality mode needs a zero bitrate, speed is set by deadline & cpu-used
+    Format.WEBM: {
+        Profile.PREVIEW: {"deadline": "realtime", "cpu-used": 8, "crf": 40, "b:v": 0,
+                          "row-mt": 1},
+        Profile.FAST: {"deadline": "good", "cpu-used": 5, "crf": 36, "b:v": 0, "row-mt": 1},
+        Profile.BALANCED: {"deadline": "good", "cpu-used": 2, "crf": 32, "b:v": 0,
+                           "row-mt": 1},
+        Profile.ARCHIVAL: {"deadline": "good", "cpu-used": 0, "crf": 28, "b:v": 0,
+                           "row-mt": 1},
+    },
+    Format.AV1: {
+        Profile.PREVIEW: {"preset": 12, "crf": 45},
+        Profile.FAST: {"preset": 10, "crf": 38},
+        Profile.BALANCED: {"preset": 7, "crf": 32},
+        Profile.ARCHIVAL: {"preset": 4, "crf": 26},
+    },
+}
+
+
+#: x264/x265 presets, from the fastest to the slowest
+X264_PRESETS: Tuple[str, ...] = ("ultrafast", "superfast", "veryfast", "faster", "fast",
+                                 "medium", "slow", "slower", "veryslow")
+
+#: Encoder speed settings of each format, from the fastest to the slowest
+SPEED_LADDERS: Dict[Format, List[Dict[str, Any]]] = {
+    Format.MP4: [{"preset": preset} for preset in X264_PRESETS],
+    Format.HEVC: [{"preset": preset} for preset in X264_PRESETS],
+    Format.WEBM: [
+        *({"deadline": "realtime", "cpu-used": cpu_used} for cpu_used in (8, 7, 6)),
+        *({"deadline": "good", "cpu-used": cpu_used} for cpu_used in (5, 4, 3, 2, 1, 0)),
+    ],
+    Format.AV1: [{"preset": preset} for preset in range(13, -1, -1)],
+}
+
+
+@dataclass
+class Target:
+    """How fast a video must be processed, for `FFmpegWrapper.tune()`"""
+    #: Maximum processing time for the whole video
+    deadline: Optional[datetime.timedelta] = None
+    #: Minimum realtime factor, in seconds of input processed per second
+    min_speed: Optional[float] = None
+
+    def input_rate(self, duration: datetime.timedelta) -> float:
+        """Seconds of input to process per second to meet the target, for a video this long"""
+        rate = self.min_speed or 0.0
+        if self.deadline:
+            rate = max(rate, duration / self.deadline)
+        return rate
+
+
+@unique
+class Timelapse(Enum):
+    """How frames are dropped when speeding a video up"""
+    #: Decode every frame and change its timestamp, the frames in excess are dropped by the
+    #: encoder. Best quality, but slow for high speed-ups.
+    NONE = "none"
+    #: Drop the frames in excess with the fps filter before doing anything else with them
+    DROP = "drop"
+    #: Only decode keyframes, which is much cheaper when the speed-up is higher than the
+    #: interval between keyframes
+    KEYFRAMES = "keyframes"
+    #: Choose a strategy depending on the speed-up and the video
+    AUTO = "auto"
+
+
+@dataclass
+class Output:
+    """One of the videos written by `FFmpegWrapper.process_many()`"""
+    to: Path
+    by: float = 2.0
+    fmt: Format = Format.MP4
+    profile: Profile = Profile.ARCHIVAL
+    #: Output (width, height), -2 for one of them keeps the aspect ratio. None keeps the input's
+    resolution: Optional[Tuple[int, int]] = None
+    #: Whether the output file was written, once processed
+    written: bool = False
+    #: Why the output file was not written, if it was not
+    error: Optional[str] = None
+
+
+class Operation:
+    """
+    A change to a video, composed with others by `FFmpegWrapper.apply()` into a single filter
+    graph. Times are relative to the video as changed by the previous operations.
+    """
+
+    def video(self, stream: Any) -> Any:
+        """Applies the operation to a ffmpeg-python video stream"""
+        return stream
+
+    def audio(self, stream: Any) -> Any:
+        """Applies the operation to a ffmpeg-python audio stream"""
+        return stream
+
+    def metadata(self, metadata: VideoMetadata) -> VideoMetadata:
+        """Metadata of a video with the given metadata, once changed by the operation"""
+        return metadata
+
+
+@dataclass
+class Trim(Operation):
+    """Keeps the part of the video between `start` and `end` seconds (the end by default)"""
+    start: float = 0.0
+    end: Optional[float] = None
+
+    def _options(self) -> Dict[str, float]:
+        return {"start": self.start, **({"end": self.end} if self.end is not None else {})}
+
+    def video(self, stream: Any) -> Any:
+        return stream.trim(**self._options()).setpts("PTS-STARTPTS")
+
+    def audio(self, stream: Any) -> Any:
+        return stream.filter("atrim", **self._options()).filter("asetpts", "PTS-STARTPTS")
+
+    def metadata(self, metadata: VideoMetadata) -> VideoMetadata:
+        end = metadata.duration.total_seconds()
+        if self.end is not None:
+            end = min(end, self.end)
+        return replace(metadata, duration=datetime.timedelta(seconds=max(end - self.start, 0)))
+
+
+@dataclass
+class Crop(Operation):
+    """Keeps a `width` x `height` rectangle, at (`x`, `y`) or centered by default"""
+    width: int
+    height: int
+    x: Optional[int] = None
+    y: Optional[int] = None
+
+    def video(self, stream: Any) -> Any:
+        options = {"w": self.width, "h": self.height}
+        if self.x is not None:
+            options["x"] = self.x
+        if self.y is not None:
+            options["y"] = self.y
+        return stream.filter("crop", **options)
+
+    def metadata(self, metadata: VideoMetadata) -> VideoMetadata:
+        return replace(metadata, resolution=(self.width, self.height))
+
+
+@dataclass
+class Scale(Operation):
+    """
+    Resizes the video. A negative `width` or `height` keeps the aspect ratio, the value being
+    rounded to a multiple of its absolute value (-2 for encoders requiring even sizes).
+    """
+    width: int
+    height: int
+
+    def video(self, stream: Any) -> Any:
+        return stream.filter("scale", self.width, self.height)
+
+    def metadata(self, metadata: VideoMetadata) -> VideoMetadata:
+        if not metadata.resolution:
+            return metadata
+        in_width, in_height = metadata.resolution
+        width, height = self.width or in_width, self.height or in_height
+        # Same as ffmpeg's scale filter
+        if width < 0 and height < 0:
+            width, height = in_width, in_height
+        if width < 0:
+            width = round(height * in_width / (in_height * -width)) * -width
+        elif height < 0:
+            height = round(width * in_height / (in_width * -height)) * -height
+        return replace(metadata, resolution=(width, height))
+
+
+@dataclass
+class Fps(Operation):
+    """Changes the frame rate, dropping or duplicating frames"""
+    fps: float
+
+    def video(self, stream: Any) -> Any:
+        return stream.filter("fps", fps=self.fps)
+
+    def metadata(self, metadata: VideoMetadata) -> VideoMetadata:
+        return replace(metadata, frame_rate=self.fps)
+
+
+@dataclass
+class Speed(Operation):
+    """Speeds the video up `by` times (slows it down if below 1), audio included"""
+    by: float
+
+    #: Tempo range of a single atempo filter
+    ATEMPO_RANGE: ClassVar[Tuple[float, float]] = (0.5, 2.0)
+
+    def video(self, stream: Any) -> Any:
+        return stream.setpts(f"{1/self.by}*PTS")
+
+    def audio(self, stream: Any) -> Any:
+        # Chain atempo filters within their supported range
+        low, high = self.ATEMPO_RANGE
+        tempo = self.by
+        while tempo > high or tempo < low:
+            step = high if tempo > high else low
+            stream = stream.filter("atempo", step)
+            tempo /= step
+        return stream.filter("atempo", tempo) if tempo != 1 else stream
+
+    def metadata(self, metadata: VideoMetadata) -> VideoMetadata:
+        return replace(metadata, duration=metadata.duration / self.by)
+
+
+def output_metadata(metadata: VideoMetadata,
+                    operations: Sequence[Operation]) -> VideoMetadata:
+    """Metadata of a video with the given metadata, once changed by the operations"""
+    for operation in operations:
+        metadata = operation.metadata(metadata)
+    return metadata
+
+
+#: Thread pool used by `FFmpegWrapper.open_in_background()`, created on first use
+_PROBE_EXECUTOR: Optional[ThreadPoolExecutor] = None
 
 
 class FFmpegWrapper:
-    #: Human readable representation of the available output formats
-    FORMATS: ClassVar[Dict[str, str]] = {
-        "mp4": "libx264",
-    }
+    #: Input seconds encoded to measure the speed of an encoder setting in `tune()`
+    CALIBRATION_WINDOW: ClassVar[float] = 10.0
+    #: `tune()` aims this much faster than the target, for the calibration time and variance
+    TUNING_MARGIN: ClassVar[float] = 1.1
+    #: Speed-ups below which `Timelapse.AUTO` decodes every frame
+    TIMELAPSE_MIN_SPEED: ClassVar[float] = 4.0
+    #: Input seconds per piece of resumable encodes, at worst lost when they are interrupted
+    CHECKPOINT_INTERVAL: ClassVar[float] = 60.0
+    #: Human readable representation of the output formats
+    FORMATS: ClassVar[Dict[str, str]] = {fmt.label: fmt.value for fmt in Format}
 
-    def __init__(self, input_file: Path):
+    def __init__(self, input_file: Path, metadata: Optional[VideoMetadata] = None,
+                 cache: Optional["MetadataCache"] = None,
+                 output_cache: Optional["OutputCache"] = None):
         assert input_file.exists()
         self.input_file = input_file
-        self.metadata: VideoMetadata = self.fetch_video_metadata()
+        self.cache = cache
+        #: Where `process()` looks for outputs before encoding, and stores them after
+        self.output_cache = output_cache
+        self.metadata: VideoMetadata = metadata or self.fetch_video_metadata()
+        self._keyframes: Optional[List[float]] = None
         self.returncode: Optional[int] = None
-        self.ffmpeg: Optional[subprocess.Popen] = None
+        self.ffmpeg: Optional[FFmpegProcess] = None
+        #: ffmpeg processes encoding segments in parallel mode
+        self.workers: List[FFmpegProcess] = []
+        #: What the last `process()` took, None after the other operations, which are not
+        #: reported
+        self.report: Optional[JobReport] = None
+        #: ffmpeg processes that exited since the current operation started
+        self._reaped: List[FFmpegProcess] = []
+        self._stopping = False
 
-    @staticmethod
-    def process_logs(lines: Sequence[str]) -> Optional[Progress]:
-        """Parses log lines and try to find the most recent progress log"""
-        for line in reversed(lines):
-            raw_status = dict(PROGRESS_RE.findall(line))
-            if raw_status:
-                LOGGER.debug(raw_status)
-                try:
-                    return Progress.from_raw_dict(raw_status)
-                except (TypeError, ValueError) as ver:
-                    LOGGER.debug("Invalid log line %r: %s", line, ver)
+    @classmethod
+    def open_in_background(cls, input_file: Path,
+                           cache: Optional["MetadataCache"] = None) -> "Future[FFmpegWrapper]":
+        """
+        Creates a wrapper for the given file in a background thread, so that probing a big or
+        remote file does not block the caller. The future raises `VideoError` if it cannot be
+        processed.
+        """
+        global _PROBE_EXECUTOR
+        if _PROBE_EXECUTOR is None:
+            _PROBE_EXECUTOR = ThreadPoolExecutor(thread_name_prefix="video-transformer-probe")
+        return _PROBE_EXECUTOR.submit(cls, input_file, cache=cache)
+
+    @property
+    def stopping(self) -> bool:
+        """Whether `stop()` was called during the current operation"""
+        return self._stopping
 
     def fetch_video_metadata(self) -> VideoMetadata:
-        """Runs ffpmpeg (blocking) to get the video's metadata"""
+        """
+        Runs ffpmpeg (blocking) to get the video's metadata.
+        If the wrapper has a cache, it is looked up first and updated after probing.
+        """
+        if self.cache is not None:
+            cached = self.cache.get(self.input_file)
+            if cached:
+                return cached
+        metadata = self._probe_metadata()
+        if self.cache is not None:
+            self.cache.put(self.input_file, metadata)
+        return metadata
+
+    def _probe_metadata(self) -> VideoMetadata:
+        """Runs ffprobe (blocking) on the input file"""
+        import ffmpeg  # type: ignore
         try:
             probe: dict = ffmpeg.probe(str(self.input_file))
         except ffmpeg.Error as err:
@@ -126,70 +718,1275 @@ class FFmpegWrapper:
             filter(lambda y: y.get("codec_type") == "video", probe["streams"])
         )
         if not video_streams:
-            raise VideoError("No video streams found in {self.input_file}")
+            raise VideoError(f"No video streams found in {self.input_file}")
         if len(video_streams) > 1:
             LOGGER.warning("More than one video stream in %s, using the first one", self.input_file)
         video_stream: Dict[str, str] = video_streams[0]
-        return VideoMetadata(
-            codec=video_stream["codec_name"],
-            pixel_format=video_stream["pix_fmt"],
-            duration=datetime.timedelta(seconds=float(probe["format"]["duration"])),
-            resolution=(int(video_stream['width']), int(video_stream['height'])),
-        )
+        audio_stream: Dict[str, str] = next((stream for stream in probe["streams"]
+                                             if stream.get("codec_type") == "audio"), {})
+        try:
+            return VideoMetadata(
+                codec=video_stream["codec_name"],
+                pixel_format=video_stream["pix_fmt"],
+                duration=datetime.timedelta(seconds=float(probe["format"]["duration"])),
+                resolution=(int(video_stream['width']), int(video_stream['height'])),
+                frame_rate=parse_frame_rate(video_stream.get("avg_frame_rate", "0/0"))
+                or parse_frame_rate(video_stream.get("r_frame_rate", "0/0")),
+                audio_codec=audio_stream.get("codec_name"),
+            )
+        except KeyError as err:
+            # e.g. raw streams have no duration
+            raise VideoError(f"No {err.args[0]} found in {self.input_file}")
+        except ValueError as err:
+            raise VideoError(f"Invalid metadata in {self.input_file}: {err}")
+
+    def keyframes(self) -> List[float]:
+        """
+        Lists the video's keyframe timestamps, in seconds from the start of the file.
+        They are probed once (blocking), then kept by the wrapper and its cache if it has one.
+        """
+        if self._keyframes is None and self.cache is not None:
+            self._keyframes = self.cache.get_keyframes(self.input_file)
+        if self._keyframes is None:
+            self._keyframes = self._probe_keyframes()
+            if self.cache is not None:
+                self.cache.put_keyframes(self.input_file, self._keyframes)
+        return list(self._keyframes)
+
+    def _probe_keyframes(self) -> List[float]:
+        """
+        Runs ffprobe (blocking) to list the video's keyframe timestamps.
+        Only reads packet headers, nothing is decoded.
+        """
+        import ffmpeg
+        try:
+            probe: dict = ffmpeg.probe(str(self.input_file), select_streams="v:0",
+                                       show_entries="packet=pts_time,flags:format=start_time")
+        except ffmpeg.Error as err:
+            raise VideoError(err.stderr.splitlines()[-1].decode())
+        start_time = float(probe["format"].get("start_time", 0))
+        return sorted(float(packet["pts_time"]) - start_time
+                      for packet in probe.get("packets", ())
+                      if packet.get("flags", "").startswith("K")
+                      and packet.get("pts_time", "N/A") != "N/A")
+
+    def timelapse_strategy(self, by: float) -> Timelapse:
+        """
+        Chooses how to drop frames when speeding the video up `by` times:
+        - below `TIMELAPSE_MIN_SPEED`, or with an unknown frame rate, every frame is decoded
+        - if at most one frame per keyframe interval is needed, only keyframes are decoded
+        - otherwise, the frames in excess are dropped right after decoding
+        """
+        if by < self.TIMELAPSE_MIN_SPEED or not self.metadata.frame_rate:
+            return Timelapse.NONE
+        keyframes = self.keyframes()
+        if len(keyframes) > 1:
+            # Average number of frames between two keyframes
+            gop = (keyframes[-1] - keyframes[0]) / (len(keyframes) - 1) * self.metadata.frame_rate
+            if by >= gop:
+                return Timelapse.KEYFRAMES
+        return Timelapse.DROP
+
+    def tune(self, target: Target, by: float = 2.0, fmt: Format = Format.MP4,
+             profile: Profile = Profile.ARCHIVAL, timelapse: Timelapse = Timelapse.NONE,
+             threads: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """
+        Finds the slowest (best quality) encoder settings that still meet the target, by
+        encoding the beginning of the video with candidate settings (blocking). Settings slower
+        than the profile's are not considered.
+        Returns encoder options overriding the profile's, or None if stopped or if ffmpeg failed.
+        """
+        required = target.input_rate(self.metadata.duration) * self.TUNING_MARGIN
+        ladder = SPEED_LADDERS[fmt]
+        profile_options = PROFILES[fmt][profile].items()
+        slowest = next((idx for idx, step in reversed(list(enumerate(ladder)))
+                        if step.items() <= profile_options), len(ladder) - 1)
+        # Binary search of the slowest setting that is fast enough
+        best, low, high = 0, 0, slowest
+        while low <= high:
+            middle = (low + high) // 2
+            rate = self._calibrate(ladder[middle], by, fmt, profile, timelapse, threads)
+            if rate is None:
+                return None
+            LOGGER.debug("%s: %.2fx realtime (%.2fx required)", ladder[middle], rate, required)
+            if rate >= required:
+                best, low = middle, middle + 1
+            else:
+                high = middle - 1
+        if low == 0:
+            # Even the fastest setting is too slow
+            LOGGER.warning("%s cannot be processed at %.2fx realtime, using the fastest settings",
+                           self.input_file, required)
+        return dict(ladder[best])
+
+    def _calibrate(self, encoder_options: Dict[str, Any], by: float, fmt: Format,
+                   profile: Profile, timelapse: Timelapse,
+                   threads: Optional[int]) -> Optional[float]:
+        """
+        Encodes the beginning of the video with the given settings, discarding the output.
+        Returns the input seconds processed per second, or None if ffmpeg did not succeed.
+        """
+        window = min(self.CALIBRATION_WINDOW, self.metadata.duration.total_seconds())
+        options: Dict[str, Any] = {"threads": threads} if threads else {}
+        start = time.perf_counter()
+        self.ffmpeg = FFmpegProcess(self._encode_args(
+            Path(os.devnull), by, fmt, {"t": window}, timelapse, profile,
+            f="null", **encoder_options, **options
+        ))
+        for _ in self._ffmpeg_loop(self.ffmpeg):
+            pass
+        if self.ffmpeg.returncode != 0:
+            return None
+        return window / (time.perf_counter() - start)
 
     def stop(self):
         """
-        Sends a stop signal the running ffmpeg process.
-        Raises `RuntimeError` if ffmpeg is not running.
+        Sends a stop signal the running ffmpeg process(es).
+        Raises `RuntimeError` if ffmpeg is not running, the operation in progress, if any, still
+        stops before starting the next one.
         """
-        if not self.ffmpeg:
+        self._stopping = True
+        if not self.ffmpeg and not self.workers:
             raise RuntimeError("ffmpeg is not running")
-        self.ffmpeg.send_signal(signal.SIGINT)
+        for process in (self.ffmpeg, *self.workers):
+            if process:
+                process.interrupt()
+
+    def process(self, to: Path, by: float = 2.0, fmt: Format = Format.MP4,
+                jobs: int = 1, threads: Optional[int] = None,
+                timelapse: Timelapse = Timelapse.NONE,
+                profile: Profile = Profile.ARCHIVAL,
+                target: Optional[Target] = None,
+                resumable: bool = False, copy: bool = False) -> Iterable[Progress]:
+        """
+        Runs ffmpeg (blocking). Yields `Progress` instances when logs are received.
+        With `jobs` > 1, the video is split at keyframes in up to `jobs` segments which are
+        encoded by as many parallel ffmpeg processes, then joined without re-encoding.
+        `threads` limits the number of threads used by the decoder, filters and encoder of each
+        ffmpeg process, by default ffmpeg uses all the cores. `timelapse` chooses how frames are
+        dropped for high speed-ups.
+        `profile` chooses the encoding speed/quality trade-off. With a `target`, the encoder
+        settings are first tuned to meet it (see `tune()`), the profile being the best case.
+        If the output is found in the wrapper's `output_cache`, it is not encoded again and a
+        single, completed `Progress` is yielded.
+        With `copy`, a video already in `fmt`'s codec is copied instead of re-encoded if its
+        speed does not change, whatever the other options, bypassing the output cache: a cached
+        copy would not be faster, only take room.
+        A `resumable` encode is done in pieces of about `CHECKPOINT_INTERVAL` seconds, kept in
+        `resume_directory(to)` when it is stopped or fails, so that processing the same video
+        to the same output again only encodes the missing pieces.
+        Once done, what it took is described by `report`.
+        """
+        report = self._start_report(to)
+        if copy and by == 1 and FORMAT_CODECS[fmt] == self.metadata.codec:
+            # Nothing to encode, copying the video stream is as fast as the output cache, which
+            # is neither looked up nor filled
+            LOGGER.debug("Remuxing %s without re-encoding it", self.input_file)
+            progresses = self._remux(to)
+        else:
+            progresses = self._process(to, by, fmt, jobs, threads, timelapse, profile, target,
+                                       resumable)
+        start = time.perf_counter()
+        try:
+            for progress in progresses:
+                report.samples.append(self._sample(time.perf_counter() - start, progress))
+                yield progress
+        finally:
+            self._end_report(report, to, time.perf_counter() - start)
 
-    def process(self, to: Path, by: float = 2.0, fmt: Format = Format.MP4) -> Iterable[Progress]:
-        """Runs ffmpeg (blocking). Yields `Progress` instances when logs are received."""
+    def _start_report(self, to: Path) -> JobReport:
+        """Starts a new `report`, of processing the input to `to`"""
+        self.report = JobReport(
+            input_file=str(self.input_file), output_file=str(to), started=time.time(),
+            input_size=self.input_file.stat().st_size,
+            input_duration=self.metadata.duration.total_seconds(),
+        )
+        self._reaped = []
+        return self.report
+
+    @staticmethod
+    def _sample(elapsed: float, progress: Progress) -> Sample:
+        """Sample of a report, for a progress reported after `elapsed` seconds"""
+        return Sample(time=elapsed, position=progress.time.total_seconds(), fps=progress.fps,
+                      speed=progress.speed, bitrate=progress.bitrate)
+
+    def _end_report(self, report: JobReport, to: Path, elapsed: float):
+        """Completes a report once processing is over, after `elapsed` seconds"""
+        report.wall_time = elapsed
+        report.returncode = self.returncode
+        if self.returncode == 0:
+            report.output_size = to.stat().st_size
+        for process in self._reaped:
+            if process.rusage is not None:
+                report.add_rusage(process.rusage)
+        self._reaped = []
+
+    def _process(self, to: Path, by: float, fmt: Format, jobs: int, threads: Optional[int],
+                 timelapse: Timelapse, profile: Profile, target: Optional[Target],
+                 resumable: bool) -> Iterable[Progress]:
+        """Implementation of `process()`"""
         try:
             # Clear previous returncode
             self.returncode = None
-            with TemporaryDirectory("video-transformer") as td:
-                temp_to = Path(td) / to.name
-                args: Tuple = (
-                    FFMPEG,
-                    *ffmpeg
-                    .input(str(self.input_file))
-                    .setpts(f"{1/by}*PTS")
-                    .output(str(temp_to), vcodec=fmt.value, preset="slower", crf=17)
-                    .get_args(overwrite_output=True)
-                )
-                # Start the ffmpeg process
-                self.ffmpeg = subprocess.Popen(
-                    args,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    universal_newlines=True
+            self._stopping = False
+            cache_key: Optional[str] = None
+            if self.output_cache is not None:
+                # Parameters that change the output, jobs and threads do not
+                cache_key = self.output_cache.key(
+                    self.input_file, by=by, fmt=fmt.value, profile=profile.value,
+                    timelapse=timelapse.value, target=target, container=to.suffix,
                 )
-                # Unbuffer stderr so we get output lines faster
-                unbuffer_fd(self.ffmpeg.stderr.fileno())
+                if self.output_cache.get(cache_key, to):
+                    LOGGER.debug("%s found in the output cache", to)
+                    self.returncode = 0
+                    yield self._cached_progress(to, by)
+                    return
+            if timelapse is Timelapse.AUTO:
+                timelapse = self.timelapse_strategy(by)
+                LOGGER.debug("Using the %s timelapse strategy", timelapse.value)
+            encoder_options: Dict[str, Any] = {}
+            if target:
+                tuned = self._tune_encode(target, by, fmt, profile, timelapse, threads)
+                if tuned is None:
+                    return
+                encoder_options = tuned
+            with temporary_directory(to) as td:
+                temp_to = Path(td) / to.name
+                yield from self._encode(temp_to, by, fmt, jobs, threads, timelapse, profile,
+                                        resume_directory(to) if resumable else None,
+                                        **encoder_options)
+                if self.returncode == 0:
+                    # if ffmpeg exited successfully, move the output file in place
+                    os.replace(temp_to, to)
+                    if resumable:
+                        shutil.rmtree(resume_directory(to), ignore_errors=True)
+                    if cache_key is not None:
+                        self._cache_output(cache_key, to)
+
+        finally:
+            # The process is not running anymore
+            self.ffmpeg = None
+            self.workers = []
+
+    def _tune_encode(self, target: Target, by: float, fmt: Format, profile: Profile,
+                     timelapse: Timelapse, threads: Optional[int]) -> Optional[Dict[str, Any]]:
+        """
+        Encoder options meeting `target`, see `tune()`. None if stopped while tuning, or once
+        tuned, or if ffmpeg failed, `returncode` being set accordingly.
+        """
+        tuned = self.tune(target, by, fmt, profile, timelapse, threads)
+        if tuned is None:
+            self.returncode = self.ffmpeg.returncode if self.ffmpeg else 255
+            return None
+        if self._stopping:
+            # Stopped after the calibration encodes, before the real one
+            self.returncode = 255
+            return None
+        return tuned
+
+    def _encode(self, to: Path, by: float, fmt: Format, jobs: int, threads: Optional[int],
+                timelapse: Timelapse, profile: Profile, resume_dir: Optional[Path],
+                **encoder_options: Any) -> Iterable[Progress]:
+        """Encodes the video in resumable pieces kept in `resume_dir`, in segments, or at once"""
+        if resume_dir is not None:
+            yield from self._process_pieces(to, resume_dir, by, fmt, jobs, threads, timelapse,
+                                            profile, **encoder_options)
+        elif jobs > 1:
+            yield from self._process_segments(to, by, fmt, jobs, threads, timelapse, profile,
+                                              **encoder_options)
+        else:
+            options: Dict[str, Any] = {"threads": threads} if threads else {}
+            options.update(encoder_options)
+            self.ffmpeg = FFmpegProcess(self._encode_args(
+                to, by, fmt, timelapse=timelapse, profile=profile, **options
+            ))
+            yield from self._ffmpeg_loop(self.ffmpeg)
+            self.returncode = self.ffmpeg.returncode
+
+    def _remux(self, to: Path) -> Iterable[Progress]:
+        """Copies the video and audio streams to `to` without re-encoding them"""
+        try:
+            # Clear previous returncode
+            self.returncode = None
+            self._stopping = False
+            with temporary_directory(to) as td:
+                temp_to = Path(td) / to.name
+                self.ffmpeg = FFmpegProcess([
+                    ffmpeg_executable(), "-i", str(self.input_file),
+                    "-map", "0:v", "-map", "0:a?", "-c", "copy", "-y", str(temp_to),
+                ])
                 yield from self._ffmpeg_loop(self.ffmpeg)
-                self.returncode = self.ffmpeg.poll()
+                self.returncode = self.ffmpeg.returncode
                 if self.returncode == 0:
-                    # if ffmpeg exited successfully, copy the output file
-                    temp_to.rename(to)
+                    os.replace(temp_to, to)
+        finally:
+            # The process is not running anymore
+            self.ffmpeg = None
+
+    def _cached_progress(self, output: Path, by: float) -> Progress:
+        """Progress of the encode of `output`, taken from the output cache"""
+        out_time_us = int(self.metadata.duration.total_seconds() / by * 1e6)
+        total_size = output.stat().st_size
+        frame_rate = self.metadata.frame_rate
+        return Progress(
+            frame=round(out_time_us / 1e6 * frame_rate) if frame_rate else 0,
+            bitrate=total_size * 8 / 1000 / (out_time_us / 1e6) if out_time_us else None,
+            total_size=total_size,
+            out_time_us=out_time_us,
+            done=True,
+        )
+
+    def _cache_output(self, key: str, output: Path):
+        """Stores an output in the output cache, failing to do so is not an error"""
+        assert self.output_cache is not None
+        try:
+            self.output_cache.put(key, output)
+        except OSError as err:
+            LOGGER.warning("Cannot store %s in the output cache: %s", output, err)
 
+    def stream(self, out: BinaryIO, by: float = 2.0, fmt: Format = Format.MP4,
+               threads: Optional[int] = None, timelapse: Timelapse = Timelapse.NONE,
+               profile: Profile = Profile.ARCHIVAL, matroska: bool = False) -> Iterable[Progress]:
+        """
+        Runs ffmpeg (blocking), writing the output to `out` while it is encoded, in a format that
+        can be read before the encode is done: fragmented mp4, webm, or matroska if `matroska`.
+        ffmpeg writes directly to pipes and files, other file-like objects get a copy.
+        Yields `Progress` instances when logs are received.
+        """
+        try:
+            # Clear previous returncode
+            self.returncode = None
+            self._stopping = False
+            self.report = None
+            self._reaped = []
+            if timelapse is Timelapse.AUTO:
+                timelapse = self.timelapse_strategy(by)
+                LOGGER.debug("Using the %s timelapse strategy", timelapse.value)
+            options: Dict[str, Any] = {"threads": threads} if threads else {}
+            options.update({"f": "matroska"} if matroska else STREAMING_OPTIONS[fmt.extension])
+            self.ffmpeg = FFmpegProcess(self._encode_args(
+                "pipe:1", by, fmt, timelapse=timelapse, profile=profile, **options
+            ), output=out)
+            yield from self._ffmpeg_loop(self.ffmpeg)
+            self.returncode = self.ffmpeg.returncode
         finally:
             # The process is not running anymore
             self.ffmpeg = None
 
-    @classmethod
-    def _ffmpeg_loop(cls, ffmpeg: subprocess.Popen) -> Iterable[Progress]:
-        """Waits for the given ffmpeg process to exit"""
-        while ffmpeg.poll() is None:
-            rlist, _, _ = select((ffmpeg.stderr, ffmpeg.stdout), (), ())
-            # Read logs from stdin
-            if ffmpeg.stderr in rlist:
-                status = cls.process_logs(ffmpeg.stderr.read().splitlines())
-                if status:
-                    yield status
-            # ignore stdout
-            if ffmpeg.stdout in rlist:
-                ffmpeg.stdout.read()
+    def apply(self, to: Path, operations: Sequence[Operation], fmt: Format = Format.MP4,
+              profile: Profile = Profile.ARCHIVAL, threads: Optional[int] = None,
+              audio: bool = True) -> Iterable[Progress]:
+        """
+        Runs ffmpeg (blocking), applying all the operations in order in a single filter graph,
+        with a single encode. The audio is kept (and changed accordingly) if `audio`.
+        Yields `Progress` instances when logs are received, see `output_metadata()` for the
+        duration of the result.
+        """
+        try:
+            # Clear previous returncode
+            self.returncode = None
+            self._stopping = False
+            self.report = None
+            self._reaped = []
+            with temporary_directory(to) as td:
+                temp_to = Path(td) / to.name
+                options: Dict[str, Any] = {"threads": threads} if threads else {}
+                self.ffmpeg = FFmpegProcess(self._apply_args(
+                    temp_to, operations, fmt, profile, audio, **options
+                ))
+                yield from self._ffmpeg_loop(self.ffmpeg)
+                self.returncode = self.ffmpeg.returncode
+                if self.returncode == 0:
+                    os.replace(temp_to, to)
+        finally:
+            # The process is not running anymore
+            self.ffmpeg = None
+
+    def trim(self, to: Path, start: float = 0.0, end: Optional[float] = None,
+             profile: Profile = Profile.ARCHIVAL, audio: bool = True) -> Iterable[Progress]:
+        """
+        Runs ffmpeg (blocking), keeping the part of the video between `start` and `end` seconds
+        (the end by default). The whole groups of pictures in between are copied, only the
+        partial ones at the edit points are re-encoded with `profile`, then all are joined.
+        The audio is re-encoded, if kept (`audio`). Videos in a codec that cannot be encoded
+        here are entirely re-encoded by `apply()`.
+        Yields `Progress` instances when logs are received.
+        """
+        fmt = next((fmt for fmt in Format.available()
+                    if FORMAT_CODECS[fmt] == self.metadata.codec), None)
+        if fmt is None:
+            LOGGER.warning("Cannot encode %s, %s will be entirely re-encoded",
+                           self.metadata.codec, self.input_file)
+            fmt = next((fmt for fmt in Format if fmt.extension == to.suffix[1:].lower()),
+                       Format.MP4)
+            yield from self.apply(to, [Trim(start, end)], fmt, profile, audio=audio)
+            return
+        try:
+            # Clear previous returncode
+            self.returncode = None
+            self._stopping = False
+            self.report = None
+            self._reaped = []
+            # Keyframe timestamps are rounded, half a frame tells them apart from the next frame
+            half_frame = 0.5 / (self.metadata.frame_rate or 25)
+            pieces = smart_cut_pieces(self.keyframes(), start, end, half_frame)
+            LOGGER.debug("Trimming %s in pieces: %s", self.input_file, pieces)
+            with temporary_directory(to) as td:
+                temp_to = Path(td) / to.name
+                piece_files: List[Path] = []
+                offset = size = 0
+                for idx, (piece_start, piece_end, copy) in enumerate(pieces):
+                    args, piece_file = self._piece_args(Path(td), idx, piece_start, piece_end,
+                                                        copy, fmt, profile, half_frame)
+                    self.ffmpeg = FFmpegProcess(args)
+                    for progress in self._ffmpeg_loop(self.ffmpeg):
+                        # Progress of the whole output, which is only done once joined
+                        progress.out_time_us += offset
+                        progress.total_size += size
+                        progress.done = progress.done and idx == len(pieces) - 1
+                        yield progress
+                    self.returncode = self.ffmpeg.returncode
+                    if self.returncode != 0:
+                        return
+                    if self._stopping:
+                        # stopped between two pieces
+                        self.returncode = 255
+                        return
+                    if piece_end is not None:
+                        offset += round((piece_end - piece_start) * 1e6)
+                    size += piece_file.stat().st_size
+                    piece_files.append(piece_file)
+                piece_list = Path(td) / "pieces.txt"
+                # The concat demuxer passes on the parameter sets of each piece, so that the
+                # re-encoded and the copied ones can be joined despite different settings
+                write_concat_list(piece_list, piece_files,
+                                  [None if piece_end is None else piece_end - piece_start
+                                   for piece_start, piece_end, _ in pieces])
+                self.ffmpeg = FFmpegProcess(
+                    self._join_args(temp_to, piece_list, start, end, audio)
+                )
+                # The join progress is not reported, it would go back in time
+                for _ in self._ffmpeg_loop(self.ffmpeg):
+                    pass
+                self.returncode = self.ffmpeg.returncode
+                if self.returncode == 0:
+                    os.replace(temp_to, to)
+        finally:
+            # The process is not running anymore
+            self.ffmpeg = None
+
+    def _piece_args(self, directory: Path, idx: int, start: float, end: Optional[float],
+                    copy: bool, fmt: Format, profile: Profile,
+                    half_frame: float) -> Tuple[List, Path]:
+        """Command line writing a piece of the trimmed video, copied or re-encoded, and its file"""
+        import ffmpeg
+        input_options: Dict[str, Any] = {"ss": start}
+        if end is not None:
+            input_options["t"] = end - start
+        stream = ffmpeg.input(str(self.input_file), **input_options).video
+        extension = PIECE_CONTAINERS.get(self.metadata.codec, "mkv")
+        piece_file = directory / f"piece{idx:04d}.{extension}"
+        if not copy:
+            # Frames are neither duplicated nor dropped, to line up with the copied ones
+            stream = stream.output(str(piece_file), vcodec=fmt.value, vsync="passthrough",
+                                   pix_fmt=self.metadata.pixel_format, **PROFILES[fmt][profile])
+        elif end is None:
+            stream = stream.output(str(piece_file), vcodec="copy")
+        else:
+            # Copying stops on decoding timestamps, which go past the next keyframe when frames
+            # are reordered: split right before that keyframe, and only keep the first part
+            piece_file = directory / f"piece{idx:04d}.0.{extension}"
+            stream = stream.output(str(directory / f"piece{idx:04d}.%d.{extension}"),
+                                   vcodec="copy", f="segment", segment_times=end - start,
+                                   segment_time_delta=half_frame)
+        return [ffmpeg_executable(), *stream.get_args(overwrite_output=True)], piece_file
+
+    def _join_args(self, to: Path, piece_list: Path, start: float, end: Optional[float],
+                   audio: bool) -> List:
+        """Command line joining the pieces of the trimmed video, with the audio if kept"""
+        import ffmpeg
+        streams = [ffmpeg.input(str(piece_list), f="concat", safe=0).video]
+        output_options: Dict[str, Any] = {"vcodec": "copy"}
+        if audio and self.metadata.audio_codec:
+            input_options: Dict[str, Any] = {"ss": start}
+            if end is not None:
+                input_options["t"] = end - start
+            streams.append(ffmpeg.input(str(self.input_file), **input_options).audio)
+            output_options["acodec"] = AUDIO_CODECS.get(to.suffix[1:].lower(), "aac")
+        return [
+            ffmpeg_executable(),
+            *ffmpeg
+            .output(*streams, str(to), **output_options)
+            .get_args(overwrite_output=True)
+        ]
+
+    def output_metadata(self, operations: Sequence[Operation]) -> VideoMetadata:
+        """Metadata of the video written by `apply()` with the given operations"""
+        return output_metadata(self.metadata, operations)
+
+    def _apply_args(self, to: Path, operations: Sequence[Operation], fmt: Format,
+                    profile: Profile, audio: bool, **output_options: Any) -> List:
+        """Command line applying the operations to the video"""
+        import ffmpeg
+        streams = self._operation_streams(operations, audio)
+        if len(streams) > 1:
+            output_options.setdefault("acodec", AUDIO_CODECS[fmt.extension])
+        return [
+            ffmpeg_executable(),
+            *ffmpeg
+            .output(*streams, str(to), vcodec=fmt.value,
+                    **{**PROFILES[fmt][profile], **output_options})
+            .get_args(overwrite_output=True)
+        ]
+
+    def _operation_streams(self, operations: Sequence[Operation], audio: bool,
+                           **input_options: Any) -> List:
+        """The video stream once the operations are applied, and the audio one if `audio`"""
+        import ffmpeg
+        trim = operations[0] if operations else None
+        if isinstance(trim, Trim):
+            # Seek in the input instead of decoding what is trimmed
+            operations = operations[1:]
+            input_options["ss"] = trim.start
+            if trim.end is not None:
+                input_options["t"] = trim.end - trim.start
+        source = ffmpeg.input(str(self.input_file), **input_options)
+        streams = [source.video]
+        if audio and self.metadata.audio_codec:
+            streams.append(source.audio)
+        for operation in operations:
+            streams = [operation.video(streams[0]), *map(operation.audio, streams[1:])]
+        return streams
+
+    def frames(self, operations: Sequence[Operation] = (), buffers: int = 2,
+               keyframes: bool = False) -> Iterable["numpy.ndarray"]:
+        """
+        Runs ffmpeg (blocking), yielding the frames of the video as (height, width, 3) RGB
+        arrays, once the operations are applied like `apply()` does: a leading `Trim` seeks,
+        `Scale` and `Fps` make frames smaller and fewer. With `keyframes`, only the keyframes
+        are decoded, which is much faster for previews.
+        Requires numpy. The frames are read into a ring of `buffers` preallocated arrays, so
+        each array is overwritten `buffers` frames later: copy it to keep it longer.
+        ffmpeg is stopped when the iteration is.
+        """
+        import numpy
+        resolution = self.output_metadata(operations).resolution
+        if resolution is None:
+            raise VideoError(f"Unknown resolution of {self.input_file}")
+        width, height = resolution
+        ring = [numpy.empty((height, width, 3), numpy.uint8) for _ in range(buffers)]
+        input_options = {"skip_frame": "nokey"} if keyframes else {}
+        video, = self._operation_streams(operations, False, **input_options)
+        # Clear previous returncode
+        self.returncode = None
+        self._stopping = False
+        self.report = None
+        self._reaped = []
+        self.ffmpeg = process = FFmpegProcess([
+            ffmpeg_executable(),
+            *video.output("pipe:1", f="rawvideo", pix_fmt="rgb24").get_args()
+        ], pipe=True)
+        try:
+            yield from self._read_frames(process, ring)
+        finally:
+            if process.running:
+                # The frames are not wanted anymore
+                self._stopping = True
+                process.interrupt(signal.SIGKILL)
+            self._reap(process)
+            self.returncode = process.returncode
+            # The process is not running anymore
+            self.ffmpeg = None
+
+    @staticmethod
+    def _read_frames(process: "FFmpegProcess",
+                     ring: Sequence["numpy.ndarray"]) -> Iterable["numpy.ndarray"]:
+        """Reads the raw frames written by ffmpeg into the arrays of `ring`, in turn"""
+        # Flat views of the arrays, ffmpeg's output is read straight into them
+        views = [frame.data.cast("B") for frame in ring]
+        assert process.stdout is not None
+        stdout = process.stdout.fileno()
+        channels = set(process.fds)
+        current = filled = 0
+        while channels:
+            rlist, _, _ = select(list(channels), (), ())
+            for fd in rlist:
+                if fd != stdout:
+                    data = os.read(fd, 65536)
+                    if data:
+                        process.feed(fd, data)
+                    else:
+                        channels.discard(fd)
+                    continue
+                count = os.readv(fd, [views[current][filled:]])
+                if not count:
+                    # EOF
+                    channels.discard(fd)
+                    continue
+                filled += count
+                if filled == len(views[current]):
+                    yield ring[current]
+                    current, filled = (current + 1) % len(ring), 0
+
+    def process_many(self, outputs: Sequence[Output],
+                     threads: Optional[int] = None) -> Iterable[Tuple[Output, Progress]]:
+        """
+        Writes several outputs with a single ffmpeg process (blocking): the video is decoded
+        once, then split between one speed-up/scaling/encoding branch per output.
+        Yields (output, progress) tuples when logs are received. Each output is moved to its
+        destination on its own, see `Output.written` and `Output.error`.
+        """
+        assert outputs
+        try:
+            # Clear previous results
+            self.returncode = None
+            self._stopping = False
+            self.report = None
+            self._reaped = []
+            with ExitStack() as stack:
+                # Each output gets its own temporary directory, next to its destination
+                temp_files: List[Path] = []
+                pending: List[Output] = []
+                for output in outputs:
+                    output.written, output.error = False, None
+                    try:
+                        td = stack.enter_context(temporary_directory(output.to))
+                    except OSError as err:
+                        output.error = str(err)
+                        LOGGER.warning("Cannot write %s: %s", output.to, err)
+                        continue
+                    temp_files.append(Path(td) / output.to.name)
+                    pending.append(output)
+                if not pending:
+                    return
+                # ffmpeg reports the position of the output that is the furthest along
+                fastest = min(output.by for output in pending)
+                options: Dict[str, Any] = {"threads": threads} if threads else {}
+                self.ffmpeg = FFmpegProcess(self._fan_out_args(pending, temp_files, **options))
+                for progress in self._ffmpeg_loop(self.ffmpeg):
+                    for output, temp_file in zip(pending, temp_files):
+                        yield output, self._output_progress(progress, fastest / output.by,
+                                                            temp_file)
+                self.returncode = self.ffmpeg.returncode
+                self._move_outputs(pending, temp_files)
+        finally:
+            # The process is not running anymore
+            self.ffmpeg = None
+
+    def _move_outputs(self, outputs: Sequence[Output], temp_files: Sequence[Path]):
+        """Moves the outputs of `process_many()` to their destination if ffmpeg succeeded"""
+        for output, temp_file in zip(outputs, temp_files):
+            if self.returncode != 0:
+                output.error = f"ffmpeg exited with code {self.returncode}"
+                continue
+            try:
+                os.replace(temp_file, output.to)
+            except OSError as err:
+                output.error = str(err)
+                LOGGER.warning("Cannot write %s: %s", output.to, err)
+            else:
+                output.written = True
+
+    def _output_progress(self, progress: Progress, ratio: float, temp_file: Path) -> Progress:
+        """
+        Progress of one of the outputs of `process_many()`, from the progress of the fastest
+        output: its position is `ratio` times the fastest one's, its size is read on disk.
+        """
+        out_time_us = int(progress.out_time_us * ratio)
+        try:
+            total_size = temp_file.stat().st_size
+        except OSError:
+            # Not created yet
+            total_size = 0
+        frame_rate = self.metadata.frame_rate
+        return Progress(
+            frame=round(out_time_us / 1e6 * frame_rate) if frame_rate else progress.frame,
+            fps=progress.fps,
+            bitrate=total_size * 8 / 1000 / (out_time_us / 1e6) if out_time_us else None,
+            total_size=total_size,
+            out_time_us=out_time_us,
+            speed=progress.speed * ratio if progress.speed is not None else None,
+            done=progress.done,
+        )
+
+    def _fan_out_args(self, outputs: Sequence[Output], temp_files: Sequence[Path],
+                      **output_options: Any) -> List:
+        """Command line decoding the video once and encoding it for each of the outputs"""
+        import ffmpeg
+        branches = ffmpeg.input(str(self.input_file)).filter_multi_output("split", len(outputs))
+        streams = []
+        for idx, (output, temp_file) in enumerate(zip(outputs, temp_files)):
+            stream = branches.stream(idx).setpts(f"{1/output.by}*PTS")
+            if output.resolution:
+                stream = stream.filter("scale", *output.resolution)
+            streams.append(stream.output(
+                str(temp_file), vcodec=output.fmt.value,
+                **{**PROFILES[output.fmt][output.profile], **output_options}
+            ))
+        return [
+            ffmpeg_executable(),
+            *ffmpeg.merge_outputs(*streams).get_args(overwrite_output=True)
+        ]
+
+    def _encode_args(self, to: Union[Path, str], by: float, fmt: Format,
+                     input_options: Optional[Dict[str, Any]] = None,
+                     timelapse: Timelapse = Timelapse.NONE,
+                     profile: Profile = Profile.ARCHIVAL,
+                     **output_options: Any) -> List:
+        """
+        Command line used to change the speed of (part of) the video.
+        `output_options` take precedence over the profile's encoder options. Their `threads`
+        limit applies to the decoder and the filters too.
+        """
+        import ffmpeg
+        input_options = dict(input_options or {})
+        threads = output_options.get("threads")
+        if threads:
+            input_options.setdefault("threads", threads)
+        if timelapse is Timelapse.KEYFRAMES:
+            input_options["skip_frame"] = "nokey"
+        stream = ffmpeg.input(str(self.input_file), **input_options)
+        if timelapse is Timelapse.DROP and self.metadata.frame_rate:
+            # Keep one frame out of `by`, then restore a fine timebase so that the timestamps
+            # are not rounded by setpts, and the original frame rate for the output
+            stream = stream.filter("fps", fps=self.metadata.frame_rate / by).filter(
+                "settb", "AVTB"
+            )
+            output_options.setdefault("r", self.metadata.frame_rate)
+        output = stream.setpts(f"{1/by}*PTS").output(
+            str(to), vcodec=fmt.value, **{**PROFILES[fmt][profile], **output_options}
+        )
+        if threads:
+            output = output.global_args("-filter_threads", str(threads))
+        return [ffmpeg_executable(), *output.get_args(overwrite_output=True)]
+
+    def _process_segments(self, to: Path, by: float, fmt: Format, jobs: int,
+                          threads: Optional[int] = None,
+                          timelapse: Timelapse = Timelapse.NONE,
+                          profile: Profile = Profile.ARCHIVAL,
+                          **encoder_options: Any) -> Iterable[Progress]:
+        """Encodes the video in parallel segments, then concatenates them into `to`"""
+        segments = split_segments(self.keyframes(), self.metadata.duration.total_seconds(), jobs)
+        # Share the available cores between the workers instead of letting each one use them all
+        threads = max(1, (threads or os.cpu_count() or 1) // len(segments))
+        segment_files: List[Path] = []
+        for idx, (start, end) in enumerate(segments):
+            segment_file = to.with_name(f"segment{idx:04d}{to.suffix}")
+            input_options: Dict[str, Any] = {"ss": start}
+            if end is not None:
+                input_options["t"] = end - start
+            self.workers.append(FFmpegProcess(
+                self._encode_args(segment_file, by, fmt, input_options, timelapse, profile,
+                                  threads=threads, **encoder_options)
+            ))
+            segment_files.append(segment_file)
+        LOGGER.debug("Encoding %d segments with %d threads each", len(segments), threads)
+        yield from self._ffmpeg_loop(*self.workers)
+        # Report the first failure, if any
+        returncodes = [worker.returncode for worker in self.workers]
+        self.returncode = next((code for code in returncodes if code != 0), 0)
+        if self.returncode != 0:
+            return
+        if self._stopping:
+            # stopped after the workers were done, but before the concatenation
+            self.returncode = 255
+            return
+        self._concatenate(to, to.with_name("segments.txt"), segment_files)
+
+    def _concatenate(self, to: Path, file_list: Path, files: Sequence[Path]):
+        """Joins video files into `to` without re-encoding them, through the `file_list`"""
+        write_concat_list(file_list, files)
+        import ffmpeg
+        self.ffmpeg = FFmpegProcess([
+            ffmpeg_executable(),
+            *ffmpeg
+            .input(str(file_list), f="concat", safe=0)
+            .output(str(to), c="copy")
+            .get_args(overwrite_output=True)
+        ])
+        # The concatenation progress is not reported, it would go back in time
+        for _ in self._ffmpeg_loop(self.ffmpeg):
+            pass
+        self.returncode = self.ffmpeg.returncode
+
+    def _process_pieces(self, to: Path, directory: Path, by: float, fmt: Format, jobs: int,
+                        threads: Optional[int] = None,
+                        timelapse: Timelapse = Timelapse.NONE,
+                        profile: Profile = Profile.ARCHIVAL,
+                        **encoder_options: Any) -> Iterable[Progress]:
+        """
+        Encodes the video in pieces starting on keyframes, `jobs` at a time, then concatenates
+        them into `to`. The pieces are kept in `directory`, and recorded in its journal as soon
+        as they are complete: those of an interrupted encode with the same parameters are not
+        encoded again.
+        """
+        duration = self.metadata.duration.total_seconds()
+        pieces = split_segments(self.keyframes(), duration,
+                                max(1, math.ceil(duration / self.CHECKPOINT_INTERVAL)))
+        stat = self.input_file.stat()
+        # Round-tripped through JSON to compare with the journal's
+        params = json.loads(json.dumps({
+            "input_file": str(self.input_file.resolve()), "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns, "by": by, "fmt": fmt.value, "profile": profile.value,
+            "timelapse": timelapse.value, "encoder_options": encoder_options, "pieces": pieces,
+        }))
+        journal = directory / "journal.json"
+        done = self._read_journal(journal, params)
+        directory.mkdir(exist_ok=True)
+        piece_files = [(directory / f"piece{idx:04d}{to.suffix}").resolve()
+                       for idx in range(len(pieces))]
+        todo = [idx for idx in range(len(pieces)) if idx not in done]
+        if done:
+            LOGGER.info("Resuming the encode of %s, %d pieces of %d are done", self.input_file,
+                        len(done), len(pieces))
+
+        def output_us(idx: int) -> int:
+            start, end = pieces[idx]
+            return round(((duration if end is None else end) - start) / by * 1e6)
+
+        threads = max(1, (threads or os.cpu_count() or 1) // max(1, min(jobs, len(todo))))
+        for first in range(0, len(todo), jobs):
+            batch = todo[first:first + jobs]
+            # Progress of the whole output, which is only done once joined
+            offset, size = sum(output_us(idx) for idx in done), sum(done.values())
+            self._start_pieces([(pieces[idx], piece_files[idx]) for idx in batch], by, fmt,
+                               threads, timelapse, profile, **encoder_options)
+            for progress in self._ffmpeg_loop(*self.workers):
+                progress.out_time_us += offset
+                progress.total_size += size
+                progress.done = progress.done and first + jobs >= len(todo)
+                yield progress
+            self._keep_pieces(batch, piece_files, done)
+            self._write_journal(journal, params, {idx: (piece_files[idx].name, piece_size)
+                                                  for idx, piece_size in done.items()})
+            # Report the first failure, if any
+            self.returncode = next((worker.returncode for worker in self.workers
+                                    if worker.returncode != 0), 0)
+            self.workers = []
+            if self._stopping:
+                # stopped during a batch, possibly before ffmpeg could handle the signal, between
+                # two batches of pieces, or before the concatenation
+                self.returncode = 255
+                return
+            if self.returncode != 0:
+                return
+        self._concatenate(to, to.with_name("pieces.txt"), piece_files)
+
+    def _start_pieces(self, batch: Sequence[Tuple[Tuple[float, Optional[float]], Path]],
+                      by: float, fmt: Format, threads: int, timelapse: Timelapse,
+                      profile: Profile, **encoder_options: Any):
+        """Starts the `workers` encoding pieces, given as ((start, end), file)"""
+        for (start, end), piece_file in batch:
+            input_options: Dict[str, Any] = {"ss": start}
+            if end is not None:
+                input_options["t"] = end - start
+            self.workers.append(FFmpegProcess(self._encode_args(
+                piece_file.with_suffix(f".part{piece_file.suffix}"), by, fmt, input_options,
+                timelapse, profile, threads=threads, **encoder_options
+            )))
+        if self._stopping:
+            # stopped while no ffmpeg was running, before this batch
+            for worker in self.workers:
+                worker.interrupt()
+
+    def _keep_pieces(self, batch: Sequence[int], piece_files: Sequence[Path],
+                     done: Dict[int, int]):
+        """Moves the pieces that the workers completed in place, adds their size to `done`"""
+        for idx, worker in zip(batch, self.workers):
+            if worker.returncode == 0:
+                piece_file = piece_files[idx]
+                part = piece_file.with_suffix(f".part{piece_file.suffix}")
+                # On the disk before the journal lists it, in case of power loss
+                fsync_path(part)
+                os.replace(part, piece_file)
+                done[idx] = piece_file.stat().st_size
+
+    @staticmethod
+    def _read_journal(journal: Path, params: Dict[str, Any]) -> Dict[int, int]:
+        """
+        Sizes of the pieces, by index, that the journal of a resumable encode with the given
+        parameters records as complete. The pieces of another encode are deleted.
+        """
+        try:
+            data = json.loads(journal.read_text())
+        except FileNotFoundError:
+            return {}
+        except ValueError as err:
+            LOGGER.warning("Ignoring invalid journal %s: %s", journal, err)
+            data = {}
+        if data.get("params") != params:
+            LOGGER.info("Discarding the pieces of another encode in %s", journal.parent)
+            shutil.rmtree(journal.parent, ignore_errors=True)
+            return {}
+        done: Dict[int, int] = {}
+        for idx, (name, size) in data["pieces"].items():
+            try:
+                # A piece may not have been written to disk before a crash
+                if (journal.parent / name).stat().st_size == size:
+                    done[int(idx)] = size
+            except FileNotFoundError:
+                pass
+        return done
+
+    @staticmethod
+    def _write_journal(journal: Path, params: Dict[str, Any],
+                       pieces: Dict[int, Tuple[str, int]]):
+        """Records the complete pieces of a resumable encode (file name and size, by index)"""
+        temp = journal.with_name(f".{journal.name}.tmp")
+        with temp.open("w") as file:
+            json.dump({"params": params, "pieces": pieces}, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp, journal)
+        # The renames of the pieces and of the journal
+        fsync_path(journal.parent)
+
+    def _ffmpeg_loop(self, *processes: "FFmpegProcess") -> Iterable[Progress]:
+        """
+        Waits for the given ffmpeg processes to exit.
+        When there are several, their progress is merged.
+        """
+        latest: Dict[int, Progress] = {}
+        channels: Dict[int, FFmpegProcess] = {
+            fd: process for process in processes for fd in process.fds
+        }
+        while channels:
+            rlist, _, _ = select(list(channels), (), ())
+            for fd in rlist:
+                process = channels[fd]
+                data = os.read(fd, 65536)
+                if not data:
+                    # EOF
+                    del channels[fd]
+                else:
+                    records = process.feed(fd, data)
+                    if records:
+                        latest[process.pid] = records[-1]
+                        yield records[-1] if len(processes) == 1 else Progress.merge(
+                            list(latest.values())
+                        )
+        for process in processes:
+            self._reap(process)
+
+    def _reap(self, process: "FFmpegProcess"):
+        """
+        Waits for an ffmpeg process to exit, with the resources it used, reports its failure if
+        it was not stopped.
+        """
+        try:
+            # Rather than Popen.wait(), which does not get the resource usage
+            _, status, process.rusage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+        except ChildProcessError:
+            # Already reaped
+            process.wait()
+        os.close(process.progress_fd)
+        self._reaped.append(process)
+        if process.returncode not in (0, 255) and not self._stopping:
+            LOGGER.warning("ffmpeg exited with code %d: %s", process.returncode,
+                           b"\n".join(process.log).decode(errors="replace"))
+
+
+class FFmpegProcess(subprocess.Popen):
+    """
+    A ffmpeg process that reports its progress on a dedicated pipe using the `-progress`
+    key=value protocol. Its stderr only carries error messages.
+    What ffmpeg writes to its stdout goes to `output`: directly if it is a file or a pipe,
+    else it is copied by `FFmpegWrapper._ffmpeg_loop()`. With `pipe`, it is left to the caller
+    to read from `stdout`.
+    """
+
+    def __init__(self, args: Sequence, output: Optional[BinaryIO] = None, pipe: bool = False):
+        stdout: Union[int, BinaryIO] = subprocess.PIPE if pipe else subprocess.DEVNULL
+        #: Where to copy the data read from stdout, if it is not written there directly
+        self.output: Optional[BinaryIO] = None
+        if output is not None:
+            try:
+                output.fileno()
+            except (AttributeError, OSError):
+                # Not backed by a file descriptor, like BytesIO
+                stdout, self.output = subprocess.PIPE, output
+            else:
+                # ffmpeg writes after what was already written
+                output.flush()
+                stdout = output
+        read_fd, write_fd = os.pipe()
+        try:
+            super().__init__(
+                self.command(args, write_fd),
+                stdin=subprocess.DEVNULL,
+                stdout=stdout,
+                stderr=subprocess.PIPE,
+                pass_fds=(write_fd,),
+            )
+        except BaseException:
+            os.close(read_fd)
+            raise
+        finally:
+            # Only ffmpeg writes to it, so it gets EOF when ffmpeg exits
+            os.close(write_fd)
+        #: Read end of the progress pipe
+        self.progress_fd = read_fd
+        self.parser = ProgressParser()
+        #: Last lines logged by ffmpeg
+        self.log: Deque[bytes] = deque(maxlen=20)
+        #: Resources used by ffmpeg, once it exited
+        self.rusage: Optional[resource.struct_rusage] = None
+        unbuffer_fd(self.progress_fd)
+        unbuffer_fd(self.stderr.fileno())
+        if self.stdout:
+            unbuffer_fd(self.stdout.fileno())
+
+    @property
+    def running(self) -> bool:
+        """
+        Whether ffmpeg did not exit yet. Unlike `poll()`, this does not reap it, which is left
+        to `FFmpegWrapper._reap()`.
+        """
+        if self.returncode is not None:
+            return False
+        if not hasattr(os, "waitid"):
+            # Until reaped, the process keeps its pid: signalling it is harmless
+            return True
+        try:
+            return os.waitid(os.P_PID, self.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is None
+        except ChildProcessError:
+            # Reaped meanwhile
+            return False
+
+    def interrupt(self, sig: int = signal.SIGINT):
+        """Sends a signal to ffmpeg if it is running, without reaping it like `send_signal()`"""
+        if self.running:
+            try:
+                os.kill(self.pid, sig)
+            except ProcessLookupError:
+                pass
+
+    @property
+    def fds(self) -> List[int]:
+        """File descriptors to read from until they reach EOF, see `feed()`"""
+        return [self.progress_fd, self.stderr.fileno(),
+                *((self.stdout.fileno(),) if self.stdout else ())]
+
+    def feed(self, fd: int, data: bytes) -> List[Progress]:
+        """Handles data read from one of `fds`, returns the progress blocks it completed"""
+        if fd == self.progress_fd:
+            return self.parser.feed(data)
+        if fd == self.stderr.fileno():
+            # Only keep the last log lines, to report errors
+            self.log.extend(data.splitlines())
+        elif self.output is not None:
+            # Streamed output, to copy
+            self.output.write(data)
+        return []
+
+    @staticmethod
+    def command(args: Sequence, progress_fd: int) -> List:
+        """Adds the options making ffmpeg report its progress on the given fd to `args`"""
+        return [args[0], "-nostdin", "-nostats", "-loglevel", "error",
+                "-progress", f"pipe:{progress_fd}", *args[1:]]
+
+
+@dataclass
+class Job:
+    """A video to process with a `JobQueue`"""
+    input_file: Path
+    output_file: Path
+    speed: float = 2.0
+    fmt: Format = Format.MP4
+    profile: Profile = Profile.ARCHIVAL
+    #: Processing speed to tune the encoder for, if any
+    target: Optional[Target] = None
+    #: Whether an interrupted encode can be resumed, see `FFmpegWrapper.process()`
+    resumable: bool = False
+    #: Whether a video already in the right codec is copied when its speed does not change
+    copy: bool = False
+    #: Metadata of the input file, once it has been probed
+    metadata: Optional[VideoMetadata] = None
+    #: Last progress reported by ffmpeg
+    progress: Optional[Progress] = None
+    #: ffmpeg's return code, once the job is finished
+    returncode: Optional[int] = None
+    #: Why the job could not be started, if it could not
+    error: Optional[str] = None
+    #: What processing the video took, once the job is finished
+    report: Optional[JobReport] = None
+
+    @property
+    def done(self) -> bool:
+        return self.returncode is not None or self.error is not None
+
+    @property
+    def fraction(self) -> float:
+        """How much of the job is done, between 0 and 1"""
+        if self.done:
+            return 1.0
+        if not self.metadata or not self.progress:
+            return 0.0
+        output_duration = self.metadata.duration.total_seconds() / self.speed
+        return min(self.progress.time.total_seconds() / output_duration, 1.0) \
+            if output_duration else 0.0
+
+
+class JobQueue:
+    """
+    Processes many videos, running several ffmpeg processes at once.
+    By default, one worker is started per `THREADS_PER_WORKER` cores, and each worker's ffmpeg
+    (decoder, filters and encoder) is limited to its share of the cores so that they do not
+    compete for the CPU.
+    The report of each finished job is appended to `report_file` as JSON lines, and all of them
+    are exported to `metrics_file` in the Prometheus text format.
+    """
+    #: Number of threads each ffmpeg process should get, to size the default number of workers
+    THREADS_PER_WORKER: ClassVar[int] = 4
+
+    def __init__(self, jobs: Iterable[Job] = (), workers: Optional[int] = None,
+                 cache: Optional["MetadataCache"] = None,
+                 output_cache: Optional["OutputCache"] = None,
+                 report_file: Optional[Path] = None, metrics_file: Optional[Path] = None):
+        cpus = os.cpu_count() or 1
+        self.workers = workers or max(1, cpus // self.THREADS_PER_WORKER)
+        #: Threads of each worker's ffmpeg
+        self.threads = max(1, cpus // self.workers)
+        self.cache = cache
+        self.output_cache = output_cache
+        self.report_file = report_file
+        self.metrics_file = metrics_file
+        self.jobs: List[Job] = list(jobs)
+        #: Index of the next job to start in `jobs`
+        self._next = 0
+        self._running: Dict[int, FFmpegWrapper] = {}
+        self._lock = Lock()
+        self._stopping = False
+
+    def submit(self, job: Job):
+        """Adds a job to the queue. Jobs submitted while `run()` is running are processed too."""
+        with self._lock:
+            self.jobs.append(job)
+
+    @property
+    def progress(self) -> float:
+        """Aggregate progress of all the jobs, between 0 and 1, each job counting the same"""
+        with self._lock:
+            jobs = list(self.jobs)
+        return sum(job.fraction for job in jobs) / len(jobs) if jobs else 1.0
+
+    @property
+    def returncode(self) -> Optional[int]:
+        """
+        0 if all the jobs succeeded, 255 if stopped, else the first failed job's code, or 1 if
+        a job could not be processed, or did not finish
+        """
+        if self._stopping:
+            return 255
+        if any(job.error or not job.done for job in self.jobs):
+            return 1
+        return next((job.returncode for job in self.jobs if job.returncode), 0)
+
+    def stop(self):
+        """Stops the running jobs, pending jobs will not be started"""
+        with self._lock:
+            self._stopping = True
+            running = list(self._running.values())
+        for wrapper in running:
+            try:
+                wrapper.stop()
+            except RuntimeError:
+                # Not started yet, or already finished
+                pass
+
+    def run(self) -> Generator[Tuple[Job, Progress], None, None]:
+        """
+        Processes the queued jobs (blocking). Yields (job, progress) tuples whenever one of the
+        jobs reports its progress.
+        If the iteration is interrupted (or closed), the jobs are stopped and their workers are
+        waited for.
+        """
+        events: "Queue[Optional[Tuple[Job, Progress]]]" = Queue()
+        threads = [Thread(target=self._worker, args=(events,), daemon=True)
+                   for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        remaining = len(threads)
+        try:
+            while remaining:
+                event = events.get()
+                if event is None:
+                    # A worker is done
+                    remaining -= 1
+                else:
+                    yield event
+        finally:
+            if remaining:
+                self.stop()
+            for thread in threads:
+                thread.join()
+
+    def _next_job(self) -> Optional[Job]:
+        """Takes the next pending job"""
+        with self._lock:
+            if self._stopping or self._next >= len(self.jobs):
+                return None
+            self._next += 1
+            return self.jobs[self._next - 1]
+
+    def _worker(self, events: "Queue[Optional[Tuple[Job, Progress]]]"):
+        """Processes jobs until there are none left"""
+        try:
+            job = self._next_job()
+            while job:
+                try:
+                    self._run_job(job, events)
+                except Exception as err:
+                    # Whatever went wrong with a job, the next ones are processed
+                    job.error = str(err) or type(err).__name__
+                    LOGGER.exception("Cannot process %s", job.input_file)
+                job = self._next_job()
+        finally:
+            events.put(None)
+
+    def _run_job(self, job: Job, events: "Queue[Optional[Tuple[Job, Progress]]]"):
+        """Processes a single job"""
+        try:
+            if not job.input_file.exists():
+                raise VideoError(f"{job.input_file} does not exist")
+            wrapper = FFmpegWrapper(job.input_file, cache=self.cache,
+                                    output_cache=self.output_cache)
+        except VideoError as err:
+            job.error = str(err)
+            LOGGER.warning("Cannot process %s: %s", job.input_file, job.error)
+            return
+        job.metadata = wrapper.metadata
+        with self._lock:
+            if self._stopping:
+                return
+            self._running[id(job)] = wrapper
+        try:
+            for progress in wrapper.process(job.output_file, by=job.speed, fmt=job.fmt,
+                                            threads=self.threads, profile=job.profile,
+                                            target=job.target, resumable=job.resumable,
+                                            copy=job.copy):
+                if self._stopping and not wrapper.stopping:
+                    # stop() was called while ffmpeg was starting
+                    wrapper.stop()
+                job.progress = progress
+                events.put((job, progress))
+            job.returncode = wrapper.returncode
+        finally:
+            job.report = wrapper.report
+            with self._lock:
+                del self._running[id(job)]
+                self._export_report(job)
+
+    def _export_report(self, job: Job):
+        """Writes the report of a finished job to the report and metrics files, if any"""
+        if job.report is None:
+            return
+        try:
+            if self.report_file:
+                append_json_lines(job.report, self.report_file)
+            if self.metrics_file:
+                write_prometheus((job.report for job in self.jobs if job.report),
+                                 self.metrics_file)
+        except OSError as err:
+            LOGGER.warning("Cannot export the report of %s: %s", job.input_file, err)
@@ -0,0 +1,355 @@
+import sys
+
+from concurrent.futures import Future
+from datetime import timedelta
+from itertools import islice
+from logging import getLogger
+from pathlib import Path
+from typing import ClassVar, List, Optional, Tuple
+
+from PyQt5 import QtWidgets  # type: ignore
+from PyQt5.QtCore import Qt, QThread, pyqtSignal  # type: ignore
+from PyQt5.QtGui import QImage, QPixmap  # type: ignore
+
+from video_transformer.cache import MetadataCache
+from video_transformer.core import (FFmpegWrapper, Format, Fps, Job, JobQueue,
+                                    Profile, Progress, Scale, VideoError,
+                                    default_output_file)
+from video_transformer.ui import Ui_MainWindow  # type: ignore
+
+LOG = getLogger("video-transformer-ui")
+
+
+class ProcessThread(QThread):
+    """QThread used to control the ffmpeg process"""
+    finished: ClassVar[pyqtSignal] = pyqtSignal(int)
+    progress: ClassVar[pyqtSignal] = pyqtSignal(Progress)
+
+    def __init__(self, ffmpeg_wrapper: FFmpegWrapper, **options):
+        QThread.__init__(self)
+        self.ffmpeg_wrapper = ffmpeg_wrapper
+        self.options = options
+
+    # run method gets called when we start the thread
+    def run(self):
+        for progress in self.ffmpeg_wrapper.process(**self.options):
+            self.progress.emit(progress)
+        self.finished.emit(self.ffmpeg_wrapper.returncode)
+
+    def stop(self):
+        self.ffmpeg_wrapper.stop()
+
+
+class QueueThread(QThread):
+    """QThread used to run a `JobQueue`"""
+    finished: ClassVar[pyqtSignal] = pyqtSignal(int)
+    #: Aggregate progress of the queue (0 to 1), and the job that reported progress
+    progress: ClassVar[pyqtSignal] = pyqtSignal(float, Job)
+
+    def __init__(self, queue: JobQueue):
+        QThread.__init__(self)
+        self.queue = queue
+
+    def run(self):
+        for job, _ in self.queue.run():
+            self.progress.emit(self.queue.progress, job)
+        self.finished.emit(self.queue.returncode)
+
+    def stop(self):
+        self.queue.stop()
+
+
+class PreviewThread(QThread):
+    """QThread decoding evenly spaced thumbnails of a video"""
+    #: Index of the thumbnail, and the thumbnail as a (height, width, 3) RGB numpy array
+    thumbnail: ClassVar[pyqtSignal] = pyqtSignal(int, object)
+
+    def __init__(self, ffmpeg_wrapper: FFmpegWrapper, count: int, width: int):
+        QThread.__init__(self)
+        # A wrapper of its own, so that it can run while the video is processed
+        self.ffmpeg_wrapper = FFmpegWrapper(ffmpeg_wrapper.input_file, ffmpeg_wrapper.metadata,
+                                            cache=ffmpeg_wrapper.cache)
+        self.count = count
+        self.width = width
+
+    def run(self):
+        duration = self.ffmpeg_wrapper.metadata.duration.total_seconds()
+        operations = [Fps(self.count / duration), Scale(self.width, -1)]
+        try:
+            # As many buffers as thumbnails, none is overwritten before it is shown
+            frames = self.ffmpeg_wrapper.frames(operations, buffers=self.count, keyframes=True)
+            for idx, frame in enumerate(islice(frames, self.count)):
+                self.thumbnail.emit(idx, frame)
+        except ImportError:
+            LOG.info("numpy is not installed, videos are not previewed")
+
+    def stop(self):
+        try:
+            self.ffmpeg_wrapper.stop()
+        except RuntimeError:
+            # Not started yet, or already done
+            pass
+
+
+class VideoTransformerInterface(QtWidgets.QMainWindow):
+    #: Fired (from a background thread) when a selected video has been analysed
+    probed: ClassVar[pyqtSignal] = pyqtSignal(Path, Future)
+    #: Number and size of the thumbnails previewing the selected video
+    THUMBNAILS: ClassVar[int] = 6
+    THUMBNAIL_SIZE: ClassVar[Tuple[int, int]] = (60, 45)
+
+    def __init__(self, parent=None):
+        QtWidgets.QMainWindow.__init__(self, parent)
+        self.ui = Ui_MainWindow()
+        self.ui.setupUi(self)
+        # Connect buttons with their actions
+        self.ui.file_select_button.clicked.connect(self.select_file)
+        self.ui.process_button.clicked.connect(self.process)
+        self.ui.speed_spinbox.valueChanged.connect(self.speed_changed)
+        self.probed.connect(self.file_probed)
+        # Only offer the formats the local ffmpeg can encode
+        for fmt in Format.available():
+            self.ui.format_combobox.addItem(fmt.label, fmt)
+        for profile in Profile:
+            self.ui.profile_combobox.addItem(profile.value.capitalize(), profile)
+        self.ui.profile_combobox.setCurrentIndex(list(Profile).index(Profile.ARCHIVAL))
+        # Set initial state
+        self.ui.statusbar.showMessage("Choose a video")
+        self.selected_file: Optional[Path] = None
+        #: Videos to process in a queue, when several were selected at once
+        self.selected_files: List[Path] = []
+        self.thread: Optional[QThread] = None
+        self.ffmpeg: Optional[FFmpegWrapper] = None
+        self.metadata_cache = MetadataCache()
+        self.preview_thread: Optional[PreviewThread] = None
+        self.thumbnails: List[QtWidgets.QLabel] = []
+        for _ in range(self.THUMBNAILS):
+            label = QtWidgets.QLabel(self.ui.verticalLayoutWidget)
+            label.setFixedSize(*self.THUMBNAIL_SIZE)
+            label.setAlignment(Qt.AlignCenter)
+            self.ui.preview_layout.addWidget(label)
+            self.thumbnails.append(label)
+        self.reset_state()
+
+    @property
+    def speed(self) -> float:
+        """The currently selected speed"""
+        return self.ui.speed_spinbox.value()
+
+    @property
+    def format(self) -> Format:
+        """The currently selected output format"""
+        return self.ui.format_combobox.currentData() or Format.MP4
+
+    @property
+    def profile(self) -> Profile:
+        """The currently selected encoding profile"""
+        return self.ui.profile_combobox.currentData()
+
+    @property
+    def output_file(self) -> Path:
+        """The ouput file (<input file name>.<speed>.<format extension>)"""
+        if not self.selected_file:
+            raise AttributeError("No file selected yet")
+        return self.output_file_for(self.selected_file)
+
+    def output_file_for(self, input_file: Path) -> Path:
+        """The ouput file for the given input file (<input file name>.<speed>.<extension>)"""
+        return default_output_file(input_file, self.speed, self.format)
+
+    @property
+    def output_duration(self) -> timedelta:
+        """The output file target duration"""
+        if not self.ffmpeg:
+            raise AttributeError("No output_duration when no file is selected")
+        return self.ffmpeg.metadata.duration * (1 / self.speed)
+
+    def select_file(self):
+        """Callback when the video selection button is pressed"""
+        selected: List[str] = QtWidgets.QFileDialog.getOpenFileNames()[0]
+        if len(selected) > 1:
+            # Several videos, they will be processed in a queue
+            self.selected_files = [Path(path) for path in selected]
+            self.selected_file = None
+            self.ffmpeg = None
+            self.ui.resulting_duration.setText("")
+            self.ui.statusbar.showMessage(f"{len(self.selected_files)} videos selected")
+            self.clear_preview()
+            self.ui.process_button.setEnabled(True)
+        elif selected:
+            self.selected_files = []
+            self.selected_file = Path(selected[0])
+            self.ffmpeg = None
+            self.clear_preview()
+            self.ui.process_button.setEnabled(False)
+            self.ui.statusbar.showMessage(f"Analysing {self.selected_file.name!r}...")
+            # Probing can be slow (big files, network storage), don't freeze the window
+            path = self.selected_file
+            FFmpegWrapper.open_in_background(
+                path, cache=self.metadata_cache
+            ).add_done_callback(lambda future: self.probed.emit(path, future))
+
+    def file_probed(self, path: Path, future: Future):
+        """Called when the `probed` event fires"""
+        if path != self.selected_file:
+            # Another file was selected in the meantime
+            return
+        try:
+            self.ffmpeg = future.result()
+        except VideoError as err:
+            self.selected_file = None
+            self.ui.statusbar.showMessage("Choose a video")
+            self.error(str(err))
+            return
+        self.ui.statusbar.showMessage(
+            f"{self.selected_file.name!r} selected ({self.ffmpeg.metadata.duration})"
+        )
+        self.ui.process_button.setEnabled(True)
+        self.speed_changed()
+        self.preview_thread = PreviewThread(self.ffmpeg, self.THUMBNAILS,
+                                            self.THUMBNAIL_SIZE[0])
+        self.preview_thread.thumbnail.connect(self.show_thumbnail)
+        self.preview_thread.start()
+
+    def clear_preview(self):
+        """Stops previewing the previously selected video, if any"""
+        if self.preview_thread:
+            self.preview_thread.stop()
+            self.preview_thread.wait()
+            self.preview_thread = None
+        for label in self.thumbnails:
+            label.clear()
+            label.setToolTip("")
+
+    def show_thumbnail(self, idx: int, frame):
+        """Called when the preview thread's `thumbnail` event fires"""
+        if self.sender() is not self.preview_thread:
+            # Thumbnail of a video that is not selected anymore
+            return
+        height, width, _ = frame.shape
+        # The image uses the frame's memory, the pixmap is a copy
+        image = QImage(frame.data, width, height, frame.strides[0], QImage.Format_RGB888)
+        self.thumbnails[idx].setPixmap(QPixmap.fromImage(image))
+        self.speed_changed()
+
+    def error(self, message):
+        """Shortcut to show an error popup"""
+        QtWidgets.QErrorMessage(self).showMessage(message)
+
+    def processing_done(self, ffmpeg_returncode: int):
+        """Called when the ffmpeg thread's `finished` event fires."""
+        if ffmpeg_returncode == 255:
+            # ffmpeg was interrupted
+            # https://ffmpeg.org/doxygen/0.6/ffmpeg_8c-source.html
+            self.ui.statusbar.showMessage("Processing stopped")
+        elif ffmpeg_returncode != 0:
+            # ffmpeg exited on error
+            self.ui.statusbar.showMessage(f"Error while processing video ({ffmpeg_returncode})")
+        elif self.selected_files:
+            self.ui.statusbar.showMessage(
+                f"{len(self.selected_files)} videos: Processing finished"
+            )
+        else:
+            # ffpmeg exited successfully
+            self.ui.statusbar.showMessage(f"{self.output_file.name!r}: Processing finished")
+        self.reset_state(success=ffmpeg_returncode == 0)
+
+    def reset_state(self, success: Optional[bool] = None):
+        if self.thread:
+            # `finished` is emitted at the end of run(), let it return before dropping the thread
+            self.thread.wait()
+        self.thread = None
+        # Can select a file
+        self.ui.file_select_button.setEnabled(True)
+        self.ui.speed_spinbox.setEnabled(True)
+        self.ui.format_combobox.setEnabled(True)
+        self.ui.profile_combobox.setEnabled(True)
+        self.ui.process_button.setText("Process video")
+        self.ui.file_select_button.setText("Select video...")
+        if success is True:
+            # Processing was finished successfully, so let's say 100%
+            self.ui.progress_bar.setValue(100)
+            self.ui.resulting_duration.setText("")
+            # And reset the video too
+            self.ffmpeg = None
+            self.selected_file = None
+            self.selected_files = []
+            self.ui.process_button.setEnabled(True)
+
+    def update_progress(self, progress: Progress):
+        """Called when the ffmpeg thread's `progress` event fires"""
+        percentage = (progress.time.total_seconds() / self.output_duration.total_seconds()) * 100
+        self.ui.progress_bar.setValue(int(percentage))
+        self.ui.statusbar.showMessage(
+            f"Processing: {progress.fps} FPS, {progress.bitrate or 0:.1f}kbits/s, "
+            f"{progress.total_size // 1024}kB written"
+        )
+
+    def update_queue_progress(self, fraction: float, job: Job):
+        """Called when the queue thread's `progress` event fires"""
+        self.ui.progress_bar.setValue(int(fraction * 100))
+        self.ui.statusbar.showMessage(f"Processing {job.input_file.name!r}...")
+
+    def process(self):
+        if self.thread:
+            self.ui.statusbar.showMessage("Stopping...")
+            self.thread.stop()
+            return
+        if self.selected_files:
+            self.process_queue()
+            return
+        if self.selected_file is None:
+            self.error("Select a video first")
+            return
+
+        self.ui.statusbar.showMessage(f"{self.output_file.name!r}: Processing...")
+        # Create the thread
+        self.thread = ProcessThread(self.ffmpeg, to=self.output_file, by=self.speed,
+                                    fmt=self.format, profile=self.profile)
+        self.thread.finished.connect(self.processing_done)
+        self.thread.progress.connect(self.update_progress)
+        self.thread.start()
+        self.ui.file_select_button.setEnabled(False)
+        self.ui.speed_spinbox.setEnabled(False)
+        self.ui.format_combobox.setEnabled(False)
+        self.ui.profile_combobox.setEnabled(False)
+        self.ui.process_button.setText("Stop")
+
+    def process_queue(self):
+        """Processes all the selected videos"""
+        queue = JobQueue((Job(path, self.output_file_for(path), speed=self.speed,
+                              fmt=self.format, profile=self.profile)
+                          for path in self.selected_files), cache=self.metadata_cache)
+        self.ui.statusbar.showMessage(f"Processing {len(self.selected_files)} videos...")
+        self.thread = QueueThread(queue)
+        self.thread.finished.connect(self.processing_done)
+        self.thread.progress.connect(self.update_queue_progress)
+        self.thread.start()
+        self.ui.file_select_button.setEnabled(False)
+        self.ui.speed_spinbox.setEnabled(False)
+        self.ui.format_combobox.setEnabled(False)
+        self.ui.profile_combobox.setEnabled(False)
+        self.ui.process_button.setText("Stop")
+
+    def speed_changed(self):
+        if not self.ffmpeg:
+            return
+        duration = str(self.output_duration).split(".")[0]
+        self.ui.resulting_duration.setText(f"({duration})")
+        # Where the thumbnails are in the result
+        for idx, label in enumerate(self.thumbnails):
+            if label.pixmap():
+                position = self.output_duration * idx / len(self.thumbnails)
+                label.setToolTip(str(position).split(".")[0])
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Runs the GUI until its window is closed, returns the exit code"""
+    app = QtWidgets.QApplication(sys.argv if argv is None else argv)
+    window = VideoTransformerInterface()
+    window.show()
+    return app.exec_()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,124 @@
+"""Resource usage reports of processed videos, and their export for monitoring"""
+import json
+import os
+import resource
+
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+
+@dataclass
+class Sample:
+    """Progress of a job at some point in time"""
+    #: Seconds since the job started
+    time: float
+    #: Output position, in seconds
+    position: float
+    #: Encoding frames per second
+    fps: float
+    #: Realtime factor, if known
+    speed: Optional[float]
+    #: Output bitrate in kbit/s, if known
+    bitrate: Optional[float]
+
+
+@dataclass
+class JobReport:
+    """What processing a video took, see `FFmpegWrapper.report`"""
+    input_file: str
+    output_file: str
+    #: Unix time at which the job started
+    started: float
+    #: Input size in bytes, and duration in seconds
+    input_size: int
+    input_duration: float
+    #: Output size in bytes, 0 if it was not written
+    output_size: int = 0
+    #: Return code of the last ffmpeg process
+    returncode: Optional[int] = None
+    #: Elapsed seconds
+    wall_time: float = 0.0
+    #: CPU seconds spent by the ffmpeg process(es)
+    user_time: float = 0.0
+    system_time: float = 0.0
+    #: Peak resident memory of the biggest ffmpeg process, in bytes
+    max_rss: int = 0
+    #: Progress timeline
+    samples: List[Sample] = field(default_factory=list)
+
+    @property
+    def compression_ratio(self) -> Optional[float]:
+        """Input size divided by output size, if the output was written"""
+        return self.input_size / self.output_size if self.output_size else None
+
+    @property
+    def realtime_factor(self) -> Optional[float]:
+        """Seconds of input processed per second"""
+        return self.input_duration / self.wall_time if self.wall_time else None
+
+    def add_rusage(self, rusage: resource.struct_rusage):
+        """Accounts for the resources used by an ffmpeg process"""
+        self.user_time += rusage.ru_utime
+        self.system_time += rusage.ru_stime
+        # In kilobytes on Linux
+        self.max_rss = max(self.max_rss, rusage.ru_maxrss * 1024)
+
+    def as_dict(self) -> Dict[str, Any]:
+        """JSON serializable representation"""
+        return {**asdict(self), "compression_ratio": self.compression_ratio,
+                "realtime_factor": self.realtime_factor}
+
+
+def append_json_lines(report: JobReport, path: Path):
+    """Appends a report to a JSON lines file"""
+    line = json.dumps(report.as_dict()) + "\n"
+    # A single write in append mode, so that concurrent writers do not mix their lines
+    with path.open("a") as file:
+        file.write(line)
+
+
+#: Exported metrics, as (name, help, report attribute)
+PROMETHEUS_METRICS: Tuple[Tuple[str, str, str], ...] = (
+    ("started_timestamp_seconds", "Unix time at which the job started", "started"),
+    ("wall_seconds", "Elapsed time", "wall_time"),
+    ("user_cpu_seconds", "User CPU time of ffmpeg", "user_time"),
+    ("system_cpu_seconds", "System CPU time of ffmpeg", "system_time"),
+    ("max_rss_bytes", "Peak resident memory of ffmpeg", "max_rss"),
+    ("input_bytes", "Input size", "input_size"),
+    ("input_duration_seconds", "Input duration", "input_duration"),
+    ("output_bytes", "Output size", "output_size"),
+    ("compression_ratio", "Input size divided by output size", "compression_ratio"),
+    ("realtime_factor", "Seconds of input processed per second", "realtime_factor"),
+    ("returncode", "Return code of ffmpeg", "returncode"),
+)
+
+
+def _label(value: str) -> str:
+    """Escapes a Prometheus label value"""
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def prometheus_text(reports: Iterable[JobReport]) -> str:
+    """Prometheus text format exposition of the given reports, labelled by input and output"""
+    reports = list(reports)
+    lines: List[str] = []
+    for name, description, attribute in PROMETHEUS_METRICS:
+        lines.append(f"# HELP video_transformer_job_{name} {description}")
+        lines.append(f"# TYPE video_transformer_job_{name} gauge")
+        for report in reports:
+            value = getattr(report, attribute)
+            if value is not None:
+                lines.append(f"video_transformer_job_{name}{{input=\"{_label(report.input_file)}\""
+                             f",output=\"{_label(report.output_file)}\"}} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(reports: Iterable[JobReport], path: Path):
+    """
+    Writes the given reports to a file for node_exporter's textfile collector. The file is
+    replaced atomically, so that it is never scraped half written.
+    """
+    temp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    temp.write_text(prometheus_text(reports))
+    os.replace(str(temp), str(path))
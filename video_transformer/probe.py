@@ -0,0 +1,236 @@
+"""
+Probing of many videos at once, and manifests of the results so that later runs do not probe
+the same files again.
+"""
+import csv
+import datetime
+import json
+import os
+
+from collections import Counter, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from logging import getLogger
+from pathlib import Path
+from typing import (TYPE_CHECKING, Any, Deque, Dict, Iterable, Iterator, List,
+                    Mapping, Optional)
+
+from video_transformer.core import FFmpegWrapper, VideoError, VideoMetadata
+
+if TYPE_CHECKING:
+    from video_transformer.cache import MetadataCache
+
+LOGGER = getLogger(__name__)
+
+#: Extensions of the files considered to be videos when walking a directory
+VIDEO_EXTENSIONS = frozenset({
+    ".avi", ".flv", ".m2ts", ".m4v", ".mkv", ".mov", ".mp4", ".mpeg", ".mpg", ".mts", ".ogv",
+    ".ts", ".webm", ".wmv",
+})
+
+#: Columns of CSV manifests
+CSV_FIELDS = ("path", "size", "mtime_ns", "codec", "pixel_format", "duration", "width",
+              "height", "frame_rate", "audio_codec", "error")
+
+
+@dataclass
+class ProbeResult:
+    """What probing a file gave"""
+    path: Path
+    #: Size and modification time of the file when it was probed
+    size: int
+    mtime_ns: int
+    #: Metadata of the video, None if it could not be probed
+    metadata: Optional[VideoMetadata] = None
+    #: Why it could not be probed
+    error: Optional[str] = None
+
+    def is_current(self) -> bool:
+        """Whether the file did not change since it was probed"""
+        try:
+            stat = self.path.stat()
+        except OSError:
+            return False
+        return (stat.st_size, stat.st_mtime_ns) == (self.size, self.mtime_ns)
+
+    def as_dict(self) -> Dict[str, Any]:
+        """JSON serializable representation"""
+        return {
+            "path": str(self.path),
+            "size": self.size,
+            "mtime_ns": self.mtime_ns,
+            "metadata": self.metadata.as_dict() if self.metadata else None,
+            "error": self.error,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "ProbeResult":
+        """Creates a new instance from its `as_dict()` representation"""
+        return cls(
+            path=Path(data["path"]),
+            size=data["size"],
+            mtime_ns=data["mtime_ns"],
+            metadata=VideoMetadata.from_dict(data["metadata"]) if data["metadata"] else None,
+            error=data["error"],
+        )
+
+    def as_row(self) -> Dict[str, Any]:
+        """Flat representation, with the `CSV_FIELDS` as keys"""
+        md = self.metadata
+        width, height = md.resolution if md and md.resolution else (None, None)
+        return {
+            "path": str(self.path), "size": self.size, "mtime_ns": self.mtime_ns,
+            "codec": md and md.codec, "pixel_format": md and md.pixel_format,
+            "duration": md and md.duration.total_seconds(), "width": width, "height": height,
+            "frame_rate": md and md.frame_rate, "audio_codec": md and md.audio_codec,
+            "error": self.error,
+        }
+
+    @classmethod
+    def from_row(cls, row: Dict[str, str]) -> "ProbeResult":
+        """Creates a new instance from its `as_row()` representation, read from a CSV file"""
+        metadata = None
+        if row["codec"]:
+            metadata = VideoMetadata(
+                codec=row["codec"],
+                pixel_format=row["pixel_format"],
+                duration=datetime.timedelta(seconds=float(row["duration"])),
+                resolution=(int(row["width"]), int(row["height"])) if row["width"] else None,
+                frame_rate=float(row["frame_rate"]) if row["frame_rate"] else None,
+                audio_codec=row["audio_codec"] or None,
+            )
+        return cls(path=Path(row["path"]), size=int(row["size"]), mtime_ns=int(row["mtime_ns"]),
+                   metadata=metadata, error=row["error"] or None)
+
+
+@dataclass
+class ProbeSummary:
+    """Totals of probe results, to plan a batch run"""
+    files: int = 0
+    failed: int = 0
+    #: Bytes, and seconds of video, of the files that could be probed
+    total_size: int = 0
+    total_duration: float = 0.0
+    #: Number of videos per codec
+    codecs: Dict[str, int] = field(default_factory=dict)
+
+    @classmethod
+    def of(cls, results: Iterable[ProbeResult]) -> "ProbeSummary":
+        """Summary of the given results"""
+        summary = cls()
+        codecs: Counter = Counter()
+        for result in results:
+            summary.files += 1
+            if result.metadata is None:
+                summary.failed += 1
+                continue
+            summary.total_size += result.size
+            summary.total_duration += result.metadata.duration.total_seconds()
+            codecs[result.metadata.codec] += 1
+        summary.codecs = dict(codecs.most_common())
+        return summary
+
+    def output_duration(self, speed: float) -> float:
+        """Seconds of video once all are sped up `speed` times"""
+        return self.total_duration / speed
+
+    def encode_time(self, realtime_factor: float) -> float:
+        """
+        Estimated seconds to process all the videos, given the seconds of input processed per
+        second (see `JobReport.realtime_factor`)
+        """
+        return self.total_duration / realtime_factor
+
+
+def find_videos(root: Path) -> Iterator[Path]:
+    """Walks a directory tree, yields the videos (by extension) it contains, sorted by path"""
+    try:
+        with os.scandir(root) as iterator:
+            entries = sorted(iterator, key=lambda entry: entry.name)
+    except OSError as err:
+        LOGGER.warning("Cannot list %s: %s", root, err)
+        return
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            yield from find_videos(Path(entry.path))
+        elif entry.is_file() and os.path.splitext(entry.name)[1].lower() in VIDEO_EXTENSIONS:
+            yield Path(entry.path)
+
+
+def probe(path: Path, cache: Optional["MetadataCache"] = None) -> ProbeResult:
+    """Probes a single file (blocking), failures are reported in the result"""
+    try:
+        stat = path.stat()
+    except OSError as err:
+        return ProbeResult(path, 0, 0, error=str(err))
+    result = ProbeResult(path, stat.st_size, stat.st_mtime_ns)
+    try:
+        result.metadata = FFmpegWrapper(path, cache=cache).metadata
+    except (VideoError, OSError) as err:
+        result.error = str(err) or type(err).__name__
+    return result
+
+
+def probe_many(paths: Iterable[Path], workers: Optional[int] = None,
+               cache: Optional["MetadataCache"] = None,
+               known: Optional[Mapping[Path, ProbeResult]] = None) -> Iterator[ProbeResult]:
+    """
+    Probes the given files with up to `workers` ffprobe processes at once (by default, as
+    many as there are CPUs), yields the results in the order of `paths`.
+    Files with a current result in `known` (see `read_manifest()`) are not probed again.
+    `paths` is consumed as the results are, so that it can be a long directory walk.
+    """
+    workers = workers or os.cpu_count() or 1
+    pending: Deque["Future[ProbeResult]"] = deque()
+    with ThreadPoolExecutor(workers, thread_name_prefix="video-transformer-probe") as executor:
+        for path in paths:
+            previous = known.get(path) if known else None
+            if previous is not None and previous.is_current():
+                future: "Future[ProbeResult]" = Future()
+                future.set_result(previous)
+                pending.append(future)
+            else:
+                pending.append(executor.submit(probe, path, cache))
+            # Only keep a few probes ahead of the consumer
+            while len(pending) > 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def write_manifest(results: Iterable[ProbeResult], path: Path,
+                   fmt: Optional[str] = None) -> List[ProbeResult]:
+    """
+    Writes probe results to a JSON lines, or CSV manifest, depending on `fmt` ("jsonl" or
+    "csv"), by default on the extension of `path`. Returns the written results.
+    """
+    fmt = fmt or ("csv" if path.suffix.lower() == ".csv" else "jsonl")
+    written: List[ProbeResult] = []
+    # Written next to the manifest then moved, so that an interrupted run keeps the previous one
+    temp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    try:
+        with temp.open("w", newline="") as file:
+            writer = csv.DictWriter(file, CSV_FIELDS) if fmt == "csv" else None
+            if writer:
+                writer.writeheader()
+            for result in results:
+                if writer:
+                    writer.writerow(result.as_row())
+                else:
+                    file.write(json.dumps(result.as_dict()) + "\n")
+                written.append(result)
+        os.replace(temp, path)
+    finally:
+        if temp.exists():
+            temp.unlink()
+    return written
+
+
+def read_manifest(path: Path) -> Dict[Path, ProbeResult]:
+    """Reads a manifest written by `write_manifest()`, results by path"""
+    with path.open(newline="") as file:
+        if path.suffix.lower() == ".csv":
+            results = [ProbeResult.from_row(row) for row in csv.DictReader(file)]
+        else:
+            results = [ProbeResult.from_dict(json.loads(line)) for line in file if line.strip()]
+    return {result.path: result for result in results}
@@ -0,0 +1,675 @@
+"""
+Job server: a queue of videos to process, served over HTTP (JSON) to workers which may run on
+other hosts. Workers lease jobs, report their progress, which renews the lease, then either
+write the output in place (shared storage) or upload it. Jobs whose lease expires, because
+their worker died, are queued again.
+Every request must carry the server's token, and the jobs only read and write files under the
+directories it serves.
+"""
+import itertools
+import json
+import os
+import secrets
+import shutil
+import time
+import urllib.error
+import urllib.request
+
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging import getLogger
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from threading import Event, Lock, Thread
+from typing import (TYPE_CHECKING, Any, BinaryIO, Deque, Dict, Iterable,
+                    Iterator, List, Optional, Sequence, Tuple)
+from urllib.parse import parse_qs, urlsplit
+
+from video_transformer.core import (FFmpegWrapper, Format, Job, Profile,
+                                    Progress, VideoError)
+
+if TYPE_CHECKING:
+    from video_transformer.cache import MetadataCache
+
+LOGGER = getLogger(__name__)
+
+#: Size of the chunks in which videos are downloaded and uploaded
+CHUNK_SIZE = 1 << 20
+#: Seconds after which a request without response fails
+REQUEST_TIMEOUT = 60.0
+#: Seconds before retrying a request to a server which cannot be reached, doubled at each try
+RETRY_DELAY = 0.5
+#: Errors of the requests to a server which cannot be reached
+UNREACHABLE_ERRORS = (urllib.error.URLError, ConnectionError, TimeoutError)
+
+
+class AuthenticationError(Exception):
+    """The job server refused the token of a request"""
+
+
+def job_as_dict(job: Job) -> Dict[str, Any]:
+    """JSON serializable representation of what to do, without the results"""
+    return {"input": str(job.input_file), "output": str(job.output_file), "speed": job.speed,
+            "format": job.fmt.name.lower(), "profile": job.profile.value}
+
+
+def job_from_dict(data: Dict[str, Any]) -> Job:
+    """Creates a new job from its `job_as_dict()` representation"""
+    return Job(Path(data["input"]), Path(data["output"]), speed=float(data["speed"]),
+               fmt=Format[data["format"].upper()], profile=Profile(data["profile"]))
+
+
+@dataclass
+class RemoteJob:
+    """A job of a `JobServer`, and who is processing it"""
+    id: int
+    job: Job
+    #: "queued", "leased", "done" or "failed"
+    status: str = "queued"
+    #: Worker holding the lease, its token, and until when it holds it (monotonic time)
+    worker: Optional[str] = None
+    lease: Optional[str] = None
+    deadline: float = 0.0
+    #: Number of times the job was leased
+    attempts: int = 0
+    #: How much of the job is done, between 0 and 1, as reported by the worker
+    fraction: float = 0.0
+
+    def as_dict(self) -> Dict[str, Any]:
+        """JSON serializable representation, without the lease token"""
+        job = self.job
+        return {
+            "id": self.id, **job_as_dict(job), "status": self.status, "worker": self.worker,
+            "attempts": self.attempts, "fraction": self.fraction,
+            "progress": job.progress.as_dict() if job.progress else None,
+            "returncode": job.returncode, "error": job.error,
+        }
+
+
+class JobServer:
+    """
+    Holds the jobs, and leases them to workers for `lease_timeout` seconds. A worker must report
+    its progress more often than that, or the job is queued again, up to `max_attempts` times.
+    The HTTP server is bound to `address` (port 0 chooses a free one), it serves the API of
+    `JobRequestHandler` once started, to the clients which send `token`. The input and output
+    files of the jobs must be under one of the `roots` directories.
+    """
+
+    def __init__(self, address: Tuple[str, int] = ("127.0.0.1", 8642), *, token: str,
+                 roots: Sequence[Path], lease_timeout: float = 60.0, max_attempts: int = 3):
+        if not token:
+            raise ValueError("The job server needs a token")
+        self.token = token
+        self.roots = [root.resolve() for root in roots]
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        self.jobs: Dict[int, RemoteJob] = {}
+        #: Ids of the jobs waiting for a worker, in order
+        self._queued: Deque[int] = deque()
+        self._lock = Lock()
+        self._http = ThreadingHTTPServer(address, JobRequestHandler)
+        self._http.daemon_threads = True
+        self._http.jobs = self  # type: ignore
+        self._thread: Optional[Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._http.socket.getsockname()[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """Serves the jobs from a background thread"""
+        self._thread = Thread(target=self._http.serve_forever, daemon=True)
+        self._thread.start()
+
+    def serve_forever(self):
+        """Serves the jobs (blocking)"""
+        self._http.serve_forever()
+
+    def shutdown(self):
+        """Stops serving, leased jobs are not waited for"""
+        if self._thread:
+            self._http.shutdown()
+            self._thread.join()
+        self._http.server_close()
+
+    def check_path(self, path: Path) -> Path:
+        """`path` resolved, ValueError if it is not under one of the served directories"""
+        resolved = path.resolve()
+        if not path.is_absolute() or not any(
+                root == resolved or root in resolved.parents for root in self.roots):
+            raise ValueError(f"{path} is not under a directory served by the job server")
+        return resolved
+
+    def submit(self, job: Job) -> int:
+        """Queues a job, returns its id, ValueError if its files are not in the served ones"""
+        job.input_file = self.check_path(job.input_file)
+        job.output_file = self.check_path(job.output_file)
+        with self._lock:
+            job_id = len(self.jobs) + 1
+            self.jobs[job_id] = RemoteJob(job_id, job)
+            self._queued.append(job_id)
+        return job_id
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        """State of all the jobs, see `RemoteJob.as_dict()`, once the expired leases are"""
+        with self._lock:
+            self._expire()
+            return [remote.as_dict() for remote in self.jobs.values()]
+
+    def lease(self, worker: str) -> Optional[RemoteJob]:
+        """Leases the next queued job to a worker, None if there is none"""
+        with self._lock:
+            self._expire()
+            if not self._queued:
+                return None
+            remote = self.jobs[self._queued.popleft()]
+            remote.status, remote.worker = "leased", worker
+            remote.lease = secrets.token_hex(16)
+            remote.deadline = time.monotonic() + self.lease_timeout
+            remote.attempts += 1
+            LOGGER.info("Job %d leased to %s", remote.id, worker)
+            return remote
+
+    def holder(self, job_id: int, lease: str) -> Optional[RemoteJob]:
+        """The job, if `lease` is its current lease, which is then renewed"""
+        with self._lock:
+            self._expire()
+            remote = self.jobs.get(job_id)
+            if remote is None or remote.status != "leased" or remote.lease != lease:
+                return None
+            remote.deadline = time.monotonic() + self.lease_timeout
+            return remote
+
+    def report(self, job_id: int, lease: str, progress: Progress, fraction: float) -> bool:
+        """Records the progress of a leased job, returns False if the lease was lost"""
+        remote = self.holder(job_id, lease)
+        if remote is None:
+            return False
+        remote.job.progress, remote.fraction = progress, fraction
+        return True
+
+    def finish(self, job_id: int, lease: str, returncode: Optional[int],
+               error: Optional[str] = None) -> bool:
+        """Records the result of a leased job, returns False if the lease was lost"""
+        with self._lock:
+            remote = self.jobs.get(job_id)
+            if remote is None or remote.status != "leased" or remote.lease != lease:
+                return False
+            remote.job.returncode, remote.job.error = returncode, error
+            remote.status = "done" if returncode == 0 and not error else "failed"
+            remote.lease = None
+            if remote.status == "done":
+                remote.fraction = 1.0
+            LOGGER.info("Job %d %s", job_id, remote.status)
+            return True
+
+    def release(self, job_id: int, lease: str) -> bool:
+        """Queues a leased job again, for a worker which stops, returns False if it was not"""
+        with self._lock:
+            remote = self.jobs.get(job_id)
+            if remote is None or remote.status != "leased" or remote.lease != lease:
+                return False
+            self._requeue(remote)
+            return True
+
+    def _expire(self):
+        """Queues the jobs whose lease expired again (with the lock held)"""
+        now = time.monotonic()
+        for remote in self.jobs.values():
+            if remote.status != "leased" or remote.deadline > now:
+                continue
+            LOGGER.warning("Lease of job %d by %s expired", remote.id, remote.worker)
+            if remote.attempts >= self.max_attempts:
+                remote.status, remote.lease = "failed", None
+                remote.job.error = f"lease expired {remote.attempts} times"
+            else:
+                self._requeue(remote)
+
+    def _requeue(self, remote: RemoteJob):
+        """Queues a leased job again, before the others (with the lock held)"""
+        remote.status, remote.worker, remote.lease = "queued", None, None
+        remote.job.progress, remote.fraction = None, 0.0
+        self._queued.appendleft(remote.id)
+
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP API of a `JobServer`:
+    - GET /jobs, GET /jobs/<id>: state of the jobs
+    - POST /jobs: submits a job, see `job_as_dict()`
+    - POST /leases: leases a job to {"worker": name}, 204 if there is none
+    - POST /jobs/<id>/progress|heartbeat|finish|release: reports of the lease holder
+    - GET /jobs/<id>/input, PUT /jobs/<id>/output?lease=: the files, for workers without
+      shared storage
+    Requests without the "Authorization: Bearer <token>" header of the server get a 401
+    (Unauthorized) response, those of workers which lost their lease a 409 (Conflict) one.
+    """
+    server_version = "video-transformer"
+
+    @property
+    def jobs(self) -> JobServer:
+        return self.server.jobs  # type: ignore
+
+    def log_message(self, format: str, *args: Any):
+        LOGGER.debug("%s: " + format, self.address_string(), *args)
+
+    def send_json(self, data: Any, status: HTTPStatus = HTTPStatus.OK):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_status(self, status: HTTPStatus):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def read_json(self) -> Any:
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def route(self) -> Tuple[List[str], Dict[str, str]]:
+        """Path components and query parameters of the request"""
+        url = urlsplit(self.path)
+        query = {name: values[0] for name, values in parse_qs(url.query).items()}
+        return [part for part in url.path.split("/") if part], query
+
+    def authorized(self) -> bool:
+        """Whether the request has the server's token, a 401 response is sent otherwise"""
+        expected = f"Bearer {self.jobs.token}".encode()
+        if secrets.compare_digest(self.headers.get("Authorization", "").encode(errors="replace"),
+                                  expected):
+            return True
+        LOGGER.warning("Request without a valid token from %s", self.address_string())
+        self.send_response(HTTPStatus.UNAUTHORIZED)
+        self.send_header("WWW-Authenticate", "Bearer")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        return False
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        parts, query = self.route()
+        if parts == ["jobs"]:
+            # Not sent with the lock held, a slow client would block the workers
+            self.send_json({"jobs": self.jobs.snapshot()})
+        elif len(parts) == 2 and parts[0] == "jobs" and parts[1].isdigit():
+            remote = self.jobs.jobs.get(int(parts[1]))
+            if remote is None:
+                self.send_status(HTTPStatus.NOT_FOUND)
+            else:
+                self.send_json(remote.as_dict())
+        elif len(parts) == 3 and parts[0] == "jobs" and parts[1].isdigit() and parts[2] == "input":
+            self.send_input(int(parts[1]), query.get("lease", ""))
+        else:
+            self.send_status(HTTPStatus.NOT_FOUND)
+
+    def do_POST(self):
+        if not self.authorized():
+            return
+        parts, _ = self.route()
+        try:
+            data = self.read_json()
+            if parts == ["jobs"]:
+                self.send_json({"id": self.jobs.submit(job_from_dict(data))}, HTTPStatus.CREATED)
+            elif parts == ["leases"]:
+                remote = self.jobs.lease(data.get("worker") or self.address_string())
+                if remote is None:
+                    self.send_status(HTTPStatus.NO_CONTENT)
+                else:
+                    self.send_json({**remote.as_dict(), "lease": remote.lease,
+                                    "lease_timeout": self.jobs.lease_timeout})
+            elif len(parts) == 3 and parts[0] == "jobs":
+                self.lease_holder_request(int(parts[1]), parts[2], data)
+            else:
+                self.send_status(HTTPStatus.NOT_FOUND)
+        except (ValueError, KeyError, TypeError) as err:
+            self.send_json({"error": str(err)}, HTTPStatus.BAD_REQUEST)
+
+    def lease_holder_request(self, job_id: int, action: str, data: Dict[str, Any]):
+        """Progress, renewal, result or release of a leased job"""
+        lease = data["lease"]
+        if action == "progress":
+            ok = self.jobs.report(job_id, lease, Progress.from_dict(data["progress"]),
+                                  float(data["fraction"]))
+        elif action == "heartbeat":
+            ok = self.jobs.holder(job_id, lease) is not None
+        elif action == "finish":
+            ok = self.jobs.finish(job_id, lease, data["returncode"], data.get("error"))
+        elif action == "release":
+            ok = self.jobs.release(job_id, lease)
+        else:
+            self.send_status(HTTPStatus.NOT_FOUND)
+            return
+        self.send_status(HTTPStatus.NO_CONTENT if ok else HTTPStatus.CONFLICT)
+
+    def send_input(self, job_id: int, lease: str):
+        """Sends the input file of a leased job"""
+        remote = self.jobs.holder(job_id, lease)
+        if remote is None:
+            self.send_status(HTTPStatus.CONFLICT)
+            return
+        try:
+            file = self.jobs.check_path(remote.job.input_file).open("rb")
+        except (ValueError, OSError) as err:
+            self.send_json({"error": str(err)}, HTTPStatus.NOT_FOUND)
+            return
+        with file:
+            self.send_response(HTTPStatus.OK)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(os.fstat(file.fileno()).st_size))
+            self.end_headers()
+            shutil.copyfileobj(file, self.wfile, CHUNK_SIZE)
+
+    def do_PUT(self):
+        """Receives the output file of a leased job"""
+        if not self.authorized():
+            return
+        parts, query = self.route()
+        if len(parts) != 3 or parts[0] != "jobs" or parts[2] != "output":
+            self.send_status(HTTPStatus.NOT_FOUND)
+            return
+        try:
+            job_id, length = int(parts[1]), int(self.headers["Content-Length"])
+            self.receive_output(job_id, query.get("lease", ""), length)
+        except (ValueError, TypeError) as err:
+            self.send_json({"error": str(err)}, HTTPStatus.BAD_REQUEST)
+
+    def receive_output(self, job_id: int, lease: str, length: int):
+        """Writes the `length` bytes of the request as the output of a leased job"""
+        remote = self.jobs.holder(job_id, lease)
+        if remote is None:
+            self.send_status(HTTPStatus.CONFLICT)
+            return
+        output_file = self.jobs.check_path(remote.job.output_file)
+        output_file.parent.mkdir(parents=True, exist_ok=True)
+        # Written next to the output then moved, so that it is never seen incomplete
+        temp = output_file.with_name(f".{output_file.name}.{job_id}.tmp")
+        try:
+            with temp.open("wb") as file:
+                while length:
+                    chunk = self.rfile.read(min(length, CHUNK_SIZE))
+                    if not chunk:
+                        raise ValueError("truncated upload")
+                    file.write(chunk)
+                    length -= len(chunk)
+            if self.jobs.holder(job_id, lease) is None:
+                self.send_status(HTTPStatus.CONFLICT)
+                return
+            os.replace(temp, output_file)
+        finally:
+            if temp.exists():
+                temp.unlink()
+        self.send_status(HTTPStatus.NO_CONTENT)
+
+
+def open_url(req: urllib.request.Request, body: Optional[BinaryIO] = None,
+             retries: int = 0) -> Any:
+    """
+    Opens a request to a job server, retrying up to `retries` times, with backoff, when the
+    server cannot be reached. `body` is the file sent by the request, rewound between tries.
+    AuthenticationError if the server refused the token.
+    """
+    for attempt in itertools.count():
+        try:
+            if body is not None:
+                body.seek(0)
+            return urllib.request.urlopen(req, timeout=REQUEST_TIMEOUT)
+        except urllib.error.HTTPError as err:
+            if err.code == HTTPStatus.UNAUTHORIZED:
+                raise AuthenticationError(f"The job server refused the token ({req.full_url})")
+            raise
+        except UNREACHABLE_ERRORS as err:
+            if attempt >= retries:
+                raise
+            delay = RETRY_DELAY * 2 ** attempt
+            LOGGER.warning("Cannot reach %s (%s), retrying in %.1fs", req.full_url,
+                           getattr(err, "reason", err), delay)
+            time.sleep(delay)
+
+
+def request(url: str, token: str, method: str = "GET", data: Any = None,
+            body: Optional[BinaryIO] = None, length: int = 0,
+            retries: int = 0) -> Tuple[int, Any]:
+    """
+    Sends a request to a job server, returns the response's status and decoded JSON body.
+    `data` is sent as JSON, or `body` as is. See `open_url()` for `retries`.
+    """
+    headers = {"Authorization": f"Bearer {token}"}
+    payload: Any = None
+    if data is not None:
+        payload = json.dumps(data).encode()
+        headers["Content-Type"] = "application/json"
+    elif body is not None:
+        payload = body
+        headers["Content-Length"] = str(length)
+    req = urllib.request.Request(url, data=payload, method=method, headers=headers)
+    try:
+        with open_url(req, body, retries) as response:
+            content = response.read()
+            return response.status, json.loads(content) if content else None
+    except urllib.error.HTTPError as err:
+        try:
+            return err.code, json.loads(err.read() or b"null")
+        except ValueError:
+            return err.code, None
+
+
+def submit(url: str, token: str, jobs: Iterable[Job]) -> List[int]:
+    """
+    Submits jobs to a job server, returns their ids. Paths must make sense to the workers, and
+    be under the directories served by the server.
+    """
+    ids = []
+    for job in jobs:
+        code, data = request(f"{url}/jobs", token, "POST", job_as_dict(job))
+        if code != HTTPStatus.CREATED:
+            error = data.get("error") if isinstance(data, dict) else None
+            raise VideoError(f"{job.input_file} could not be submitted ({error or code})")
+        ids.append(data["id"])
+    return ids
+
+
+def status(url: str, token: str) -> List[Dict[str, Any]]:
+    """State of the jobs of a job server, see `RemoteJob.as_dict()`"""
+    return request(f"{url}/jobs", token)[1]["jobs"]
+
+
+class Worker:
+    """
+    Processes the jobs of the job server at `url`, one at a time, authenticated by `token`.
+    With `shared` storage, the paths of the jobs are used as is, otherwise the input is
+    downloaded and the output uploaded. `threads` limits the threads of each ffmpeg process.
+    """
+    #: Seconds between two progress reports, which must be less than the lease timeout
+    REPORT_INTERVAL: float = 1.0
+    #: Times a request is tried again when the server cannot be reached, see `open_url()`
+    RETRIES: int = 6
+
+    def __init__(self, url: str, token: str, name: Optional[str] = None, shared: bool = True,
+                 threads: Optional[int] = None, cache: Optional["MetadataCache"] = None,
+                 poll_interval: float = 2.0):
+        self.url = url.rstrip("/")
+        self.token = token
+        self.name = name or f"{os.uname().nodename}:{os.getpid()}"
+        self.shared = shared
+        self.threads = threads
+        self.cache = cache
+        #: Seconds to wait before asking again for a job, when there was none
+        self.poll_interval = poll_interval
+        #: Number of jobs processed
+        self.processed = 0
+        self._wrapper: Optional[FFmpegWrapper] = None
+        self._stopping = False
+
+    def stop(self):
+        """Stops processing, the current job is given back to the server (thread safe)"""
+        self._stopping = True
+        self._stop_ffmpeg()
+
+    def _stop_ffmpeg(self):
+        """Stops the ffmpeg process of the current job, if any"""
+        wrapper = self._wrapper
+        if wrapper:
+            try:
+                wrapper.stop()
+            except RuntimeError:
+                # Not started yet, or already finished
+                pass
+
+    def run(self, exit_when_idle: bool = False):
+        """
+        Processes jobs (blocking) until stopped, or until there are none with `exit_when_idle`.
+        The worker outlives a server which cannot be reached, but not one refusing its token
+        (AuthenticationError).
+        """
+        self._stopping = False
+        while not self._stopping:
+            try:
+                status_code, leased = self._request(f"{self.url}/leases", "POST",
+                                                    {"worker": self.name})
+                if status_code == HTTPStatus.OK:
+                    self._process(leased)
+                    continue
+            except UNREACHABLE_ERRORS as err:
+                LOGGER.error("Cannot reach the job server: %s", getattr(err, "reason", err))
+            else:
+                if exit_when_idle:
+                    return
+            time.sleep(self.poll_interval)
+
+    def _request(self, url: str, method: str = "GET", data: Any = None,
+                 body: Optional[BinaryIO] = None, length: int = 0) -> Tuple[int, Any]:
+        """Sends a request to the server, see `request()`"""
+        return request(url, self.token, method, data, body, length, self.RETRIES)
+
+    def _post(self, job_id: int, action: str, lease: str, **data: Any) -> bool:
+        """Sends a report of the lease holder, returns False if the lease was lost"""
+        url = f"{self.url}/jobs/{job_id}/{action}"
+        return self._request(url, "POST", {"lease": lease, **data})[0] == HTTPStatus.NO_CONTENT
+
+    @contextmanager
+    def _heartbeat(self, job_id: int, lease: str, interval: float) -> Iterator[Event]:
+        """
+        Renews the lease every `interval` seconds while the job is held, whatever the worker
+        is doing. The event yielded is set, and ffmpeg stopped, once the lease is lost.
+        """
+        lost, released = Event(), Event()
+
+        def beat():
+            while not released.wait(interval):
+                try:
+                    renewed = self._post(job_id, "heartbeat", lease)
+                except UNREACHABLE_ERRORS as err:
+                    # Retried at the next beat, while the lease lasts
+                    LOGGER.warning("Cannot renew the lease of job %d: %s", job_id, err)
+                    continue
+                if not renewed:
+                    LOGGER.warning("Lease of job %d lost, stopping", job_id)
+                    lost.set()
+                    self._stop_ffmpeg()
+                    return
+
+        thread = Thread(target=beat, name=f"heartbeat-{job_id}", daemon=True)
+        thread.start()
+        try:
+            yield lost
+        finally:
+            released.set()
+            thread.join()
+
+    def _process(self, leased: Dict[str, Any]):
+        """
+        Processes a leased job, which fails if anything goes wrong with it, rather than the worker.
+        If the server cannot be reached, the job is left to the expiry of its lease.
+        """
+        job_id, lease, job = leased["id"], leased["lease"], job_from_dict(leased)
+        LOGGER.info("Processing job %d: %s", job_id, job.input_file)
+        with self._heartbeat(job_id, lease, float(leased["lease_timeout"]) / 3) as lost, \
+                TemporaryDirectory(prefix="video-transformer-worker-") as directory:
+            error = None
+            try:
+                returncode = self._run(job_id, lease, job, Path(directory), lost)
+            except (AuthenticationError, *UNREACHABLE_ERRORS):
+                raise
+            except Exception as err:
+                if not isinstance(err, VideoError):
+                    LOGGER.exception("Job %d failed", job_id)
+                returncode, error = None, str(err) or type(err).__name__
+            if lost.is_set():
+                return
+            if returncode == 255 and self._stopping:
+                self._post(job_id, "release", lease)
+                return
+            self._post(job_id, "finish", lease, returncode=returncode, error=error)
+            if error is None:
+                self.processed += 1
+
+    def _run(self, job_id: int, lease: str, job: Job, directory: Path,
+             lost: Event) -> Optional[int]:
+        """Fetches the input, encodes it and sends the output, returns ffmpeg's return code"""
+        input_file, output_file = job.input_file, job.output_file
+        if not self.shared:
+            input_file = directory / f"input{job.input_file.suffix}"
+            output_file = directory / f"output{job.output_file.suffix}"
+            self._download(job_id, lease, input_file)
+        if not input_file.exists():
+            raise VideoError(f"{input_file} does not exist")
+        wrapper = FFmpegWrapper(input_file, cache=self.cache)
+        job.metadata = wrapper.metadata
+        if lost.is_set():
+            return None
+        self._encode(job_id, lease, job, wrapper, output_file, lost)
+        if wrapper.returncode == 0 and not self.shared and not lost.is_set():
+            self._upload(job_id, lease, output_file, lost)
+        return wrapper.returncode
+
+    def _encode(self, job_id: int, lease: str, job: Job, wrapper: FFmpegWrapper,
+                output_file: Path, lost: Event):
+        """Runs ffmpeg, reporting its progress, stops it once the lease is lost"""
+        self._wrapper = wrapper
+        reported = 0.0
+        try:
+            for progress in wrapper.process(output_file, by=job.speed, fmt=job.fmt,
+                                            threads=self.threads, profile=job.profile):
+                job.progress = progress
+                if lost.is_set() or (time.monotonic() - reported < self.REPORT_INTERVAL
+                                     and not progress.done):
+                    continue
+                reported = time.monotonic()
+                if not self._post(job_id, "progress", lease, progress=progress.as_dict(),
+                                  fraction=job.fraction):
+                    LOGGER.warning("Lease of job %d lost, stopping", job_id)
+                    lost.set()
+                    wrapper.stop()
+        finally:
+            self._wrapper = None
+
+    def _download(self, job_id: int, lease: str, to: Path):
+        """Downloads the input of a leased job"""
+        url = f"{self.url}/jobs/{job_id}/input?lease={lease}"
+        req = urllib.request.Request(url, headers={"Authorization": f"Bearer {self.token}"})
+        try:
+            with open_url(req, retries=self.RETRIES) as response, to.open("wb") as file:
+                shutil.copyfileobj(response, file, CHUNK_SIZE)
+        except urllib.error.HTTPError as err:
+            raise VideoError(f"Cannot download the input: {err}")
+
+    def _upload(self, job_id: int, lease: str, output_file: Path, lost: Event):
+        """Uploads the output of a leased job, sets `lost` if the lease was lost"""
+        url = f"{self.url}/jobs/{job_id}/output?lease={lease}"
+        with output_file.open("rb") as file:
+            status_code, data = self._request(url, "PUT", body=file,
+                                              length=os.fstat(file.fileno()).st_size)
+        if status_code == HTTPStatus.CONFLICT:
+            lost.set()
+        elif status_code != HTTPStatus.NO_CONTENT:
+            error = data.get("error") if isinstance(data, dict) else status_code
+            raise VideoError(f"Cannot upload the output: {error}")
@@ -14,7 +14,7 @@ from PyQt5 import QtCore, QtGui, QtWidgets
 class Ui_MainWindow(object):
     def setupUi(self, MainWindow):
         MainWindow.setObjectName("MainWindow")
-        MainWindow.resize(407, 275)
+        MainWindow.resize(407, 361)
         sizePolicy = QtWidgets.QSizePolicy(QtWidgets.QSizePolicy.Fixed, QtWidgets.QSizePolicy.Fixed)
         sizePolicy.setHorizontalStretch(0)
         sizePolicy.setVerticalStretch(0)
@@ -23,7 +23,7 @@ class Ui_MainWindow(object):
         self.centralwidget = QtWidgets.QWidget(MainWindow)
         self.centralwidget.setObjectName("centralwidget")
         self.verticalLayoutWidget = QtWidgets.QWidget(self.centralwidget)
-        self.verticalLayoutWidget.setGeometry(QtCore.QRect(0, 10, 401, 241))
+        self.verticalLayoutWidget.setGeometry(QtCore.QRect(0, 10, 401, 327))
         self.verticalLayoutWidget.setObjectName("verticalLayoutWidget")
         self.verticalLayout = QtWidgets.QVBoxLayout(self.verticalLayoutWidget)
         self.verticalLayout.setContentsMargins(7, 0, 7, 0)
@@ -58,6 +58,22 @@ class Ui_MainWindow(object):
         self.resulting_duration.setObjectName("resulting_duration")
         self.horizontalLayout.addWidget(self.resulting_duration)
         self.verticalLayout.addLayout(self.horizontalLayout)
+        self.format_layout = QtWidgets.QHBoxLayout()
+        self.format_layout.setObjectName("format_layout")
+        self.format_label = QtWidgets.QLabel(self.verticalLayoutWidget)
+        self.format_label.setAlignment(QtCore.Qt.AlignCenter)
+        self.format_label.setObjectName("format_label")
+        self.format_layout.addWidget(self.format_label)
+        self.format_combobox = QtWidgets.QComboBox(self.verticalLayoutWidget)
+        self.format_combobox.setObjectName("format_combobox")
+        self.format_layout.addWidget(self.format_combobox)
+        self.profile_combobox = QtWidgets.QComboBox(self.verticalLayoutWidget)
+        self.profile_combobox.setObjectName("profile_combobox")
+        self.format_layout.addWidget(self.profile_combobox)
+        self.verticalLayout.addLayout(self.format_layout)
+        self.preview_layout = QtWidgets.QHBoxLayout()
+        self.preview_layout.setObjectName("preview_layout")
+        self.verticalLayout.addLayout(self.preview_layout)
         self.process_button = QtWidgets.QCommandLinkButton(self.verticalLayoutWidget)
         sizePolicy = QtWidgets.QSizePolicy(QtWidgets.QSizePolicy.Preferred, QtWidgets.QSizePolicy.Expanding)
         sizePolicy.setHorizontalStretch(0)
@@ -88,3 +104,4 @@ class Ui_MainWindow(object):
         MainWindow.setWindowTitle(_translate("MainWindow", "video transformer"))
         self.speed_label.setText(_translate("MainWindow", "Speedup:"))
         self.speed_spinbox.setPrefix(_translate("MainWindow", "x"))
+        self.format_label.setText(_translate("MainWindow", "Format:"))
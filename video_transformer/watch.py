@@ -0,0 +1,374 @@
+"""
+Watch folder: videos dropped in a directory are processed as soon as they are completely
+written, then moved to a "done" or "failed" directory.
+"""
+import ctypes
+import ctypes.util
+import json
+import os
+import shutil
+import stat
+import struct
+import time
+
+from dataclasses import asdict, dataclass
+from logging import getLogger
+from pathlib import Path
+from queue import Empty, Queue
+from select import select
+from threading import Event, Lock, Thread
+from typing import TYPE_CHECKING, Dict, List, Optional, Set, Tuple, Union
+
+from video_transformer.core import (FFmpegWrapper, Format, Profile, VideoError,
+                                    default_output_file, resume_directory)
+from video_transformer.probe import VIDEO_EXTENSIONS
+
+if TYPE_CHECKING:
+    from video_transformer.cache import MetadataCache
+
+LOGGER = getLogger(__name__)
+
+
+class Inotify:
+    """Notifications of the files created in, or moved to, a directory, by Linux's inotify"""
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_Q_OVERFLOW = 0x4000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    #: struct inotify_event, without its name
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self, directory: Path):
+        """Raises `OSError` if inotify is not available"""
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            init, add_watch = libc.inotify_init1, libc.inotify_add_watch
+        except (OSError, AttributeError) as err:
+            raise OSError(f"inotify is not available: {err}")
+        self.fd = init(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        if add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, os.strerror(errno), str(directory))
+
+    def wait(self, timeout: float) -> Optional[List[str]]:
+        """
+        Waits up to `timeout` seconds for events, returns the names of the files concerned.
+        None if events were lost because the kernel's queue overflowed: the directory must be
+        listed again.
+        """
+        rlist, _, _ = select([self.fd], (), (), timeout)
+        if not rlist:
+            return []
+        data = os.read(self.fd, 65536)
+        names: List[str] = []
+        overflowed = False
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                overflowed = True
+            elif name:
+                names.append(os.fsdecode(name))
+        return None if overflowed else names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class DirectoryPoller:
+    """
+    Same as `Inotify`, by listing the directory. It is only listed again when its modification
+    time changed, which it does when files are created in it or moved to it.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self._mtime_ns: Optional[int] = None
+        self._names: Set[str] = set()
+
+    def wait(self, timeout: float) -> List[str]:
+        """Waits `timeout` seconds, returns the names of the files that appeared meanwhile"""
+        time.sleep(timeout)
+        mtime_ns = os.stat(self.directory).st_mtime_ns
+        # Files created right after the last listing may not have changed the timestamp
+        if mtime_ns == self._mtime_ns and time.time_ns() - mtime_ns > 1e9:
+            return []
+        self._mtime_ns = mtime_ns
+        with os.scandir(self.directory) as entries:
+            names = {entry.name for entry in entries}
+        new = names - self._names
+        self._names = names
+        return sorted(new)
+
+    def close(self):
+        pass
+
+
+@dataclass
+class WatchedFile:
+    """State of a file of the watched directory, as persisted in the state file"""
+    size: int
+    mtime_ns: int
+    #: "processing", "done" or "failed"
+    status: str
+    output: Optional[str] = None
+    error: Optional[str] = None
+
+
+class WatchFolder:
+    """
+    Processes the videos dropped in `inbox` (not in its subdirectories) once their size and
+    modification time did not change for `settle` seconds, with up to `workers` ffmpeg processes.
+    The results are written to `output_dir`, then the videos are moved to `done_dir`, or to
+    `failed_dir` if they could not be processed.
+    What was processed is persisted in `state_file`, so that restarting does not process the
+    same videos again, and finishes moving those that were processed.
+    """
+    #: Seconds between two checks of the pending files
+    TICK: float = 1.0
+
+    def __init__(self, inbox: Path, output_dir: Path, speed: float = 2.0,
+                 fmt: Format = Format.MP4, profile: Profile = Profile.ARCHIVAL,
+                 workers: int = 1, settle: float = 5.0, done_dir: Optional[Path] = None,
+                 failed_dir: Optional[Path] = None, state_file: Optional[Path] = None,
+                 cache: Optional["MetadataCache"] = None, polling: bool = False):
+        self.inbox = inbox
+        self.output_dir = output_dir
+        self.speed = speed
+        self.fmt = fmt
+        self.profile = profile
+        self.workers = workers
+        self.settle = settle
+        self.done_dir = done_dir or inbox / "done"
+        self.failed_dir = failed_dir or inbox / "failed"
+        self.state_file = state_file or inbox / ".video-transformer-watch.json"
+        self.cache = cache
+        #: Whether to list the directory even where inotify is available
+        self.polling = polling
+        #: Files being processed or moved, by name
+        self.files: Dict[str, WatchedFile] = {}
+        #: Files that appeared, by name, with their last (size, mtime) and since when it is so
+        self._pending: Dict[str, Tuple[int, int, float]] = {}
+        self._ready: "Queue[Optional[str]]" = Queue()
+        self._finished: "Queue[str]" = Queue()
+        self._running: Dict[str, FFmpegWrapper] = {}
+        self._lock = Lock()
+        self._stopping = Event()
+
+    def stop(self):
+        """Stops watching, the videos being processed are left in `inbox` (thread safe)"""
+        self._stopping.set()
+        with self._lock:
+            running = list(self._running.values())
+        for wrapper in running:
+            try:
+                wrapper.stop()
+            except RuntimeError:
+                # Not started yet, or already finished
+                pass
+
+    def run(self):
+        """Watches the directory (blocking) until `stop()` is called"""
+        for directory in (self.output_dir, self.done_dir, self.failed_dir):
+            directory.mkdir(parents=True, exist_ok=True)
+        self._load_state()
+        watcher = self._watcher()
+        threads = [Thread(target=self._worker, daemon=True) for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        try:
+            # What was there before
+            self._appeared(self._list_inbox())
+            while not self._stopping.is_set():
+                names = watcher.wait(self.TICK)
+                if names is None:
+                    LOGGER.warning("Notifications of %s were lost, listing it again", self.inbox)
+                    names = self._list_inbox()
+                self._appeared(names)
+                self._check_pending()
+                self._move_finished()
+        finally:
+            self.stop()
+            watcher.close()
+            for _ in threads:
+                self._ready.put(None)
+            for thread in threads:
+                thread.join()
+            self._move_finished()
+
+    def _watcher(self) -> Union[Inotify, DirectoryPoller]:
+        """Notifications of the files appearing in the inbox"""
+        if not self.polling:
+            try:
+                return Inotify(self.inbox)
+            except OSError as err:
+                LOGGER.info("Listing %s periodically: %s", self.inbox, err)
+        return DirectoryPoller(self.inbox)
+
+    def _list_inbox(self) -> List[str]:
+        """Names of all the files of the inbox"""
+        with os.scandir(self.inbox) as entries:
+            return [entry.name for entry in entries]
+
+    def _appeared(self, names: List[str]):
+        """Starts checking whether the given files are completely written"""
+        now = time.monotonic()
+        for name in names:
+            if name.startswith(".") or os.path.splitext(name)[1].lower() not in VIDEO_EXTENSIONS:
+                continue
+            if name not in self._pending and name not in self.files:
+                # Unknown size, it is only stable once it did not change for a while
+                self._pending[name] = (-1, -1, now)
+
+    def _check_pending(self):
+        """Queues the pending files that were not changed for `settle` seconds"""
+        now = time.monotonic()
+        for name, (size, mtime_ns, since) in list(self._pending.items()):
+            try:
+                stat_result = os.stat(self.inbox / name)
+            except FileNotFoundError:
+                # Moved away or deleted before it could be processed
+                del self._pending[name]
+                continue
+            if not stat.S_ISREG(stat_result.st_mode):
+                del self._pending[name]
+            elif (stat_result.st_size, stat_result.st_mtime_ns) != (size, mtime_ns):
+                self._pending[name] = (stat_result.st_size, stat_result.st_mtime_ns, now)
+            elif now - since >= self.settle:
+                del self._pending[name]
+                self.files[name] = WatchedFile(size, mtime_ns, "processing")
+                self._save_state()
+                self._ready.put(name)
+
+    def _worker(self):
+        """Processes the ready files until there are none left"""
+        name = self._ready.get()
+        while name is not None:
+            if not self._stopping.is_set():
+                try:
+                    self._process(name)
+                except Exception as err:
+                    # Whatever went wrong with a file, the next ones are processed
+                    LOGGER.exception("Cannot process %s", name)
+                    self._failed(name, str(err) or type(err).__name__)
+            name = self._ready.get()
+
+    def _output_file(self, name: str) -> Path:
+        """Where a file of the inbox is processed to"""
+        return self.output_dir / default_output_file(self.inbox / name, self.speed, self.fmt).name
+
+    def _process(self, name: str):
+        """Processes a single file, from a worker thread"""
+        entry = self.files[name]
+        input_file = self.inbox / name
+        output_file = self._output_file(name)
+        try:
+            wrapper = FFmpegWrapper(input_file, cache=self.cache)
+        except (VideoError, OSError) as err:
+            self._failed(name, str(err))
+            return
+        with self._lock:
+            self._running[name] = wrapper
+        try:
+            LOGGER.info("Processing %s", input_file)
+            threads = max(1, (os.cpu_count() or 1) // self.workers)
+            # Restarting the daemon does not lose the work done on long videos
+            for _ in wrapper.process(output_file, by=self.speed, fmt=self.fmt,
+                                     threads=threads, profile=self.profile, resumable=True):
+                pass
+        finally:
+            with self._lock:
+                del self._running[name]
+        if wrapper.returncode == 255:
+            # Interrupted (possibly by a Ctrl-C sent to the whole process group), not a failure
+            # of the video: it is processed again after a restart
+            LOGGER.warning("Processing %s was interrupted", input_file)
+            return
+        if wrapper.returncode == 0:
+            entry.status, entry.output = "done", str(output_file)
+            self._finished.put(name)
+        else:
+            self._failed(name, f"ffmpeg exited with code {wrapper.returncode}")
+
+    def _failed(self, name: str, error: str):
+        """Records that a file could not be processed, and will not be tried again"""
+        entry = self.files[name]
+        entry.status, entry.error = "failed", error
+        # The pieces of the encode, if any, are of no use anymore
+        shutil.rmtree(resume_directory(self._output_file(name)), ignore_errors=True)
+        self._finished.put(name)
+
+    def _move_finished(self):
+        """Moves the files that were processed (or could not be) out of the inbox"""
+        while True:
+            try:
+                name = self._finished.get_nowait()
+            except Empty:
+                return
+            entry = self.files[name]
+            # Recorded first: if moving is interrupted, it is finished after a restart
+            self._save_state()
+            self._move(name, entry)
+
+    def _move(self, name: str, entry: WatchedFile):
+        """Moves a file out of the inbox, according to its status"""
+        directory = self.done_dir if entry.status == "done" else self.failed_dir
+        destination = directory / name
+        counter = 1
+        while destination.exists():
+            # Never overwrite an earlier file of the same name
+            destination = directory / f"{Path(name).stem}.{counter}{Path(name).suffix}"
+            counter += 1
+        try:
+            os.replace(self.inbox / name, destination)
+        except FileNotFoundError:
+            pass
+        if entry.status == "done":
+            LOGGER.info("%s processed to %s", name, entry.output)
+        else:
+            LOGGER.warning("%s could not be processed: %s", name, entry.error)
+        del self.files[name]
+        self._save_state()
+
+    def _load_state(self):
+        """Reads the state left by a previous run, finishes what it was doing"""
+        try:
+            data = json.loads(self.state_file.read_text())
+        except FileNotFoundError:
+            return
+        except ValueError as err:
+            LOGGER.warning("Ignoring invalid state file %s: %s", self.state_file, err)
+            return
+        for name, fields in data["files"].items():
+            entry = WatchedFile(**fields)
+            try:
+                stat_result = os.stat(self.inbox / name)
+            except FileNotFoundError:
+                continue
+            if (stat_result.st_size, stat_result.st_mtime_ns) != (entry.size, entry.mtime_ns):
+                # Replaced by another file of the same name
+                continue
+            if entry.status == "processing":
+                # Interrupted, it will be processed again, from the pieces already encoded
+                continue
+            self.files[name] = entry
+            self._move(name, entry)
+        self._save_state()
+
+    def _save_state(self):
+        """Writes the state file atomically"""
+        temp = self.state_file.with_name(f".{self.state_file.name}.{os.getpid()}.tmp")
+        temp.write_text(json.dumps(
+            {"files": {name: asdict(entry) for name, entry in self.files.items()}}
+        ))
+        os.replace(temp, self.state_file)